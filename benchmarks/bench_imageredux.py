@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_imageredux - Benchmarks for the imageredux reduction pipeline.
+
+Generates synthetic nights in the root/YYYYMMDD/{bias,dark,flat,objX} layout,
+times each pipeline stage in a fresh process, records its peak RSS and writes
+the results to a JSON file that can be compared between releases.
+
+Usage:
+
+    $ python benchmarks/bench_imageredux.py --sizes 1024 2048 4096 -o results.json
+    $ python benchmarks/bench_imageredux.py --sizes 1024 --compare results.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import imageredux as redux  # noqa: E402
+
+
+BIAS_LEVEL = 1000.0
+"Bias level of the synthetic camera in ADU."
+READ_NOISE = 8.0
+"Read noise of the synthetic camera in ADU."
+DARK_CURRENT = 0.5
+"Dark current of the synthetic camera in ADU/s."
+FLAT_LEVEL = 20000.0
+"Mean illumination of the synthetic flats in ADU."
+
+
+def _write_frame(fname, data, imagetyp, exposure, filt, date_obs):
+    """Write data as a 16-bit unsigned FITS frame with the usual acquisition headers."""
+    hdu = fits.PrimaryHDU(np.clip(data, 0, 65535).astype(np.uint16))
+    hdu.header['IMAGETYP'] = imagetyp
+    hdu.header['EXPOSURE'] = exposure
+    hdu.header['FILTER'] = filt
+    hdu.header['XBINNING'] = 1
+    hdu.header['YBINNING'] = 1
+    hdu.header['DATE-OBS'] = date_obs
+    hdu.writeto(fname, overwrite=True)
+
+
+def make_synthetic_night(root, night="20170817", shape=(1024, 1024), n_bias=5, n_dark=5, n_flat=5,
+                         objects=None, dark_exposure=60.0, flat_exposure=5.0, light_exposure=60.0,
+                         filt="R", nstars=50, seed=0):
+    """
+    Write a synthetic night in the directory layout expected by imageredux.
+
+    Frames are 16-bit with a bias level, read noise, dark current proportional to the
+    exposure, a vignetted flat field, and Gaussian stars on a sky background for the
+    light frames.
+
+    Args:
+        root: the root directory; the night is written to root/night
+        night: the night directory name (YYYYMMDD)
+        shape: the (nrows, ncols) frame shape
+        n_bias, n_dark, n_flat: the number of bias, dark and flat frames
+        objects: a dict object name -> number of light frames; default one object of 10 frames
+        dark_exposure, flat_exposure, light_exposure: the exposure times in seconds
+        filt: the FILTER header value
+        nstars: the number of stars in each light frame
+        seed: the random seed
+
+    Returns:
+        the path of the night directory
+    """
+    rng = np.random.RandomState(seed)
+    objects = {"obj1": 10} if objects is None else objects
+    nrows, ncols = shape
+    night_dir = os.path.join(root, night)
+    date_obs = "{}-{}-{}T00:00:00".format(night[:4], night[4:6], night[6:])
+
+    yy, xx = np.mgrid[0:nrows, 0:ncols]
+    rr = np.hypot((yy - nrows / 2.0) / nrows, (xx - ncols / 2.0) / ncols)
+    vignetting = 1.0 - 0.3 * rr ** 2
+
+    def noise():
+        return rng.normal(0.0, READ_NOISE, shape)
+
+    for kind, count, exposure, name, imagetyp in (
+            ("bias", n_bias, 0.0, "bias", "Bias Frame"),
+            ("dark", n_dark, dark_exposure, "dark", "Dark Frame"),
+            ("flat", n_flat, flat_exposure, "flat", "Flat Field")):
+        os.makedirs(os.path.join(night_dir, kind), exist_ok=True)
+        for i in range(count):
+            data = BIAS_LEVEL + DARK_CURRENT * exposure + noise()
+            if kind == "flat":
+                data += FLAT_LEVEL * vignetting
+            fname = os.path.join(night_dir, kind, "{}_{:03d}.fit".format(name, i))
+            _write_frame(fname, data, imagetyp, exposure, filt, date_obs)
+
+    for obj, count in sorted(objects.items()):
+        os.makedirs(os.path.join(night_dir, obj), exist_ok=True)
+        star_y = rng.uniform(0, nrows, nstars)
+        star_x = rng.uniform(0, ncols, nstars)
+        star_flux = rng.uniform(500, 20000, nstars)
+        for i in range(count):
+            sky = np.full(shape, 200.0)
+            for y, x, flux in zip(star_y, star_x, star_flux):
+                y0, y1 = int(max(0, y - 8)), int(min(nrows, y + 9))
+                x0, x1 = int(max(0, x - 8)), int(min(ncols, x + 9))
+                sky[y0:y1, x0:x1] += flux * np.exp(
+                    -((yy[y0:y1, x0:x1] - y) ** 2 + (xx[y0:y1, x0:x1] - x) ** 2) / (2 * 2.0 ** 2))
+            data = BIAS_LEVEL + DARK_CURRENT * light_exposure + sky * vignetting
+            data = rng.poisson(np.clip(data, 0, None)).astype(np.float64) + noise()
+            fname = os.path.join(night_dir, obj, "{}_{:03d}.fit".format(obj, i))
+            _write_frame(fname, data, "Light Frame", light_exposure, filt, date_obs)
+
+    return night_dir
+
+
+def _peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2.0 ** 20
+
+
+def _stage_file_list(in_dir, out_dir, night_dir, engine):
+    redux._IN_DIR = in_dir
+    return len(redux.do_file_list())
+
+
+def _read_master(out_dir, name):
+    return redux.ccdproc.fits_ccddata_reader(os.path.join(out_dir, "master-{}.fit".format(name)))
+
+
+def _stage_bias_combine(in_dir, out_dir, night_dir, engine):
+    bias_list, __, __ = redux._calibration_lists(night_dir)
+    redux.do_bias_combine(bias_list, out_dir)
+    return len(bias_list)
+
+
+def _stage_dark_combine(in_dir, out_dir, night_dir, engine):
+    __, dark_list, __ = redux._calibration_lists(night_dir)
+    redux.do_dark_combine(dark_list, out_dir, master_bias=_read_master(out_dir, "bias"))
+    return len(dark_list)
+
+
+def _stage_flat_combine(in_dir, out_dir, night_dir, engine):
+    __, __, flat_list = redux._calibration_lists(night_dir)
+    redux.do_flat_combine(flat_list, _read_master(out_dir, "dark"), out_dir, master_bias=_read_master(out_dir, "bias"))
+    return len(flat_list)
+
+
+def _stage_calibrate(in_dir, out_dir, night_dir, engine):
+    master_bias = _read_master(out_dir, "bias")
+    master_dark = _read_master(out_dir, "dark")
+    master_flat = _read_master(out_dir, "flat")
+    nframes = 0
+    for obj in redux._object_dirs(night_dir):
+        object_list = redux._object_list(night_dir, obj)
+        redux.do_calibrate(object_list, master_flat, master_dark, "{}_{}".format(obj, engine), out_dir,
+                           engine=engine, master_bias=master_bias)
+        nframes += len(object_list)
+    return nframes
+
+
+STAGES = (
+    ("do_file_list", _stage_file_list),
+    ("do_bias_combine", _stage_bias_combine),
+    ("do_dark_combine", _stage_dark_combine),
+    ("do_flat_combine", _stage_flat_combine),
+    ("do_calibrate", _stage_calibrate),
+    )
+"The benchmarked stages, in pipeline order."
+
+
+def _run_stage(func, *args):
+    """
+    Run a stage and return (frames processed, wall seconds, peak RSS in MB).
+
+    The lazily imported modules are imported before the timer starts, so every stage is timed
+    without the imports, as before imageredux deferred them.
+    """
+    redux._import_lazy_modules()
+    start = time.perf_counter()
+    nframes = func(*args)
+    return nframes, time.perf_counter() - start, _peak_rss_mb()
+
+
+def run_benchmarks(sizes, n_dark=10, n_flat=10, n_light=20, engines=("numpy",), workdir=None):
+    """
+    Benchmark every stage at each frame size.
+
+    Each stage runs in a freshly spawned process so its peak RSS is measured in isolation.
+
+    Returns:
+        a list of result dicts with keys stage, size, engine, frames, seconds,
+        frames_per_sec and peak_rss_mb
+    """
+    results = []
+    context = get_context("spawn")
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix="bench_redux_", dir=workdir)
+        try:
+            in_dir = os.path.join(root, "raw")
+            night_dir = make_synthetic_night(in_dir, shape=(size, size), n_dark=n_dark, n_flat=n_flat,
+                                             objects={"obj1": n_light})
+            for engine in engines:
+                out_dir = os.path.join(root, "out_{}".format(engine))
+                os.makedirs(out_dir)
+                for stage, func in STAGES:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        nframes, seconds, peak_rss_mb = executor.submit(
+                            _run_stage, func, in_dir, out_dir, night_dir, engine).result()
+                    results.append({
+                        "stage": stage,
+                        "size": size,
+                        "engine": engine,
+                        "frames": nframes,
+                        "seconds": seconds,
+                        "frames_per_sec": nframes / seconds if seconds > 0 else None,
+                        "peak_rss_mb": peak_rss_mb,
+                        })
+                    print("{:>16s} {:>5d}px {:>8s} {:5d} frames {:8.3f} s {:8.1f} MB".format(
+                        stage, size, engine, nframes, seconds, peak_rss_mb))
+        finally:
+            shutil.rmtree(root)
+    return results
+
+
+def compare(results, baseline):
+    """Print the speed ratio of each result against a matching baseline result."""
+    key = lambda r: (r["stage"], r["size"], r["engine"])  # noqa: E731
+    previous = {key(r): r for r in baseline["results"]}
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        print("{:>16s} {:>5d}px {:>8s} {:6.2f}x time {:6.2f}x memory".format(
+            result["stage"], result["size"], result["engine"],
+            result["seconds"] / old["seconds"], result["peak_rss_mb"] / old["peak_rss_mb"]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks for imageredux')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1024, 2048, 4096],
+                        help='Frame sizes (pixels per side) to benchmark. Default is 1024 2048 4096.')
+    parser.add_argument('--darks', type=int, default=10, help='Number of dark frames. Default is 10.')
+    parser.add_argument('--flats', type=int, default=10, help='Number of flat frames. Default is 10.')
+    parser.add_argument('--lights', type=int, default=20, help='Number of light frames. Default is 20.')
+    parser.add_argument('--engines', nargs='+', default=['numpy'], choices=redux._ENGINES,
+                        help='Calibration engines to benchmark. Default is numpy.')
+    parser.add_argument('--workdir', default=None,
+                        help='Directory for the synthetic data. Default is the system temp dir.')
+    parser.add_argument('-o', '--output', default='bench_results.json',
+                        help='JSON file to write the results to. Default is bench_results.json.')
+    parser.add_argument('--compare', default=None, metavar='JSON',
+                        help='Previous results file to compare against.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.darks, args.flats, args.lights, args.engines, args.workdir)
+    report = {
+        "imageredux_version": redux.__version__,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "date": datetime.datetime.now().isoformat(),
+        "results": results,
+        }
+    with open(args.output, "w") as fobj:
+        json.dump(report, fobj, indent=1)
+    print("Results written to {}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as fobj:
+            compare(results, json.load(fobj))
@@ -12,256 +12,3870 @@ All rights reserved.
 
 __version__ = "1.0a1"
 
-from astropy import units as u
-import numpy as np
-import ccdproc
+import asyncio
+import cProfile
+import csv
+import fnmatch
 import glob
+import hashlib
+import importlib
+import json
 import os
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from collections import deque, namedtuple
+from functools import partial
 from pathlib import Path
-from astropy.table import Table, Column
 import logging
 
+try:
+    import fcntl
+except ImportError:
+    # Not on POSIX: the MasterCache index is then updated without a lock
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    # Not on POSIX: the run report has no peak RSS
+    resource = None
+
+
+class _LazyModule(object):
+    """
+    Stand-in for a heavy module, imported on first attribute access.
+
+    The import replaces the stand-in in this module's globals, so later lookups go straight
+    to the module. Planning a run (headers, catalog, manifests) never touches these, so
+    --help and --dry-run do not pay for importing astropy, ccdproc and numpy.
+    """
+
+    def __init__(self, alias, name):
+        self._alias = alias
+        self._name = name
+
+    def load(self):
+        """Import the module, put it in place of the stand-in and return it."""
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+u = _LazyModule("u", "astropy.units")
+fits = _LazyModule("fits", "astropy.io.fits")
+np = _LazyModule("np", "numpy")
+ccdproc = _LazyModule("ccdproc", "ccdproc")
+
+
+def _import_lazy_modules():
+    """
+    Import astropy, ccdproc and numpy now, before the first stage of a run that reads pixels, so
+    their import is not timed as part of that stage in the RunReport.
+    """
+    for alias in ("u", "fits", "np", "ccdproc"):
+        module = globals()[alias]
+        if isinstance(module, _LazyModule):
+            module.load()
+
 
 # create logger
 logger = logging.getLogger(__name__)
 
-_IN_DIR = None
-"The path to the images directory."
-_OUT_DIR = None
-"The path to the directory where new files will be saved."
+_IN_DIR = None
+"The path to the images directory."
+_OUT_DIR = None
+"The path to the directory where new files will be saved."
+
+
+_REPORT = None
+"The RunReport collecting the statistics of the current run, or None when not instrumented."
+
+
+def _peak_rss_mb(children=False):
+    """
+    Return the peak resident set size in MB of this process (or of its finished children), or
+    None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss * scale / 2.0 ** 20
+
+
+class RunReport(object):
+    """
+    Per-stage timing, throughput, I/O and memory statistics of a reduction run.
+
+    Each stage records its wall time, frames processed, bytes read and written, frames per
+    second and the peak RSS of the process (and of finished worker processes) when it ended.
+    With a profile_dir, each leaf stage is also run under cProfile and its stats dumped there.
+    """
+
+    def __init__(self, profile_dir=None):
+        self.stages = []
+        self.profile_dir = profile_dir
+        self.started = time.time()
+        if profile_dir is not None and not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+
+    @contextmanager
+    def stage(self, name, profile=True, **labels):
+        """
+        Context manager timing a stage; yields a dict the stage updates with frames and bytes.
+        """
+        record = {"stage": name, "frames": 0, "bytes_read": 0, "bytes_written": 0}
+        record.update(labels)
+        profiler = None
+        if profile and self.profile_dir is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                label = "-".join(str(v) for k, v in sorted(labels.items()) if k in ("night", "object"))
+                prof_name = "{}-{}{}-{}.prof".format(
+                    len(self.stages), name, "-" + label if label else "", os.getpid())
+                profiler.dump_stats(os.path.join(self.profile_dir, prof_name.replace(os.sep, "_")))
+            seconds = record["seconds"]
+            record["frames_per_sec"] = record["frames"] / seconds if seconds > 0 else None
+            record["peak_rss_mb"] = _peak_rss_mb()
+            record["peak_children_rss_mb"] = _peak_rss_mb(children=True)
+            self.stages.append(record)
+
+    def totals(self):
+        """Return the frames, bytes and seconds summed over the leaf stages, by stage name."""
+        totals = {}
+        for record in self.stages:
+            if record["stage"] in ("main", "night"):
+                continue
+            total = totals.setdefault(record["stage"], {"frames": 0, "bytes_read": 0, "bytes_written": 0,
+                                                        "seconds": 0.0})
+            for key in total:
+                total[key] += record[key]
+        return totals
+
+    def write(self, filename):
+        """Write the report as JSON."""
+        report = {
+            "version": __version__,
+            "started": self.started,
+            "wall_seconds": time.time() - self.started,
+            "peak_rss_mb": _peak_rss_mb(),
+            "peak_children_rss_mb": _peak_rss_mb(children=True),
+            "totals": self.totals(),
+            "stages": self.stages,
+            }
+        with open(filename, "w") as fobj:
+            json.dump(report, fobj, indent=1)
+
+
+@contextmanager
+def _untimed_stage():
+    """Yield a scratch dict of stage counters for a stage run without a RunReport."""
+    yield {"frames": 0, "bytes_read": 0, "bytes_written": 0}
+
+
+def _stage(name, profile=True, **labels):
+    """
+    Time a stage in the current RunReport; a no-op yielding a scratch dict when not instrumented.
+    """
+    if _REPORT is None:
+        return _untimed_stage()
+    return _REPORT.stage(name, profile, **labels)
+
+
+def _bytes_of(frame_list):
+    """Return the number of bytes of the files (or CCDData pixels) in frame_list."""
+    return sum(os.path.getsize(f) if isinstance(f, (str, os.PathLike)) else f.data.nbytes
+               for f in frame_list)
+
+
+_DEFAULT_MEM_LIMIT = 1e9
+"Default memory ceiling (in bytes) for combining master frames."
+
+_COMBINE_MEMORY_FACTOR = 5.0
+"Bytes of working memory used per input byte by a tiled median combine."
+
+
+def _parse_size(text):
+    """
+    Parse a size such as '512M', '2G' or '1e9' into a number of bytes.
+    """
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+    text = str(text).strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def _is_path_list(frame_list):
+    """Return True if frame_list is a non-empty list of file paths."""
+    return bool(frame_list) and all(isinstance(f, (str, os.PathLike)) for f in frame_list)
+
+
+def _write_fits_skeleton(filename, headers):
+    """
+    Write a FITS file with the given HDU headers and zero-filled data without allocating the data.
+    """
+    with open(filename, "wb") as fobj:
+        for header in headers:
+            fobj.write(header.tostring().encode("ascii"))
+            nbytes = abs(header["BITPIX"]) // 8 * header["NAXIS1"] * header["NAXIS2"]
+            # Data blocks are padded to a multiple of 2880 bytes
+            fobj.seek(-(-nbytes // 2880) * 2880, os.SEEK_CUR)
+        fobj.truncate()
+
+
+_READOUT_KEYWORDS = ("BIASSEC", "TRIMSEC")
+"Header keywords giving the overscan and the light-sensitive region of a raw frame."
+
+
+def _fits_section(text):
+    """
+    Return the (rows, cols) slices of a FITS section such as '[1:2048,1:4096]'.
+
+    Sections are 1-based, inclusive and list the columns first, as parsed by
+    ccdproc.utils.slices.slice_from_string(fits_convention=True); '*' is a whole axis.
+    Parsing them here keeps header scans free of the ccdproc import.
+    """
+    axes = []
+    for axis in text.strip().strip("[]").split(","):
+        if axis.strip() == "*":
+            axes.append(slice(None))
+            continue
+        start, stop = sorted(int(value) for value in axis.split(":"))
+        axes.append(slice(start - 1, stop))
+    return tuple(reversed(axes))
+
+
+def _readout_sections(header, shape):
+    """
+    Return the overscan column slice (or None) and the (rows, cols) trim slices of a raw frame.
+
+    The sections come from the BIASSEC and TRIMSEC headers, in FITS convention; a frame
+    without TRIMSEC is not trimmed.
+    """
+    overscan = None
+    if "BIASSEC" in header:
+        overscan = _fits_section(header["BIASSEC"])[1]
+    trim = (slice(None), slice(None))
+    if "TRIMSEC" in header:
+        trim = _fits_section(header["TRIMSEC"])
+    return overscan, tuple(slice(*section.indices(n)[:2]) for section, n in zip(trim, shape))
+
+
+def _trimmed_shape(header, shape):
+    """Return the shape of a raw frame after trimming to its TRIMSEC."""
+    __, trim = _readout_sections(header, shape)
+    return tuple(section.stop - section.start for section in trim)
+
+
+def _overscan_trim(block, overscan, trim_cols):
+    """
+    Subtract the serial overscan from a block of rows of a raw frame and trim its columns.
+
+    The median of the overscan columns of each row is subtracted from the row, like
+    ccdproc.subtract_overscan(overscan_axis=1, median=True).
+
+    Returns:
+        the corrected block as a new float64 array
+    """
+    block = np.asarray(block, dtype=np.float64)
+    if overscan is not None:
+        block = block - np.median(block[:, overscan], axis=1, keepdims=True)
+    return block[:, trim_cols]
+
+
+def _ccd_overscan_trim(ccd):
+    """Subtract the overscan of a raw CCDData and trim it, as given by its BIASSEC and TRIMSEC headers."""
+    if "BIASSEC" in ccd.header:
+        ccd = ccdproc.subtract_overscan(ccd, fits_section=ccd.header["BIASSEC"], overscan_axis=1, median=True)
+    if "TRIMSEC" in ccd.header:
+        ccd = ccdproc.trim_image(ccd, fits_section=ccd.header["TRIMSEC"])
+    for key in _READOUT_KEYWORDS:
+        ccd.meta.pop(key, None)
+    return ccd
+
+
+CombineOptions = namedtuple("CombineOptions", "method sigma nlow nhigh")
+CombineOptions.__new__.__defaults__ = ("median", 3.0, 1, 1)
+"""
+How frames are combined into a master.
+
+method is one of _COMBINE_METHODS; sigma is the clipping threshold of "sigma_clip" and
+nlow, nhigh the number of lowest and highest values rejected per pixel by "minmax".
+"""
+
+_COMBINE_METHODS = ("median", "average", "sigma_clip", "minmax", "weighted")
+"""
+Combine methods: per-pixel median; average; average after rejecting values more than sigma
+standard deviations from the median; average after rejecting the nlow lowest and nhigh highest
+values; and, for flats, average of the frames scaled to a common level and weighted by their
+level (inverse variance for photon-limited frames).
+"""
+
+_STREAMING_METHODS = ("average", "weighted")
+"Combine methods computed with running sums, one frame at a time."
+
+_LEVEL_STEP = 4
+"Subsampling step in rows and columns when measuring the level of a frame."
+
+
+def _combine_params(combine):
+    """Return the master key parameters of CombineOptions; just the method for median, as before."""
+    params = {"method": combine.method}
+    if combine.method == "sigma_clip":
+        params["sigma"] = combine.sigma
+    elif combine.method == "minmax":
+        params.update(nlow=combine.nlow, nhigh=combine.nhigh)
+    return params
+
+
+def _frame_level(data):
+    """Return the median of a subsample of a frame."""
+    return float(np.median(data[::_LEVEL_STEP, ::_LEVEL_STEP]))
+
+
+def _combine_in_memory(frame_list, combine):
+    """
+    Combine CCDData objects with ccdproc.combine according to CombineOptions.
+
+    Returns:
+        a CCDData object containing the combined frame
+    """
+    if combine.method not in _COMBINE_METHODS:
+        raise ValueError("Unknown combine method '{}'".format(combine.method))
+    kwargs = {"method": "median" if combine.method == "median" else "average"}
+    if combine.method == "sigma_clip":
+        kwargs.update(sigma_clip=True, sigma_clip_low_thresh=combine.sigma, sigma_clip_high_thresh=combine.sigma,
+                      sigma_clip_func=np.ma.median)
+    elif combine.method == "minmax":
+        kwargs.update(clip_extrema=True, nlow=combine.nlow, nhigh=combine.nhigh)
+    elif combine.method == "weighted":
+        levels = np.array([_frame_level(ccd.data) for ccd in frame_list])
+        kwargs.update(scale=levels.mean() / levels, weights=levels)
+    return ccdproc.combine(frame_list, unit="adu", **kwargs)
+
+
+def _combine_tiles(tiles, combine):
+    """Combine one block of rows of every frame with ccdproc.Combiner according to CombineOptions."""
+    combiner = ccdproc.Combiner(tiles, dtype=np.float64)
+    if combine.method == "median":
+        return combiner.median_combine()
+    if combine.method == "sigma_clip":
+        combiner.sigma_clipping(low_thresh=combine.sigma, high_thresh=combine.sigma, func=np.ma.median)
+    elif combine.method == "minmax":
+        combiner.clip_extrema(nlow=combine.nlow, nhigh=combine.nhigh)
+    return combiner.average_combine()
+
+
+def _tiled_combine(frame_list, out_filename, mem_limit=_DEFAULT_MEM_LIMIT, process_tile=None, meta=None,
+                   overscan=False, combine=None):
+    """
+    Combine FITS files one block of rows at a time and write the result incrementally.
+
+    Each input is opened memory-mapped and only the rows of the current block are read,
+    so the working set stays under mem_limit regardless of the number of frames. Median
+    and clipped blocks are combined with ccdproc.Combiner, so the result is bit-identical to
+    ccdproc.combine on the whole frames. Averages are accumulated one frame at a time with
+    running sums (and a running variance for the uncertainty), so their memory does not
+    grow with the number of frames and the blocks are correspondingly larger.
+
+    Args:
+        frame_list: a list of file paths of the frames to combine
+        out_filename: a string identifying the output path for writing to disk
+        mem_limit: the memory ceiling in bytes
+        process_tile: optional function (CCDData tile, row slice) -> CCDData applied to each
+            combined block before it is written
+        meta: optional extra header keywords for the output
+        overscan: if True, each frame is overscan-subtracted and trimmed as given by its
+            BIASSEC and TRIMSEC headers before it is combined
+        combine: the CombineOptions; default is a median
+
+    Returns:
+        a CCDData object containing the combined frame, read back from out_filename
+    """
+    combine = combine or CombineOptions()
+    if combine.method not in _COMBINE_METHODS:
+        raise ValueError("Unknown combine method '{}'".format(combine.method))
+    tmp_filename = out_filename + ".part"
+    with ExitStack() as stack:
+        # astropy memory-maps by default; passing memmap=True explicitly would make
+        # it refuse to scale 16-bit frames with BZERO
+        hduls = [stack.enter_context(fits.open(f)) for f in frame_list]
+        shape = hduls[0][0].shape
+        for f, hdul in zip(frame_list, hduls):
+            if hdul[0].shape != shape:
+                raise ValueError("Frame {} is not same shape as {}".format(f, frame_list[0]))
+        nrows, ncols = shape
+
+        # Rows and columns of the raw frames that make up the output
+        sections = [_readout_sections(hdul[0].header, shape) if overscan else (None, (slice(0, nrows),
+                                                                                     slice(0, ncols)))
+                    for hdul in hduls]
+        trim_rows, trim_cols = sections[0][1]
+        for f, (__, trim) in zip(frame_list, sections):
+            if trim != sections[0][1]:
+                raise ValueError("Frame {} is not trimmed as {}".format(f, frame_list[0]))
+
+        header = hduls[0][0].header.copy()
+        for key in ("SIMPLE", "BITPIX", "NAXIS", "NAXIS1", "NAXIS2", "EXTEND", "BZERO", "BSCALE"):
+            header.remove(key, ignore_missing=True)
+        if overscan:
+            for key in _READOUT_KEYWORDS:
+                header.remove(key, ignore_missing=True)
+        header["NCOMBINE"] = len(frame_list)
+        header.update(meta or {})
+        out_nrows = trim_rows.stop - trim_rows.start
+
+        def read_tile(k, rows):
+            # Rows of the output are offset by the trimmed rows in the raw frames
+            raw_rows = slice(trim_rows.start + rows.start, trim_rows.start + rows.stop, rows.step)
+            if overscan:
+                return _overscan_trim(hduls[k][0].section[raw_rows], sections[k][0], trim_cols)
+            return np.asarray(hduls[k][0].section[raw_rows], dtype=np.float64)
+
+        streaming = combine.method in _STREAMING_METHODS
+        scales = weights = np.ones(len(hduls))
+        if combine.method == "weighted":
+            # The same subsample as _frame_level, reading only every _LEVEL_STEP-th row
+            levels = np.array([np.median(read_tile(k, slice(0, out_nrows, _LEVEL_STEP))[:, ::_LEVEL_STEP])
+                               for k in range(len(hduls))])
+            scales, weights = levels.mean() / levels, levels
+
+        if streaming:
+            # A tile and four accumulators, whatever the number of frames
+            row_bytes = 5 * ncols * np.dtype(np.float64).itemsize
+        else:
+            row_bytes = _COMBINE_MEMORY_FACTOR * len(frame_list) * ncols * np.dtype(np.float64).itemsize
+        block = int(min(out_nrows, max(1, mem_limit // row_bytes)))
+        logger.debug("Combining {} frames ({}) in blocks of {} rows".format(len(frame_list), combine.method, block))
+
+        out_hdul = None
+        try:
+            for row in range(0, out_nrows, block):
+                rows = slice(row, min(out_nrows, row + block))
+                if streaming:
+                    combined = _running_average(
+                        (read_tile(k, rows) * scales[k] for k in range(len(hduls))), weights, header)
+                else:
+                    tiles = [ccdproc.CCDData(read_tile(k, rows), unit="adu", meta=header)
+                             for k in range(len(hduls))]
+                    combined = _combine_tiles(tiles, combine)
+                    del tiles
+                combined.meta = header
+                if process_tile is not None:
+                    combined = process_tile(combined, rows)
+                tile_hdus = combined.to_hdu()
+
+                if out_hdul is None:
+                    headers = [hdu.header.copy() for hdu in tile_hdus]
+                    for hdr in headers:
+                        hdr["NAXIS2"] = out_nrows
+                    _write_fits_skeleton(tmp_filename, headers)
+                    out_hdul = fits.open(tmp_filename, mode="update", memmap=True)
+
+                for out_hdu, tile_hdu in zip(out_hdul, tile_hdus):
+                    out_hdu.data[rows] = tile_hdu.data
+                del combined, tile_hdus
+        finally:
+            if out_hdul is not None:
+                out_hdul.close()
+
+    os.replace(tmp_filename, out_filename)
+    return ccdproc.fits_ccddata_reader(out_filename)
+
+
+def _running_average(tiles, weights, header):
+    """
+    Average tiles one at a time with running sums.
+
+    The data is the weighted mean; the uncertainty is the standard deviation of the tiles
+    divided by sqrt(n), accumulated with Welford's method, as in Combiner.average_combine.
+
+    Args:
+        tiles: an iterable of float arrays of the same shape
+        weights: the weight of each tile
+        header: the header of the result
+
+    Returns:
+        a CCDData object containing the average
+    """
+    from astropy.nddata import StdDevUncertainty
+
+    total = mean = m2 = None
+    for count, (tile, weight) in enumerate(zip(tiles, weights), 1):
+        if total is None:
+            total, mean, m2 = np.zeros_like(tile), np.zeros_like(tile), np.zeros_like(tile)
+        total += weight * tile
+        delta = tile - mean
+        mean += delta / count
+        m2 += delta * (tile - mean)
+    uncertainty = np.sqrt(m2 / count) / np.sqrt(count)
+    return ccdproc.CCDData(total / np.sum(weights), unit="adu", meta=header, mask=np.zeros(total.shape, dtype=bool),
+                           uncertainty=StdDevUncertainty(uncertainty))
+
+
+def _file_identity(path):
+    """Return the [size, mtime] identity of a file."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _file_checksum(path, chunk_size=2 ** 22):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fobj:
+        for chunk in iter(lambda: fobj.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _master_key(frame_list, **params):
+    """
+    Compute the content key of a master frame.
+
+    The key is a SHA-256 over the identity (path, size, mtime) of each input file, or over the
+    pixel data of in-memory CCDData inputs, and over the combine parameters.
+
+    Returns:
+        a hexadecimal digest string
+    """
+    digest = hashlib.sha256()
+    for item in frame_list:
+        if isinstance(item, (str, os.PathLike)):
+            digest.update(json.dumps([os.path.abspath(item)] + _file_identity(item)).encode())
+        else:
+            digest.update(np.ascontiguousarray(item.data).tobytes())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class MasterCache(object):
+    """
+    Content-addressed store of master frames shared across nights and runs.
+
+    Masters are stored as <key>.fit in cache_dir; an index file records the size and last
+    use of each entry, and the least recently used entries are evicted once the cache
+    grows beyond max_size bytes. Every read-modify-write of the index holds an exclusive
+    lock on a lock file, so processes and nodes can share the cache (on NFS, flock needs
+    NFSv4 or Linux's emulation with POSIX locks).
+    """
+
+    INDEX_NAME = "index.json"
+    LOCK_NAME = "index.lock"
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, self.INDEX_NAME)
+        self.lock_path = os.path.join(cache_dir, self.LOCK_NAME)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "{}.fit".format(key))
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as fobj:
+                return json.load(fobj)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        tmp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        with open(tmp_path, "w") as fobj:
+            json.dump(index, fobj, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    @contextmanager
+    def _locked_index(self):
+        """Yield the index while holding the cache lock, and save it when the block ends without error."""
+        with open(self.lock_path, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._load_index()
+                yield index
+                self._save_index(index)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, key, out_filename):
+        """
+        Copy the cached master for key to out_filename.
+
+        Returns:
+            True if the master was found in the cache, False otherwise.
+        """
+        # The copy holds the lock too, so the entry cannot be evicted under it
+        with self._locked_index() as index:
+            if key not in index or not os.path.isfile(self.path(key)):
+                return False
+            tmp_filename = out_filename + ".part"
+            shutil.copyfile(self.path(key), tmp_filename)
+            os.replace(tmp_filename, out_filename)
+            index[key]["last_used"] = time.time()
+        return True
+
+    def put(self, key, filename):
+        """Store the master in filename under key and evict old entries."""
+        tmp_path = "{}.{}.part".format(self.path(key), os.getpid())
+        shutil.copyfile(filename, tmp_path)
+        with self._locked_index() as index:
+            os.replace(tmp_path, self.path(key))
+            index[key] = {
+                "size": os.path.getsize(self.path(key)),
+                "last_used": time.time(),
+                "source": os.path.abspath(filename),
+                }
+            self._evict(index, keep=key)
+
+    def _evict(self, index, keep=None):
+        if self.max_size is None:
+            return
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_used"]):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            logger.info("Evicting cached master {}".format(key))
+            total -= index.pop(key)["size"]
+            if os.path.isfile(self.path(key)):
+                os.remove(self.path(key))
+
+
+def _reuse_master(out_filename, key, cache):
+    """
+    Find an up-to-date master for key, either in out_filename or in the cache.
+
+    Returns:
+        True if out_filename now holds the master for key.
+    """
+    if os.path.isfile(out_filename):
+        if fits.getheader(out_filename).get("REDUXKEY") == key:
+            return True
+        logger.info("Existing '{}' is stale".format(os.path.basename(out_filename)))
+    if cache is not None and cache.get(key, out_filename):
+        logger.info("Assigning cached master {}".format(key))
+        return True
+    return False
+
+
+def _bias_params(master_bias, overscan):
+    """Return the master key parameters for the bias and overscan handling, empty for neither."""
+    params = {}
+    if master_bias is not None:
+        params["bias"] = master_bias.header.get("REDUXKEY") or _master_key([master_bias])
+    if overscan:
+        params["overscan"] = True
+    return params
+
+
+def do_bias_combine(bias_list, master_frame_dir, mem_limit=_DEFAULT_MEM_LIMIT, cache=None, overscan=False,
+                    name="master-bias.fit", combine=None):
+    """
+    Create master bias by combining a list of bias images, by default with a median.
+
+    Like do_dark_combine, file paths are combined in memory-mapped row blocks and the master
+    is only recombined when the content key of its inputs changes.
+
+    Args:
+        bias_list: a list of file paths or CCDData objects containing the individual bias frames
+        master_frame_dir: a string identifying the output path for writing to disk
+        mem_limit: the memory ceiling in bytes for combining file paths
+        cache: an optional MasterCache shared across nights
+        overscan: if True, subtract the overscan and trim each frame as given by its BIASSEC
+            and TRIMSEC headers
+        name: the file name of the master
+        combine: the CombineOptions; default is a median
+
+    Returns:
+        a CCDData object containing the master bias
+    """
+    combine = combine or CombineOptions()
+    with _stage("bias_combine", frames=len(bias_list), output=master_frame_dir) as record:
+        out_filename = os.path.join(master_frame_dir, name)
+        key = _master_key(bias_list, frame="bias", **_combine_params(combine), **_bias_params(None, overscan))
+        if not _reuse_master(out_filename, key, cache):
+
+            logger.info("Combining biases ({})".format(combine.method))
+            if _is_path_list(bias_list):
+                # Combine biases block by block, writing the master as we go
+                master_bias = _tiled_combine(bias_list, out_filename, mem_limit, meta={"REDUXKEY": key},
+                                             overscan=overscan, combine=combine)
+            else:
+                if overscan:
+                    bias_list = [_ccd_overscan_trim(ccd) for ccd in bias_list]
+                # Combine biases
+                master_bias = _combine_in_memory(bias_list, combine)
+                master_bias.meta["REDUXKEY"] = key
+
+                logger.info("Writing master bias to disk")
+                # Write master bias to disk
+                ccdproc.fits_ccddata_writer(master_bias, out_filename, overwrite=True)
+
+            if cache is not None:
+                cache.put(key, out_filename)
+
+            record["bytes_read"] += _bytes_of(bias_list)
+            record["bytes_written"] += os.path.getsize(out_filename)
+
+        else:
+
+            logger.warning("Skipping bias combine: assigning existing file '{}'".format(name))
+            # Read master bias from disk and assign to variable
+            master_bias = ccdproc.fits_ccddata_reader(out_filename)
+            record["reused"] = True
+            record["bytes_read"] += os.path.getsize(out_filename)
+
+    return master_bias, out_filename
+
+
+def do_dark_combine(dark_list, master_frame_dir, mem_limit=_DEFAULT_MEM_LIMIT, cache=None, master_bias=None,
+                    overscan=False, name="master-dark.fit", combine=None):
+    """
+    Create master dark by combining a list of dark images, by default with a median.
+
+    When dark_list holds file paths the combine is streamed through memory-mapped
+    row blocks so memory use stays under mem_limit. The master is stamped with the
+    content key of its inputs and is only recombined when that key changes.
+
+    With a master bias, the bias is subtracted from the combined dark, which then holds
+    only the dark current and scales correctly to any exposure time. Subtracting a fixed
+    frame commutes with the median, so this equals combining bias-subtracted darks.
+
+    Args:
+        dark_list: a list of file paths or CCDData objects containing the individual dark frames
+        master_frame_dir: a string identifying the output path for writing to disk
+        mem_limit: the memory ceiling in bytes for combining file paths
+        cache: an optional MasterCache shared across nights
+        master_bias: an optional CCDData object containing the master bias
+        overscan: if True, subtract the overscan and trim each frame as given by its BIASSEC
+            and TRIMSEC headers
+        name: the file name of the master
+        combine: the CombineOptions; default is a median
+
+    Returns:
+        a CCDData object containing the master dark
+    """
+    combine = combine or CombineOptions()
+    with _stage("dark_combine", frames=len(dark_list), output=master_frame_dir) as record:
+        out_filename = os.path.join(master_frame_dir, name)
+        key = _master_key(dark_list, frame="dark", **_combine_params(combine), **_bias_params(master_bias, overscan))
+        if not _reuse_master(out_filename, key, cache):
+
+            logger.info("Combining darks ({})".format(combine.method))
+            if _is_path_list(dark_list):
+                def subtract_tile_bias(combined_tile, rows):
+                    # Subtract master bias from this block of the combined dark
+                    return ccdproc.subtract_bias(combined_tile, master_bias[rows])
+
+                # Combine darks block by block, writing the master as we go
+                master_dark = _tiled_combine(dark_list, out_filename, mem_limit,
+                                             subtract_tile_bias if master_bias is not None else None,
+                                             meta={"REDUXKEY": key}, overscan=overscan, combine=combine)
+            else:
+                if overscan:
+                    dark_list = [_ccd_overscan_trim(ccd) for ccd in dark_list]
+                # Combine darks
+                master_dark = _combine_in_memory(dark_list, combine)
+                if master_bias is not None:
+                    logger.info("Subtracting bias from dark")
+                    master_dark = ccdproc.subtract_bias(master_dark, master_bias)
+                master_dark.meta["REDUXKEY"] = key
+
+                logger.info("Writing master dark to disk")
+                # Write master dark to disk
+                ccdproc.fits_ccddata_writer(master_dark, out_filename, overwrite=True)
+
+            if cache is not None:
+                cache.put(key, out_filename)
+
+            record["bytes_read"] += _bytes_of(dark_list)
+            record["bytes_written"] += os.path.getsize(out_filename)
+
+        else:
+
+            logger.warning("Skipping dark combine: assigning existing file '{}'".format(name))
+            # Read master dark from disk and assign to variable
+            master_dark = ccdproc.fits_ccddata_reader(out_filename)
+            record["reused"] = True
+            record["bytes_read"] += os.path.getsize(out_filename)
+
+    return master_dark, out_filename
+
+
+def do_flat_combine(flat_list, master_dark, master_frame_dir, mem_limit=_DEFAULT_MEM_LIMIT, cache=None,
+                    master_bias=None, overscan=False, name="master-flat.fit", combine=None):
+    """
+    Create master flat.
+
+    When flat_list holds file paths the combine and dark subtraction are streamed
+    through memory-mapped row blocks so memory use stays under mem_limit. The master
+    is keyed on its inputs and on the master dark (and bias), and only recombined when
+    any of them changes.
+
+    Args:
+        flat_list: a list of file paths or CCDData objects containing the individual flat frames
+        master_dark: a CCDData object containing the master dark
+        master_frame_dir: a string identifying the output path for writing to disk
+        mem_limit: the memory ceiling in bytes for combining file paths
+        cache: an optional MasterCache shared across nights
+        master_bias: an optional CCDData object containing the master bias, subtracted before
+            the dark; master_dark must then be bias-subtracted too
+        overscan: if True, subtract the overscan and trim each frame as given by its BIASSEC
+            and TRIMSEC headers
+        name: the file name of the master
+        combine: the CombineOptions; default is a median. "weighted" suits flats taken at
+            varying sky brightness
+
+    Returns:
+        a CCDData object containing the master flat.
+    """
+    combine = combine or CombineOptions()
+    with _stage("flat_combine", frames=len(flat_list), output=master_frame_dir) as record:
+        out_filename = os.path.join(master_frame_dir, name)
+        dark_key = master_dark.header.get("REDUXKEY") or _master_key([master_dark])
+        key = _master_key(flat_list, frame="flat", dark=dark_key, **_combine_params(combine),
+                          **_bias_params(master_bias, overscan))
+        if not _reuse_master(out_filename, key, cache):
+
+            logger.info("Combining flats ({})".format(combine.method))
+            if _is_path_list(flat_list):
+                def subtract_tile_dark(combined_tile, rows):
+                    if master_bias is not None:
+                        # Subtract master bias from this block of the combined flat
+                        combined_tile = ccdproc.subtract_bias(combined_tile, master_bias[rows])
+                    # Subtract master dark from this block of the combined flat
+                    return ccdproc.subtract_dark(
+                        combined_tile, master_dark[rows],
+                        data_exposure=combined_tile.header["exposure"] * u.second,
+                        dark_exposure=master_dark.header["exposure"] * u.second,
+                        scale=True)
+
+                master_flat = _tiled_combine(flat_list, out_filename, mem_limit, subtract_tile_dark,
+                                             meta={"REDUXKEY": key}, overscan=overscan, combine=combine)
+            else:
+                if overscan:
+                    flat_list = [_ccd_overscan_trim(ccd) for ccd in flat_list]
+                # Combine flats
+                combined_flat = _combine_in_memory(flat_list, combine)
+
+                if master_bias is not None:
+                    logger.info("Subtracting bias from flat")
+                    combined_flat = ccdproc.subtract_bias(combined_flat, master_bias)
+
+                logger.info("Subtracting dark from flat")
+                # Subtract master dark from combined flat
+                master_flat = ccdproc.subtract_dark(
+                    combined_flat, master_dark,
+                    data_exposure=combined_flat.header["exposure"] * u.second,
+                    dark_exposure=master_dark.header["exposure"] * u.second,
+                    scale=True)
+                master_flat.meta["REDUXKEY"] = key
+
+                logger.info("Writing master flat to disk")
+                # Write master flat to disk
+                ccdproc.fits_ccddata_writer(master_flat, out_filename, overwrite=True)
+
+            if cache is not None:
+                cache.put(key, out_filename)
+
+            record["bytes_read"] += _bytes_of(flat_list)
+            record["bytes_written"] += os.path.getsize(out_filename)
+
+        else:
+
+            logger.warning("Skipping flat combine: assigning existing file '{}'".format(name))
+            # Read master flat from disk and assign to variable
+            master_flat = ccdproc.fits_ccddata_reader(out_filename)
+            record["reused"] = True
+            record["bytes_read"] += os.path.getsize(out_filename)
+
+    return master_flat, out_filename
+
+
+FrameInfo = namedtuple("FrameInfo", "path exposure shape imagetyp filter binning trimmed_shape")
+"""Header summary of a frame: path, exposure (s or None), (nrows, ncols), IMAGETYP, FILTER, (ybin, xbin)
+and the (nrows, ncols) after trimming to TRIMSEC."""
+
+_SCALING_KEYWORDS = ("BZERO", "BSCALE", "BLANK")
+"Header keywords describing the on-disk integer scaling of raw data."
+
+
+_FITS_BLOCK = 2880
+"Size in bytes of a FITS header or data block."
+_FITS_CARD = 80
+"Size in bytes of a FITS header card."
+
+
+def _read_primary_header(path):
+    """
+    Return the primary header of a FITS file as a dict keyword -> value.
+
+    The fixed-format cards are parsed straight from the header blocks, which is much faster
+    than astropy and needs no import of it; only the first value of a repeated keyword is
+    kept. Files that are not plain FITS (e.g. gzipped) are read with fits.getheader.
+    """
+    header = {}
+    with open(path, "rb") as fobj:
+        block = fobj.read(_FITS_BLOCK)
+        if not block.startswith(b"SIMPLE  ="):
+            return fits.getheader(path)
+        while len(block) == _FITS_BLOCK:
+            for start in range(0, _FITS_BLOCK, _FITS_CARD):
+                card = block[start:start + _FITS_CARD].decode("ascii", "replace")
+                keyword = card[:8].strip()
+                if keyword == "END":
+                    return header
+                if card[8:10] == "= " and keyword not in header:
+                    header[keyword] = _card_value(card[10:])
+            block = fobj.read(_FITS_BLOCK)
+    raise ValueError("Truncated FITS header in {}".format(path))
+
+
+def _card_value(text):
+    """Return the value of a FITS header card from the text after its '= '."""
+    text = text.strip()
+    if text.startswith("'"):
+        # Quotes inside strings are doubled, and trailing blanks are not significant
+        end = 1
+        while True:
+            end = text.find("'", end)
+            if end < 0:
+                raise ValueError("Unterminated string in FITS card: {}".format(text))
+            if text[end + 1:end + 2] != "'":
+                break
+            end += 2
+        return text[1:end].replace("''", "'").rstrip()
+    value = text.split("/", 1)[0].strip()
+    if value in ("T", "F"):
+        return value == "T"
+    for parse in (int, lambda v: float(v.replace("D", "E"))):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value or None
+
+
+def scan_header(path):
+    """
+    Read only the primary header of a frame and summarize it.
+
+    Returns:
+        a FrameInfo
+    """
+    header = _read_primary_header(path)
+    shape = tuple(header.get("NAXIS{}".format(i), 0) for i in range(header.get("NAXIS", 0), 0, -1))
+    return FrameInfo(
+        path=path,
+        exposure=header.get("EXPOSURE"),
+        shape=shape,
+        imagetyp=header.get("IMAGETYP"),
+        filter=header.get("FILTER"),
+        binning=(header.get("YBINNING", 1), header.get("XBINNING", 1)),
+        trimmed_shape=_trimmed_shape(header, shape) if len(shape) == 2 else shape,
+        )
+
+
+def _check_frame(info, shape, overscan=False):
+    """Return why the frame of a FrameInfo cannot be calibrated with masters of shape, or None if it can."""
+    frame_shape = info.trimmed_shape if overscan else info.shape
+    if frame_shape != tuple(shape):
+        return "shape {} is not same shape as Master frames {}".format(frame_shape, tuple(shape))
+    if info.exposure is None:
+        return "no exposure keyword"
+    return None
+
+
+ScreenOptions = namedtuple("ScreenOptions", "step saturation max_saturated min_level max_level min_stars star_sigma "
+                                            "threads")
+ScreenOptions.__new__.__defaults__ = (4, 60000.0, 0.01, None, None, 5, 5.0, 4)
+"""
+Quality pre-screen of the raw light frames in do_calibrate (see frame_quality). A frame is
+rejected if more than max_saturated of its pixels are at or above saturation, if its median
+level is below min_level or above max_level (None is no limit), or if it has fewer than
+min_stars stars. Frames are measured on every step-th pixel of every step-th row, threads at
+a time.
+"""
+
+FrameQuality = namedtuple("FrameQuality", "level noise saturated stars")
+"The median level, robust noise, saturated fraction and star count of a raw frame (see frame_quality)."
+
+
+def frame_quality(path, step=4, saturation=60000.0, star_sigma=5.0):
+    """
+    Measure a raw frame from a subsample of every step-th pixel of every step-th row of its TRIMSEC.
+
+    The level is the median of the subsample, and the noise the robust standard deviation
+    around it. Stars are the local maxima of the subsample more than star_sigma times the
+    noise above the level: a rough count, enough to tell a clear frame from a cloudy or
+    trailed one of the same field.
+
+    Args:
+        path: the path of the raw frame
+        step: the subsampling step in rows and columns
+        saturation: the level in ADU of saturated pixels
+        star_sigma: the detection threshold of stars in standard deviations of the noise
+
+    Returns:
+        a FrameQuality
+    """
+    # Unscaled, the pixels stay memory-mapped and only the pages of the subsample are read
+    with fits.open(path, do_not_scale_image_data=True) as hdul:
+        hdu = hdul[0]
+        __, (rows, cols) = _readout_sections(hdu.header, hdu.shape)
+        data = hdu.data[rows.start:rows.stop:step, cols.start:cols.stop:step]
+        data = data * np.float32(hdu.header.get("BSCALE", 1.0)) + np.float32(hdu.header.get("BZERO", 0.0))
+    level = float(np.median(data))
+    noise = _MAD_SIGMA * float(np.median(np.abs(data - level)))
+    saturated = np.count_nonzero(data >= saturation) / float(data.size)
+
+    nrows, ncols = data.shape[0] - 2, data.shape[1] - 2
+    peaks = data[1:-1, 1:-1]
+    local_max = np.maximum.reduce([data[i:i + nrows, j:j + ncols] for i in range(3) for j in range(3)])
+    stars = np.count_nonzero((peaks > level + star_sigma * noise) & (peaks == local_max))
+    return FrameQuality(level, noise, saturated, int(stars))
+
+
+def _screen_reason(quality, screen):
+    """Return why a frame of FrameQuality fails the ScreenOptions, or None if it passes."""
+    if quality.saturated > screen.max_saturated:
+        return "{:.1%} of pixels saturated".format(quality.saturated)
+    if screen.min_level is not None and quality.level < screen.min_level:
+        return "median level {:.0f} below {:.0f}".format(quality.level, screen.min_level)
+    if screen.max_level is not None and quality.level > screen.max_level:
+        return "median level {:.0f} above {:.0f}".format(quality.level, screen.max_level)
+    if quality.stars < screen.min_stars:
+        return "{} stars".format(quality.stars)
+    return None
+
+
+def _screen_frame(item, screen):
+    """Return the (FrameQuality or None, reason or None) of a frame screened with ScreenOptions."""
+    try:
+        quality = frame_quality(item, screen.step, screen.saturation, screen.star_sigma)
+    except Exception as err:
+        return None, "unreadable: {}".format(err)
+    return quality, _screen_reason(quality, screen)
+
+
+_REJECTED_NAME = "rejected.csv"
+"Name of the per-object file listing the frames rejected by the quality pre-screen."
+
+_REJECTED_FIELDS = ("frame", "reason") + FrameQuality._fields
+"Columns of the rejected frames file."
+
+
+def _load_rejected(check_path):
+    """Load the rows of the rejected frames file of a cal_<object> directory, by frame name."""
+    try:
+        with open(os.path.join(check_path, _REJECTED_NAME), newline="") as fobj:
+            return {row["frame"]: row for row in csv.DictReader(fobj)}
+    except OSError:
+        return {}
+
+
+def _save_rejected(check_path, rejected):
+    """Atomically write the rejected frames file of a cal_<object> directory."""
+    rejected_path = os.path.join(check_path, _REJECTED_NAME)
+    with open(rejected_path + ".part", "w", newline="") as fobj:
+        writer = csv.DictWriter(fobj, _REJECTED_FIELDS)
+        writer.writeheader()
+        for frame in sorted(rejected):
+            writer.writerow(rejected[frame])
+    os.replace(rejected_path + ".part", rejected_path)
+
+
+def _screen_frames(object_list, object_name, check_path, screen):
+    """
+    Screen the raw frames of an object with ScreenOptions before they are calibrated.
+
+    Rejected frames are logged and listed with their reason and FrameQuality in rejected.csv
+    in check_path; frames that pass are removed from it.
+
+    Returns:
+        a list of booleans, True for the frames that passed
+    """
+    with _stage("screen", object=object_name) as record:
+        with ThreadPoolExecutor(screen.threads) as executor:
+            results = list(executor.map(partial(_screen_frame, screen=screen), object_list))
+        record["frames"] = len(object_list)
+        record["rejected"] = sum(1 for __, reason in results if reason is not None)
+
+    rejected = _load_rejected(check_path)
+    for item, (quality, reason) in zip(object_list, results):
+        frame = os.path.basename(item)
+        if reason is None:
+            rejected.pop(frame, None)
+            continue
+        logger.warning("Rejecting {}: {}".format(frame, reason))
+        row = {"frame": frame, "reason": reason}
+        if quality is not None:
+            row.update(quality._asdict())
+        rejected[frame] = row
+    if rejected or os.path.exists(os.path.join(check_path, _REJECTED_NAME)):
+        _save_rejected(check_path, rejected)
+    logger.info("Screened {} frames of {}, rejected {}".format(len(object_list), object_name, record["rejected"]))
+    return [reason is None for __, reason in results]
+
+
+OutputFormat = namedtuple("OutputFormat", "dtype compression quantize_level extensions")
+OutputFormat.__new__.__defaults__ = (None, None, 16.0, True)
+"""
+How calibrated frames are written.
+
+dtype is "float32" or "float64", or None to keep the engine's (float32 for numpy, float64
+for ccdproc). compression is None or one of _COMPRESSIONS; compressed frames are written as
+tile-compressed image extensions after an empty primary HDU. Before Rice or HCOMPRESS
+compression floats are quantized to 1/quantize_level of the noise of each tile (higher keeps
+more precision); GZIP with quantize_level 0 is lossless. extensions=False skips the MASK and
+UNCERT extensions.
+"""
+
+_COMPRESSIONS = {"rice": "RICE_1", "gzip": "GZIP_2", "hcompress": "HCOMPRESS_1"}
+"Tile compressions of calibrated frames, by name."
+
+
+def _write_frame(filename, data, header, mask=None, uncertainty=None, output=None):
+    """
+    Write calibrated data with optional MASK and UNCERT extensions in an OutputFormat.
+
+    The raw-data scaling keywords are dropped from header, so the pixels are written unscaled.
+    By default the data is written as-is (no dtype conversion) and uncompressed.
+    """
+    output = output or OutputFormat()
+    header = header.copy()
+    for key in _SCALING_KEYWORDS:
+        header.remove(key, ignore_missing=True)
+    header["BUNIT"] = "adu"
+    if output.dtype is not None:
+        data = np.asarray(data, dtype=output.dtype)
+
+    hdus = [(None, data, header)]
+    if output.extensions:
+        if mask is not None:
+            hdus.append(("MASK", mask.astype(np.uint8), None))
+        if uncertainty is not None:
+            # The extension fits_ccddata_reader reads back as a StdDevUncertainty
+            uncertainty_header = fits.Header([("UTYPE", "astropy.nddata.nduncertainty.StdDevUncertainty")])
+            hdus.append(("UNCERT", np.asarray(uncertainty, dtype=data.dtype), uncertainty_header))
+
+    if output.compression is None:
+        hdul = fits.HDUList([fits.PrimaryHDU(data, header=header)] +
+                            [fits.ImageHDU(ext_data, header=ext_header, name=name)
+                             for name, ext_data, ext_header in hdus[1:]])
+    else:
+        compression = _COMPRESSIONS.get(output.compression, output.compression)
+        if output.quantize_level == 0 and not compression.startswith("GZIP"):
+            raise ValueError("Lossless compression of floats needs gzip, not {}".format(output.compression))
+        # Seeding the dither from the data keeps the output reproducible
+        hdul = fits.HDUList([fits.PrimaryHDU()] +
+                            [fits.CompImageHDU(ext_data, header=ext_header, name=name, compression_type=compression,
+                                               quantize_level=output.quantize_level, dither_seed=-1)
+                             for name, ext_data, ext_header in hdus])
+    hdul.writeto(filename, overwrite=True)
+
+
+def _output_key(output):
+    """Return the manifest record of an OutputFormat; None for the default format."""
+    return list(output) if output is not None and output != OutputFormat() else None
+
+
+class CalibrationKernel(object):
+    """
+    Dark-subtract and flat-correct frames with NumPy in float32.
+
+    The normalized flat reciprocal and the exposure-scaled darks are computed once and reused
+    for every frame, and frames are calibrated in place in a preallocated buffer. Results
+    match ccdproc.subtract_dark(scale=True) followed by ccdproc.flat_correct to float32
+    precision; uncertainties are not propagated. On 2048x2048 frames the arithmetic is about
+    7x faster per frame than the ccdproc calls.
+
+    With a master bias (and a bias-subtracted master dark) only the dark current is scaled;
+    the bias is folded into the cached scaled darks, so it costs nothing per frame.
+
+    Args:
+        master_flat: a CCDData object containing the master flat
+        master_dark: a CCDData object containing the master dark
+        dtype: the floating point type of the calibrated data
+        master_bias: an optional CCDData object containing the master bias
+    """
+
+    def __init__(self, master_flat, master_dark, dtype="float32", master_bias=None):
+        self.dtype = np.dtype(dtype)
+        self.shape = master_dark.shape
+        self.dark = np.asarray(master_dark.data, dtype=self.dtype)
+        self.dark_exposure = float(master_dark.header["exposure"])
+        self.bias = np.asarray(master_bias.data, dtype=self.dtype) if master_bias is not None else None
+
+        # ccdproc.flat_correct divides by the flat normalized to its mean,
+        # with masked flat pixels set to unity
+        flat = np.asarray(master_flat.data, dtype=np.float64)
+        flat_reciprocal = flat.mean() / flat
+        if master_flat.mask is not None:
+            flat_reciprocal[master_flat.mask] = 1.0
+        self.flat_reciprocal = flat_reciprocal.astype(self.dtype)
+
+        masks = [m.mask for m in (master_dark, master_flat, master_bias)
+                 if m is not None and m.mask is not None and m.mask.any()]
+        self.mask = np.logical_or.reduce(masks) if masks else None
+
+        self._scaled_darks = {}
+        self.buffer = np.empty(self.shape, dtype=self.dtype)
+
+    def scaled_dark(self, exposure, bzero=0.0):
+        """
+        Return the master dark scaled to exposure plus the bias, minus bzero, computed once per
+        exposure time and bzero.
+        """
+        key = (float(exposure), float(bzero))
+        if key not in self._scaled_darks:
+            scaled_dark = self.dark * self.dtype.type(key[0] / self.dark_exposure)
+            if self.bias is not None:
+                scaled_dark += self.bias
+            if key[1]:
+                scaled_dark -= self.dtype.type(key[1])
+            self._scaled_darks[key] = scaled_dark
+        return self._scaled_darks[key]
+
+    def calibrate(self, data, exposure, out=None, bzero=0.0, bscale=1.0):
+        """
+        Calibrate one frame.
+
+        Args:
+            data: the raw frame data
+            exposure: the exposure time of the frame in seconds
+            out: optional array of the kernel's shape and dtype to write the result in,
+                e.g. self.buffer; if data is out it is calibrated in place
+            bzero, bscale: the BZERO and BSCALE of raw data read unscaled (see _read_object);
+                bzero is folded into the cached scaled dark, so unit-scaled frames cost
+                nothing extra
+
+        Returns:
+            the calibrated data
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        if bscale != 1.0:
+            np.multiply(data, self.dtype.type(bscale), out=out, casting="unsafe")
+            data = out
+        np.subtract(data, self.scaled_dark(exposure, bzero), out=out, casting="unsafe")
+        np.multiply(out, self.flat_reciprocal, out=out)
+        return out
+
+
+MaskOptions = namedtuple("MaskOptions", "bad_pixels cosmic_rays hot_sigma low_flat high_flat cr_sigma cr_contrast "
+                                        "tile_size threads")
+MaskOptions.__new__.__defaults__ = (True, True, 5.0, 0.5, 1.5, 5.0, 2.0, 512, 1)
+"""
+Masking of the calibrated frames in do_calibrate. With bad_pixels, the static bad-pixel mask of
+the masters (see bad_pixel_mask, with hot_sigma, low_flat and high_flat) is added to the mask of
+every frame. With cosmic_rays, the cosmic-ray hits of each frame are masked and replaced before it
+is written (see reject_cosmic_rays, with cr_sigma, cr_contrast, tile_size and threads).
+"""
+
+_MAD_SIGMA = 1.4826
+"Ratio of the standard deviation to the median absolute deviation of normally distributed values."
+
+
+def bad_pixel_mask(master_dark, master_flat, hot_sigma=5.0, low_flat=0.5, high_flat=1.5):
+    """
+    Return the static bad-pixel mask of a master dark and flat.
+
+    Hot pixels are more than hot_sigma robust standard deviations above the median of the dark.
+    Dead, low-response and dusty pixels have a flat, normalized to its median, outside
+    [low_flat, high_flat]. Non-finite pixels of either master are bad too.
+
+    Args:
+        master_dark: a CCDData object containing the master dark
+        master_flat: a CCDData object containing the master flat
+        hot_sigma: the threshold of hot pixels in robust standard deviations of the dark
+        low_flat, high_flat: the range of good pixels of the normalized flat
+
+    Returns:
+        a boolean array of the shape of the masters, True for bad pixels
+    """
+    dark = np.asarray(master_dark.data, dtype=np.float32)
+    median = np.nanmedian(dark)
+    sigma = _MAD_SIGMA * np.nanmedian(np.abs(dark - median))
+    mask = ~(dark <= median + hot_sigma * sigma)
+
+    flat = np.asarray(master_flat.data, dtype=np.float32)
+    flat = flat / np.nanmedian(flat)
+    mask |= ~((flat >= low_flat) & (flat <= high_flat))
+    mask |= ~np.isfinite(dark) | ~np.isfinite(flat)
+    return mask
+
+
+def _sort_pairs(values, pairs):
+    """Compare and exchange values[i], values[j] elementwise for each (i, j) of a sorting network."""
+    for i, j in pairs:
+        values[i], values[j] = np.minimum(values[i], values[j]), np.maximum(values[i], values[j])
+    return values
+
+
+_MEDIAN9_NETWORK = ((1, 2), (4, 5), (7, 8), (0, 1), (3, 4), (6, 7), (1, 2), (4, 5), (7, 8), (0, 3), (5, 8), (4, 7),
+                    (3, 6), (1, 4), (2, 5), (4, 7), (4, 2), (6, 4), (4, 2))
+"Compare-exchanges leaving the median of 9 values in the middle one (Paeth, Graphics Gems)."
+
+_MEDIAN5_NETWORK = ((0, 1), (3, 4), (0, 3), (1, 4), (1, 2), (2, 3), (1, 2))
+"Compare-exchanges leaving the median of 5 values in the middle one."
+
+
+def _median3(data):
+    """Return the 3x3 running median of data, without its 1-pixel border."""
+    nrows, ncols = data.shape[0] - 2, data.shape[1] - 2
+    values = [data[i:i + nrows, j:j + ncols] for i in range(3) for j in range(3)]
+    return _sort_pairs(values, _MEDIAN9_NETWORK)[4]
+
+
+def _median5(data):
+    """
+    Return the separable 5x5 running median of data (the 5-row median of the 5-column median),
+    without its 2-pixel border.
+    """
+    nrows, ncols = data.shape[0] - 4, data.shape[1] - 4
+    rows = _sort_pairs([data[:, j:j + ncols] for j in range(5)], _MEDIAN5_NETWORK)[2]
+    return _sort_pairs([rows[i:i + nrows] for i in range(5)], _MEDIAN5_NETWORK)[2]
+
+
+_CR_HALO = 3
+"Border in pixels read around a tile by reject_cosmic_rays: 1 for the 3x3 median and 2 for the 5x5 median of it."
+
+
+def _cosmic_ray_tile(data, rows, cols, sigma, contrast):
+    """
+    Detect the cosmic-ray hits of the tile data[rows, cols] (see reject_cosmic_rays).
+
+    Returns:
+        a (rows, cols, hits, values) tuple: the mask of the hits and non-finite pixels in the
+        tile, and the median of the neighbours of each hit (NaN for the non-finite pixels)
+    """
+    nrows, ncols = data.shape
+    row0, row1 = max(rows.start - _CR_HALO, 0), min(rows.stop + _CR_HALO, nrows)
+    col0, col1 = max(cols.start - _CR_HALO, 0), min(cols.stop + _CR_HALO, ncols)
+    # Reflect the frame at its edges
+    padding = ((_CR_HALO - (rows.start - row0), _CR_HALO - (row1 - rows.stop)),
+               (_CR_HALO - (cols.start - col0), _CR_HALO - (col1 - cols.stop)))
+    padded = np.pad(data[row0:row1, col0:col1], padding, mode="reflect")
+    bad = ~np.isfinite(padded)
+    tile_bad = bad[_CR_HALO:-_CR_HALO, _CR_HALO:-_CR_HALO]
+    if bad.all():
+        return rows, cols, tile_bad, np.full(np.count_nonzero(tile_bad), np.nan, dtype=padded.dtype)
+    if bad.any():
+        # A NaN would spread through the sorting networks and fail every comparison
+        padded[bad] = np.median(padded[~bad])
+
+    tile = padded[_CR_HALO:-_CR_HALO, _CR_HALO:-_CR_HALO]
+    median3 = _median3(padded)
+    median = median3[2:-2, 2:-2]
+    residual = tile - median
+    # Fine structure: large in the cores of stars, small around cosmic rays, which are sharper
+    fine = median - _median5(median3)
+    # The residuals of a subsample of about 16k pixels are enough for the noise
+    step = max(1, int(np.sqrt(residual.size / 16384.0)))
+    deviations = np.abs(residual[::step, ::step])
+    # The filled pixels are left out of the noise
+    deviations[tile_bad[::step, ::step]] = np.nan
+    noise = _MAD_SIGMA * np.nanmedian(deviations)
+
+    # The brightest pixel of a hit is the maximum of its 3x3 neighbours; pixels in the wings
+    # of stars are not, however far they are above their median
+    around = padded[_CR_HALO - 1:1 - _CR_HALO, _CR_HALO - 1:1 - _CR_HALO]
+    local_max = np.maximum.reduce([around[i:i + tile.shape[0], j:j + tile.shape[1]]
+                                   for i in range(3) for j in range(3)])
+
+    threshold = sigma * noise
+    hits = (residual > threshold) & (residual > contrast * np.maximum(fine, noise)) & (tile == local_max)
+    # Grow the hits into their 4-connected neighbours above half the threshold
+    grown = hits.copy()
+    grown[1:] |= hits[:-1]
+    grown[:-1] |= hits[1:]
+    grown[:, 1:] |= hits[:, :-1]
+    grown[:, :-1] |= hits[:, 1:]
+    hits = grown & (residual > 0.5 * threshold) & ~tile_bad
+    # The non-finite pixels are masked and left as they are
+    return rows, cols, hits | tile_bad, np.where(tile_bad, np.nan, median)[hits | tile_bad]
+
+
+def reject_cosmic_rays(data, sigma=5.0, contrast=2.0, tile_size=512, threads=1):
+    """
+    Mask the cosmic-ray hits of a calibrated frame and replace them by the median of their neighbours.
+
+    A pixel is a hit if it is the maximum of its 3x3 neighbourhood and above its median by more
+    than sigma times the noise and by more than contrast times the fine structure of the frame
+    there (the 3x3 median minus its 5x5 median, after L.A.Cosmic). The noise is the robust
+    standard deviation of these residuals over the tile. Stars, which are smoother than cosmic
+    rays, are left alone. Hits are grown into their neighbours above half the threshold.
+    Non-finite pixels, e.g. BLANK pixels of the raw frame, are left out of the medians and the
+    noise, and are masked too.
+
+    The medians are computed with sorting networks of elementwise minima and maxima, about 10x
+    faster than np.median. The frame is processed in independent tiles of tile_size x tile_size
+    pixels, each read with a 3-pixel border, so the temporary memory is a few dozen tiles per
+    thread and the tiles run on a pool of threads (NumPy releases the GIL in elementwise
+    operations).
+
+    Args:
+        data: the 2D float data of the frame, modified in place
+        sigma: the detection threshold in standard deviations of the noise
+        contrast: the minimum ratio of a hit's residual to the fine structure
+        tile_size: the side of the tiles in pixels
+        threads: the number of threads processing tiles
+
+    Returns:
+        a boolean array of the shape of data, True for the replaced pixels and the non-finite ones
+    """
+    nrows, ncols = data.shape
+    tiles = [(slice(row, min(row + tile_size, nrows)), slice(col, min(col + tile_size, ncols)))
+             for row in range(0, nrows, tile_size) for col in range(0, ncols, tile_size)]
+    detect = partial(_cosmic_ray_tile, data, sigma=sigma, contrast=contrast)
+    if threads > 1 and len(tiles) > 1:
+        with ThreadPoolExecutor(min(threads, len(tiles))) as executor:
+            results = list(executor.map(lambda tile: detect(*tile), tiles))
+    else:
+        results = [detect(*tile) for tile in tiles]
+
+    mask = np.zeros(data.shape, dtype=bool)
+    # Replace the hits only once every tile is done, as the tiles read the borders of their neighbours
+    for rows, cols, hits, values in results:
+        mask[rows, cols] = hits
+        data[rows, cols][hits] = values
+    return mask
+
+
+def _mask_frame(cal_object_frame, masking, bad_pixels=None):
+    """
+    Add the bad pixels and the cosmic-ray hits to the mask of a calibrated CCDData object (see MaskOptions).
+
+    Returns:
+        cal_object_frame, with its cosmic-ray hits replaced in place and a new mask
+    """
+    masks = [mask for mask in (cal_object_frame.mask, bad_pixels) if mask is not None]
+    if masking.cosmic_rays:
+        hits = reject_cosmic_rays(cal_object_frame.data, masking.cr_sigma, masking.cr_contrast, masking.tile_size,
+                                  masking.threads)
+        logger.info("Masked {} cosmic-ray and non-finite pixels".format(np.count_nonzero(hits)))
+        masks.append(hits)
+    if masks:
+        # A new array, as the mask of a kernel is shared by all its frames
+        cal_object_frame.mask = np.logical_or.reduce(masks)
+    return cal_object_frame
+
+
+def _masking_key(masking):
+    """Return the manifest record of a MaskOptions, without the threads; None without masking."""
+    if masking is None:
+        return None
+    return {name: value for name, value in masking._asdict().items() if name != "threads"}
+
+
+_ENGINES = ("numpy", "ccdproc")
+"Calibration engines accepted by do_calibrate."
+
+
+def _cal_filename(item, check_path):
+    """Return the path of the calibrated frame of item in the cal_<object> directory check_path."""
+    return os.path.join(check_path, "cal-{}".format(os.path.basename(item)))
+
+
+def _write_calibrated(cal_object_frame, out_filename, output=None):
+    """
+    Write a calibrated CCDData object atomically in an OutputFormat.
+
+    With the default format, frames calibrated by ccdproc are written by fits_ccddata_writer.
+    """
+    frame = os.path.basename(out_filename)
+    # Write calibrated object to a temporary file and rename it, so a
+    # half-written frame never appears under its final name
+    tmp_filename = os.path.join(os.path.dirname(out_filename), ".{}.part".format(frame))
+    logger.info("Writing object {} to disk".format(frame))
+    uncertainty = cal_object_frame.uncertainty
+    if output is None and uncertainty is not None:
+        ccdproc.fits_ccddata_writer(cal_object_frame, tmp_filename, overwrite=True)
+    else:
+        _write_frame(tmp_filename, cal_object_frame.data, _fits_header(cal_object_frame), cal_object_frame.mask,
+                     uncertainty.array if uncertainty is not None else None, output)
+    os.replace(tmp_filename, out_filename)
+
+
+def _fits_header(ccd):
+    """Return the header of a CCDData object as a fits.Header."""
+    if isinstance(ccd.header, fits.Header):
+        return ccd.header
+    return ccd.to_hdu(hdu_mask=None, hdu_uncertainty=None)[0].header
+
+
+def _read_calibrated(path):
+    """
+    Read a calibrated frame written by _write_calibrated, in any OutputFormat, with its mask.
+
+    Returns:
+        A CCDData object in adu.
+    """
+    with fits.open(path) as hdul:
+        # Compressed frames keep their data in the first extension
+        hdu = hdul[0] if hdul[0].data is not None else hdul[1]
+        mask = np.array(hdul["MASK"].data, dtype=bool) if "MASK" in hdul else None
+        return ccdproc.CCDData(np.array(hdu.data), unit="adu", meta=hdu.header, mask=mask)
+
+
+def _calibrate_data(item, master_flat, master_dark, kernel=None, master_bias=None, overscan=False, masking=None,
+                    bad_pixels=None):
+    """
+    Calibrate a single light frame in memory (see _calibrate_frame_safe and _calibrate_object).
+
+    Returns:
+        The calibrated CCDData object. With a kernel the data is the kernel's buffer and is
+        overwritten by the next frame.
+    """
+    # Pixels are read memory-mapped straight into the kernel's float32 buffer
+    object_frame = _read_object(item, "numpy" if kernel is not None else "ccdproc", overscan)
+    return _calibrate_object(item, object_frame, master_flat, master_dark, kernel, master_bias,
+                             out=kernel.buffer if kernel is not None else None, masking=masking,
+                             bad_pixels=bad_pixels)
+
+
+def _read_object(item, engine="numpy", overscan=False, load=False):
+    """
+    Read a light frame to be calibrated.
+
+    Args:
+        item: a string identifying the path of the light frame
+        engine: the calibration engine; with "numpy" the pixels are left memory-mapped as
+            stored, unscaled, with BZERO and BSCALE kept in the header for the CalibrationKernel
+            to apply (frames with a BLANK keyword are scaled into a float32 array, blank pixels
+            being NaN); with "ccdproc" they are read as float64
+        overscan: if True, subtract the overscan and trim the frame as given by its BIASSEC
+            and TRIMSEC headers; the pixels are then scaled and corrected into a float64 array
+        load: if True, read memory-mapped pixels into memory now, e.g. on a reader thread
+            ahead of the calibration
+
+    Returns:
+        A CCDData object in adu.
+    """
+    logger.info("Reading object {}".format(os.path.basename(item)))
+    if engine != "numpy":
+        object_frame = ccdproc.fits_ccddata_reader(item, unit="adu")
+        return _ccd_overscan_trim(object_frame) if overscan else object_frame
+
+    # Scaling 16-bit frames would copy them to memory in a wider type; the kernel scales on the fly
+    with fits.open(item, do_not_scale_image_data=not overscan) as hdul:
+        header = hdul[0].header
+        data = hdul[0].data
+        if overscan:
+            overscan_cols, (trim_rows, trim_cols) = _readout_sections(header, data.shape)
+            data = _overscan_trim(data[trim_rows], overscan_cols, trim_cols)
+            header = header.copy()
+            for key in _READOUT_KEYWORDS:
+                header.remove(key, ignore_missing=True)
+        elif "BLANK" in header and header["BITPIX"] > 0:
+            scaled = data * header.get("BSCALE", 1.0) + header.get("BZERO", 0.0)
+            data = np.where(data == header["BLANK"], np.nan, scaled).astype(np.float32)
+            header = header.copy()
+            for key in _SCALING_KEYWORDS:
+                header.remove(key, ignore_missing=True)
+        elif load:
+            data = np.array(data)
+    return ccdproc.CCDData(data, unit="adu", meta=header)
+
+
+def _calibrate_object(item, object_frame, master_flat, master_dark, kernel=None, master_bias=None, out=None,
+                      masking=None, bad_pixels=None):
+    """
+    Calibrate a light frame read by _read_object.
+
+    Args:
+        item: a string identifying the path of the light frame
+        object_frame: the CCDData object of the light frame
+        master_flat, master_dark, master_bias: CCDData objects of the masters (see do_calibrate)
+        kernel: a CalibrationKernel built from the masters; None calibrates with ccdproc
+        out: an optional array to write the result of the kernel in (see CalibrationKernel.calibrate)
+        masking: optional MaskOptions; the cosmic rays are then rejected in memory
+        bad_pixels: the bad_pixel_mask of the masters, added to the mask if masking.bad_pixels
+
+    Returns:
+        The calibrated CCDData object.
+
+    Raises:
+        ValueError: if the frame is not the same shape as the master frames.
+    """
+    frame = os.path.basename(item)
+
+    # Check if object frame is same size as master frames
+    if not object_frame.shape == master_dark.shape:
+        raise ValueError("Object frame is not same shape as Master frames")
+
+    if kernel is not None:
+        logger.info("Calibrating {}".format(frame))
+        header = object_frame.header
+        # Subtract bias and scaled dark and divide by normalized flat in place, scaling raw
+        # data read unscaled on the way
+        data = kernel.calibrate(object_frame.data, header["exposure"], out=out, bzero=header.get("BZERO", 0.0),
+                                bscale=header.get("BSCALE", 1.0))
+        if "BZERO" in header or "BSCALE" in header:
+            header = header.copy()
+            for key in _SCALING_KEYWORDS:
+                header.remove(key, ignore_missing=True)
+        cal_object_frame = ccdproc.CCDData(data, unit="adu", meta=header, mask=kernel.mask)
+        return _mask_frame(cal_object_frame, masking, bad_pixels) if masking is not None else cal_object_frame
+
+    if master_bias is not None:
+        logger.info("Subtracting bias from {}".format(frame))
+        object_frame = ccdproc.subtract_bias(object_frame, master_bias)
+
+    logger.info("Subtracting dark from {}".format(frame))
+    # Subtract dark from object
+    object_min_dark = ccdproc.subtract_dark(
+        object_frame, master_dark,
+        data_exposure=object_frame.header["exposure"] * u.second,
+        dark_exposure=master_dark.header["exposure"] * u.second,
+        scale=True,
+        )
+
+    logger.info("Dividing {} by flat".format(frame))
+    # Divide object by flat
+    cal_object_frame = ccdproc.flat_correct(object_min_dark, master_flat)
+    return _mask_frame(cal_object_frame, masking, bad_pixels) if masking is not None else cal_object_frame
+
+
+_EXPOSURE_BUCKET = 1.0
+"Width in seconds of the exposure buckets darks are grouped and matched by."
+
+
+def _master_groups(info):
+    """
+    Return the group of each kind of master a frame belongs to, from its FrameInfo.
+
+    Biases are grouped by (binning, shape), darks by (binning, shape, exposure bucket) and
+    flats by (filter, binning, shape). Shapes are of the raw frames.
+    """
+    binning, shape = tuple(info.binning), tuple(info.shape)
+    bucket = int(round(float(info.exposure) / _EXPOSURE_BUCKET)) if info.exposure is not None else None
+    return {"bias": (binning, shape), "dark": (binning, shape, bucket), "flat": (info.filter, binning, shape)}
+
+
+class MasterIndex(object):
+    """
+    In-memory index of master frames by the group of frames they apply to (see _master_groups).
+
+    masters_for() picks the master flat, dark and bias of a light frame with a few dict
+    lookups. A frame whose exposure bucket has no dark gets the longest dark of its binning
+    and shape, scaled. Masters added as file names are only read when first used, and then
+    kept. Masters added under the group None match every frame.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._longest_darks = {}
+        self._loaded = {}
+        self._headers = {}
+
+    @classmethod
+    def single(cls, master_flat, master_dark, master_bias=None):
+        """Return an index applying the same masters to every frame."""
+        index = cls()
+        for kind, master in (("flat", master_flat), ("dark", master_dark), ("bias", master_bias)):
+            if master is not None:
+                index.add(kind, None, master)
+        return index
+
+    def __getstate__(self):
+        # Worker processes load their own masters on first use
+        state = self.__dict__.copy()
+        state["_loaded"] = {}
+        return state
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, kind, group, master):
+        """
+        Add a master.
+
+        Args:
+            kind: "bias", "dark" or "flat"
+            group: the group of the master's input frames, or None to match every frame
+            master: a CCDData object or the file name of the master
+        """
+        self._entries[(kind, group)] = master
+        if kind == "dark" and group is not None and group[2] is not None:
+            binning, shape, bucket = group
+            if bucket > self._longest_darks.get((binning, shape), -1):
+                self._longest_darks[(binning, shape)] = bucket
+
+    def find(self, kind, group):
+        """Return the index key of the master of kind for a group of frames, or None if there is none."""
+        if kind == "dark" and group is not None and (kind, group) not in self._entries:
+            binning, shape, __ = group
+            group = (binning, shape, self._longest_darks.get((binning, shape)))
+        for key in ((kind, group), (kind, None)):
+            if key in self._entries:
+                return key
+        return None
+
+    def masters_for(self, info):
+        """
+        Return the index keys of the (flat, dark, bias) masters of a frame, bias being None if
+        there is no master bias for it, or None if the frame has no flat or dark.
+        """
+        groups = _master_groups(info)
+        keys = tuple(self.find(kind, groups[kind]) for kind in ("flat", "dark", "bias"))
+        return keys if keys[0] is not None and keys[1] is not None else None
+
+    def get(self, key):
+        """Return the master CCDData of an index key, reading it on first use; None for None."""
+        if key is None:
+            return None
+        master = self._entries[key]
+        if not isinstance(master, (str, os.PathLike)):
+            return master
+        if key not in self._loaded:
+            logger.info("Loading {}".format(os.path.basename(master)))
+            self._loaded[key] = ccdproc.fits_ccddata_reader(master)
+        return self._loaded[key]
+
+    def header(self, key):
+        """Return the header of a master, reading only the header of a master not loaded yet."""
+        master = self._entries[key]
+        if not isinstance(master, (str, os.PathLike)):
+            return master.header
+        if key in self._loaded:
+            return self._loaded[key].header
+        if key not in self._headers:
+            self._headers[key] = fits.getheader(master)
+        return self._headers[key]
+
+    def reduxkey(self, key):
+        """Return the content key of a master."""
+        return self.header(key).get("REDUXKEY") or _master_key([self.get(key)])
+
+    def shape(self, key):
+        """Return the (nrows, ncols) shape of a master."""
+        master = self._entries[key]
+        if not isinstance(master, (str, os.PathLike)):
+            return master.shape
+        header = self.header(key)
+        return (header["NAXIS2"], header["NAXIS1"])
+
+    def reduxkeys(self):
+        """Return the sorted content keys of all the masters."""
+        return tuple(sorted(self.reduxkey(key) for key in self._entries))
+
+    def to_json(self):
+        """Return the [kind, group, file name] entries of an index of master file names."""
+        return [[kind, group, os.fspath(master)] for (kind, group), master in self._entries.items()]
+
+    @classmethod
+    def from_json(cls, entries):
+        """Return the index of the entries given by to_json."""
+        index = cls()
+        for kind, group, master in entries:
+            index.add(kind, _tuples(group), master)
+        return index
+
+
+def _tuples(value):
+    """Return value with its (nested) lists turned into tuples, undoing a JSON round trip."""
+    return tuple(_tuples(item) for item in value) if isinstance(value, list) else value
+
+
+_worker_masters = None
+"The (index, engine, overscan, kernels, output, masking) of a calibration worker; masters are read on first use."
+
+
+def _init_calibrate_worker(index, engine="numpy", overscan=False, output=None, masking=None):
+    """Store the master index in the worker process."""
+    global _worker_masters
+    _worker_masters = (index, engine, overscan, {}, output, masking)
+
+
+PipelineOptions = namedtuple("PipelineOptions", "readers prefetch writers")
+PipelineOptions.__new__.__defaults__ = (2, 4, 1)
+"""
+Threads of the serial read -> calibrate -> write pipeline of do_calibrate: readers threads read
+up to prefetch frames ahead of the calibration, and writers threads write the calibrated frames.
+"""
+
+
+class _FramePipeline(object):
+    """
+    Read, calibrate and write frames in three overlapping stages.
+
+    A pool of reader threads prefetches up to options.prefetch frames ahead of the calibration,
+    which runs in the calling thread, and a pool of writer threads writes the calibrated
+    frames. Both queues are bounded: at most prefetch raw frames are read ahead, and at most
+    writers calibrated frames wait to be written while the next one is calibrated. Results are
+    yielded in the order of the jobs.
+
+    The counters hold, for each stage, the frames done, the seconds its threads were busy and
+    the frames per second it could sustain; "starved" and "blocked" are the seconds the
+    calibration waited for a read and for a free writer. The stage with the lowest rate is the
+    bottleneck.
+
+    Args:
+        read: read(job) -> frame, run on the reader threads
+        compute: compute(job, frame) -> result, run in the calling thread
+        write: write(job, result) -> output, run on the writer threads
+        options: the PipelineOptions
+    """
+
+    def __init__(self, read, compute, write, options=None):
+        self.read, self.compute, self.write = read, compute, write
+        self.options = options or PipelineOptions()
+        self.counters = {stage: {"frames": 0, "seconds": 0.0, "threads": threads}
+                         for stage, threads in (("read", self.options.readers), ("calibrate", 1),
+                                                ("write", self.options.writers))}
+        self.counters["starved"] = self.counters["blocked"] = 0.0
+        self._lock = threading.Lock()
+
+    def _timed(self, stage, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.counters[stage]["frames"] += 1
+                self.counters[stage]["seconds"] += time.perf_counter() - start
+
+    def _waited(self, counter, future):
+        start = time.perf_counter()
+        try:
+            return future.result()
+        finally:
+            self.counters[counter] += time.perf_counter() - start
+
+    def run(self, jobs, failed=None):
+        """
+        Run jobs through the pipeline and yield their outputs in order.
+
+        A job failing in any stage is logged and yields failed; job[0] names it in the log.
+        """
+        jobs = iter(jobs)
+        reads, writes = deque(), deque()
+        with ThreadPoolExecutor(self.options.readers) as readers, \
+                ThreadPoolExecutor(self.options.writers) as writers:
+            def prefetch():
+                for job in jobs:
+                    reads.append((job, readers.submit(self._timed, "read", self.read, job)))
+                    if len(reads) >= self.options.prefetch:
+                        break
+
+            prefetch()
+            while reads:
+                job, future = reads.popleft()
+                try:
+                    result = self._timed("calibrate", self.compute, job, self._waited("starved", future))
+                except Exception as err:
+                    logger.warning("Skipping object calibration of {}: {}".format(os.path.basename(job[0]), err))
+                    writes.append((job, None))
+                else:
+                    writes.append((job, writers.submit(self._timed, "write", self.write, job, result)))
+                result = None
+                prefetch()
+                while writes and (len(writes) > self.options.writers or writes[0][1] is None):
+                    yield self._written(writes.popleft(), failed)
+            while writes:
+                yield self._written(writes.popleft(), failed)
+
+    def _written(self, write, failed):
+        job, future = write
+        if future is None:
+            return failed
+        try:
+            return self._waited("blocked", future)
+        except Exception as err:
+            logger.warning("Skipping object calibration of {}: {}".format(os.path.basename(job[0]), err))
+            return failed
+
+    def rates(self):
+        """Add the frames per second each stage could sustain to the counters and return them."""
+        for stage in ("read", "calibrate", "write"):
+            counter = self.counters[stage]
+            seconds = counter["seconds"] / counter["threads"]
+            counter["frames_per_sec"] = counter["frames"] / seconds if seconds > 0 else None
+        return self.counters
+
+
+def _write_calibrated_safe(item, cal_object_frame, out_filename, return_fits_objs, output=None):
+    """
+    Write a calibrated frame, logging and swallowing any error.
+
+    Returns:
+        A (CCDData or None, file path, output checksum) tuple, or (None, None, None) if the write failed.
+    """
+    try:
+        _write_calibrated(cal_object_frame, out_filename, output)
+    except Exception as err:
+        logger.warning("Skipping object calibration of {}: {}".format(os.path.basename(item), err))
+        return None, None, None
+    return (cal_object_frame if return_fits_objs else None), out_filename, _file_checksum(out_filename)
+
+
+def _calibrate_frame_safe(item, master_flat, master_dark, check_path, return_fits_objs, kernel=None,
+                          master_bias=None, overscan=False, output=None, masking=None, bad_pixels=None):
+    """
+    Calibrate a frame, logging and swallowing any per-frame error.
+
+    Returns:
+        A (CCDData or None, file path, output checksum) tuple, or (None, None, None) if the frame failed.
+    """
+    try:
+        cal_object_frame = _calibrate_data(item, master_flat, master_dark, kernel, master_bias, overscan, masking,
+                                           bad_pixels)
+    except Exception as err:
+        logger.warning("Skipping object calibration of {}: {}".format(os.path.basename(item), err))
+        return None, None, None
+    if kernel is not None and return_fits_objs:
+        # Detach the result from the kernel's reused buffer
+        cal_object_frame = cal_object_frame.copy()
+    # Without return_fits_objs, avoid shipping the pixel data back from the worker
+    return _write_calibrated_safe(item, cal_object_frame, _cal_filename(item, check_path), return_fits_objs,
+                                  output)
+
+
+def _masters_of(master_keys, index, engine, kernels, masking=None):
+    """
+    Return the (flat, dark, bias, kernel, bad pixels) of index given by master_keys (see
+    MasterIndex.masters_for).
+
+    With the numpy engine, kernels are built once per set of masters, and with masking.bad_pixels
+    the bad_pixel_mask is computed once per master dark and flat; both are kept in the kernels dict.
+    """
+    flat_key, dark_key, bias_key = master_keys
+    master_flat, master_dark, master_bias = index.get(flat_key), index.get(dark_key), index.get(bias_key)
+    kernel = None
+    if engine == "numpy":
+        if master_keys not in kernels:
+            kernels[master_keys] = CalibrationKernel(master_flat, master_dark, master_bias=master_bias)
+        kernel = kernels[master_keys]
+    bad_pixels = None
+    if masking is not None and masking.bad_pixels:
+        mask_key = ("bad_pixels", flat_key, dark_key)
+        if mask_key not in kernels:
+            kernels[mask_key] = bad_pixel_mask(master_dark, master_flat, masking.hot_sigma, masking.low_flat,
+                                               masking.high_flat)
+            logger.info("Masking {} bad pixels of the master dark and flat".format(
+                np.count_nonzero(kernels[mask_key])))
+        bad_pixels = kernels[mask_key]
+    return master_flat, master_dark, master_bias, kernel, bad_pixels
+
+
+def _calibrate_with_masters(item, master_keys, index, engine, overscan, kernels, check_path, return_fits_objs,
+                            output=None, masking=None):
+    """Calibrate a frame with the masters of index given by master_keys (see _masters_of)."""
+    master_flat, master_dark, master_bias, kernel, bad_pixels = _masters_of(master_keys, index, engine, kernels,
+                                                                            masking)
+    return _calibrate_frame_safe(item, master_flat, master_dark, check_path, return_fits_objs, kernel,
+                                 master_bias, overscan, output, masking, bad_pixels)
+
+
+def _pipeline_calibrate(jobs, index, engine, overscan, check_path, return_fits_objs, output=None, options=None,
+                        masking=None, kernels=None):
+    """
+    Calibrate (item, master_keys) jobs in a _FramePipeline.
+
+    Frames are read into memory on the reader threads, calibrated (and masked) into a new array
+    each (the kernel's buffer cannot be shared with the writers) and written on the writer threads.
+    The kernels and bad-pixel masks are kept in kernels (see _masters_of), a new dict by default.
+
+    Returns:
+        The pipeline, and a generator of the (CCDData or None, file path, output checksum)
+        tuples of the jobs in order, (None, None, None) for failed frames.
+    """
+    kernels = {} if kernels is None else kernels
+
+    def read(job):
+        return _read_object(job[0], engine, overscan, load=True)
+
+    def compute(job, object_frame):
+        item, master_keys = job
+        master_flat, master_dark, master_bias, kernel, bad_pixels = _masters_of(master_keys, index, engine,
+                                                                                kernels, masking)
+        return _calibrate_object(item, object_frame, master_flat, master_dark, kernel, master_bias,
+                                 masking=masking, bad_pixels=bad_pixels)
+
+    def write(job, cal_object_frame):
+        out_filename = _cal_filename(job[0], check_path)
+        _write_calibrated(cal_object_frame, out_filename, output)
+        return (cal_object_frame if return_fits_objs else None), out_filename, _file_checksum(out_filename)
+
+    pipeline = _FramePipeline(read, compute, write, options)
+    return pipeline, pipeline.run(jobs, failed=(None, None, None))
+
+
+def _calibrate_frame_worker(job, check_path, return_fits_objs):
+    """Calibrate an (item, master_keys) job in a worker process using the shipped master index."""
+    index, engine, overscan, kernels, output, masking = _worker_masters
+    item, master_keys = job
+    return _calibrate_with_masters(item, master_keys, index, engine, overscan, kernels, check_path,
+                                   return_fits_objs, output, masking)
+
+
+def _report_pipeline(frame_pipeline, record):
+    """Add the counters of a _FramePipeline to a stage record and log its slowest stage."""
+    counters = frame_pipeline.rates()
+    record["pipeline"] = counters
+    rates = [(counters[stage]["frames_per_sec"], stage) for stage in ("read", "calibrate", "write")
+             if counters[stage]["frames_per_sec"] is not None]
+    if rates:
+        logger.info("Pipeline: {}; bottleneck is {}".format(
+            ", ".join("{} {:.1f} frames/s".format(stage, rate) for rate, stage in rates), min(rates)[1]))
+
+
+_MANIFEST_NAME = "manifest.json"
+"Name of the per-object file recording which frames have been calibrated."
+
+
+def _load_manifest(check_path):
+    """Load the calibration manifest of a cal_<object> directory."""
+    try:
+        with open(os.path.join(check_path, _MANIFEST_NAME)) as fobj:
+            return json.load(fobj)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(check_path, manifest):
+    """Atomically write the calibration manifest of a cal_<object> directory."""
+    manifest_path = os.path.join(check_path, _MANIFEST_NAME)
+    with open(manifest_path + ".part", "w") as fobj:
+        json.dump(manifest, fobj, indent=1, sort_keys=True)
+    os.replace(manifest_path + ".part", manifest_path)
+
+
+def _is_calibrated(entry, item, masters, engine, check_path, output=None, masking=None):
+    """
+    Return True if the manifest entry shows item is calibrated with the current inputs, masters,
+    engine, output format and masking.
+    """
+    if (entry is None or entry["input"] != _file_identity(item) or entry["masters"] != masters or
+            entry.get("engine") != engine or entry.get("format") != _output_key(output) or
+            entry.get("masking") != _masking_key(masking)):
+        return False
+    return _has_output(entry, check_path)
+
+
+def _has_output(entry, check_path):
+    """Return True if the calibrated frame of a manifest entry is in check_path with its recorded size."""
+    out_filename = os.path.join(check_path, entry["output"])
+    return os.path.isfile(out_filename) and os.path.getsize(out_filename) == entry["size"]
+
+
+StackOptions = namedtuple("StackOptions", "method region mem_limit")
+StackOptions.__new__.__defaults__ = ("mean", 512, _DEFAULT_MEM_LIMIT)
+"""
+Co-add of the calibrated frames of an object in do_calibrate (see _Stacker). method is "mean"
+(a running mean and variance) or "median" (of the aligned frames spilled to disk and combined in
+blocks of rows under mem_limit bytes). The offsets of the frames are measured on their central
+region x region pixels.
+"""
+
+_STACK_METHODS = ("mean", "median")
+"Methods of the per-object stack."
+
+_MEDIAN_EFFICIENCY = 1.2533
+"Ratio of the standard error of the median to that of the mean of normally distributed values."
+
+
+def _offset_cutout(data, mask, region):
+    """
+    Return the central region x region pixels of data for frame_offset, background-subtracted,
+    with the masked and non-finite pixels set to 0.
+    """
+    nrows, ncols = data.shape
+    rows = slice(max(0, (nrows - region) // 2), max(0, (nrows - region) // 2) + region)
+    cols = slice(max(0, (ncols - region) // 2), max(0, (ncols - region) // 2) + region)
+    cutout = np.array(data[rows, cols], dtype=np.float64)
+    bad = ~np.isfinite(cutout)
+    if mask is not None:
+        bad |= mask[rows, cols]
+    if not bad.all():
+        cutout -= np.median(cutout[~bad])
+    cutout[bad] = 0.0
+    return cutout
+
+
+def frame_offset(reference_fft, cutout):
+    """
+    Return the integer (rows, cols) offset of an image relative to a reference image of the same
+    shape, from the peak of their circular cross-correlation computed by FFT.
+
+    Offsets are found up to half the image size either way.
+
+    Args:
+        reference_fft: np.fft.rfft2 of the reference image
+        cutout: the image, e.g. from _offset_cutout
+
+    Returns:
+        the (rows, cols) tuple of ints such that cutout[y + rows, x + cols] matches reference[y, x]
+    """
+    correlation = np.fft.irfft2(np.fft.rfft2(cutout) * np.conj(reference_fft), s=cutout.shape)
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    # The correlation wraps around: peaks past the middle are negative offsets
+    return tuple(int(p) - n if p > n // 2 else int(p) for p, n in zip(peak, correlation.shape))
+
+
+def _shift_slices(offset, size):
+    """Return the (stack, frame) slices of the overlap of a frame offset by offset pixels along an axis of size."""
+    return slice(max(0, -offset), min(size, size - offset)), slice(max(0, offset), min(size, size + offset))
+
+
+class _Stacker(object):
+    """
+    Co-add calibrated frames one at a time, as they are calibrated.
+
+    The first frame is the reference: the stack has its shape and header, and every other frame
+    is shifted by its integer-pixel frame_offset from it before it is added. Masked and
+    non-finite pixels are left out. With the "mean" method, the running mean and variance of
+    each pixel are updated in float64 (Welford's algorithm), so the memory is 20 bytes per pixel
+    whatever the number of frames; they can be saved and resumed by a later run, which then only
+    adds its new frames. With the "median" method, the aligned frames are appended in
+    float32 to a spill file and the median is combined from it one block of rows at a time.
+    """
+
+    def __init__(self, spill_filename, options=None):
+        self.options = options or StackOptions()
+        if self.options.method not in _STACK_METHODS:
+            raise ValueError("Unknown stack method '{}'".format(self.options.method))
+        self.spill_filename = spill_filename
+        self.frames = []
+        self.shape = None
+        self.header = None
+        self.reference_fft = None
+        self._spill = None
+
+    def add(self, name, cal_object_frame):
+        """
+        Add a calibrated CCDData object named name to the stack.
+
+        Returns:
+            the (rows, cols) offset of the frame, or None if its shape is not the reference's
+        """
+        data = np.asarray(cal_object_frame.data)
+        mask = cal_object_frame.mask
+        cutout = _offset_cutout(data, mask, self.options.region)
+        if self.header is None:
+            self._start(data.shape, _fits_header(cal_object_frame))
+            self.reference_fft = np.fft.rfft2(cutout)
+            offset = (0, 0)
+        elif data.shape != self.shape:
+            logger.warning("Not stacking {}: shape {} differs from {}".format(name, data.shape, self.shape))
+            return None
+        else:
+            offset = frame_offset(self.reference_fft, cutout)
+
+        (stack_rows, rows), (stack_cols, cols) = (_shift_slices(shift, size) for shift, size in zip(offset, self.shape))
+        values = np.array(data[rows, cols], dtype=np.float64 if self.options.method == "mean" else np.float32)
+        valid = np.isfinite(values)
+        if mask is not None:
+            valid &= ~mask[rows, cols]
+        if self.options.method == "mean":
+            self._add_mean((stack_rows, stack_cols), values, valid)
+        else:
+            aligned = np.full(self.shape, np.nan, dtype=np.float32)
+            aligned[stack_rows, stack_cols] = values
+            if not valid.all():
+                aligned[stack_rows, stack_cols][~valid] = np.nan
+            self._spill.write(aligned.tobytes())
+        self.frames.append((name, offset))
+        logger.debug("Stacking {} with offset {}".format(name, offset))
+        return offset
+
+    def _start(self, shape, header):
+        self.shape = shape
+        self.header = header.copy()
+        if self.options.method == "mean":
+            self.count = np.zeros(shape, dtype=np.int32)
+            self.mean = np.zeros(shape, dtype=np.float64)
+            self.m2 = np.zeros(shape, dtype=np.float64)
+        else:
+            self._spill = open(self.spill_filename, "wb")
+
+    def _add_mean(self, section, values, valid):
+        count, mean, m2 = self.count[section], self.mean[section], self.m2[section]
+        everywhere = valid.all()
+        if not everywhere:
+            values[~valid] = 0.0
+        count += valid
+        delta = values - mean
+        if not everywhere:
+            delta *= valid
+        mean += delta / np.maximum(count, 1)
+        # values - mean is 0 where delta is
+        values -= mean
+        values *= delta
+        m2 += values
+
+    def _combine_mean(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # The standard error of the mean; NaN for pixels of fewer than 2 frames
+            error = np.sqrt(self.m2 / (self.count - 1) / self.count)
+        error[self.count < 2] = np.nan
+        return self.mean, error, self.count
+
+    def _combine_median(self):
+        self._spill.close()
+        nframes = len(self.frames)
+        nrows, ncols = self.shape
+        spill = np.memmap(self.spill_filename, dtype=np.float32, mode="r", shape=(nframes, nrows, ncols))
+        data = np.empty(self.shape, dtype=np.float32)
+        error = np.empty(self.shape, dtype=np.float32)
+        count = np.empty(self.shape, dtype=np.int32)
+        # np.nanmedian makes a few copies of a block
+        block = max(1, int(self.options.mem_limit / (_COMBINE_MEMORY_FACTOR * nframes * ncols * 4)))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for row in range(0, nrows, block):
+                rows = slice(row, min(row + block, nrows))
+                # NaNs sort last, so the median of the n valid values is at (n - 1) // 2 and n // 2;
+                # much faster than np.nanmedian
+                tile = np.sort(spill[:, rows], axis=0)
+                valid = np.isfinite(tile)
+                count[rows] = n = np.count_nonzero(valid, axis=0)
+                low = np.take_along_axis(tile, np.maximum(n - 1, 0)[np.newaxis] // 2, axis=0)[0]
+                high = np.take_along_axis(tile, n[np.newaxis] // 2, axis=0)[0]
+                # Pixels of no frame are NaN
+                data[rows] = np.where(n > 0, 0.5 * (low + high), np.nan)
+                tile[~valid] = 0.0
+                mean = tile.sum(axis=0) / n
+                tile -= mean
+                tile *= valid
+                error[rows] = _MEDIAN_EFFICIENCY * np.sqrt((tile ** 2).sum(axis=0) / (n - 1) / n)
+        error[count < 2] = np.nan
+        del spill
+        return data, error, count
+
+    def close(self):
+        """Delete the spill file."""
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+            os.remove(self.spill_filename)
+
+    def save(self, state_filename, checksums):
+        """
+        Save the running mean and variance of a "mean" stack atomically to state_filename (see resume).
+
+        Args:
+            checksums: a dict name -> output checksum of every frame added to the stack
+        """
+        frames = {"checksums": checksums, "offsets": self.frames, "region": self.options.region}
+        tmp_filename = os.path.join(os.path.dirname(state_filename),
+                                    ".{}.part".format(os.path.basename(state_filename)))
+        with open(tmp_filename, "wb") as state:
+            np.savez(state, count=self.count, mean=self.mean, m2=self.m2, reference_fft=self.reference_fft,
+                     header=np.array(self.header.tostring()), frames=np.array(json.dumps(frames)))
+        os.replace(tmp_filename, state_filename)
+
+    def resume(self, state_filename, checksums):
+        """
+        Load the "mean" stack saved to state_filename by save, if it was measured on the same
+        region and the checksums of all its frames are still those in checksums.
+
+        Returns:
+            the names of the frames in the stack, or None if nothing was loaded
+        """
+        try:
+            with np.load(state_filename) as state:
+                frames = json.loads(str(state["frames"]))
+                if frames["region"] != self.options.region or any(
+                        checksums.get(name) != checksum for name, checksum in frames["checksums"].items()):
+                    return None
+                count, mean, m2 = state["count"], state["mean"], state["m2"]
+                reference_fft, header = state["reference_fft"], fits.Header.fromstring(str(state["header"]))
+        except (OSError, ValueError, KeyError):
+            return None
+        self.count, self.mean, self.m2, self.reference_fft, self.header = count, mean, m2, reference_fft, header
+        self.shape = mean.shape
+        self.frames = [(name, tuple(offset)) for name, offset in frames["offsets"]]
+        logger.debug("Resuming the stack of {} frames from {}".format(len(self.frames), state_filename))
+        return list(frames["checksums"])
+
+    def write(self, out_filename, key=None):
+        """
+        Write the stack atomically as float32 with MASK (pixels of no frame) and UNCERT (standard
+        error) extensions. NCOMBINE, STACKMTH and, if given, STACKKEY are added to the header of
+        the reference frame, with a HISTORY card giving the offset of each frame.
+        """
+        data, error, count = self._combine_mean() if self.options.method == "mean" else self._combine_median()
+        # The reference header is kept as is for save
+        header = self.header.copy()
+        header["NCOMBINE"] = (len(self.frames), "Number of frames stacked")
+        header["STACKMTH"] = (self.options.method, "Stack method")
+        if key is not None:
+            header["STACKKEY"] = key
+        for name, (rows, cols) in self.frames:
+            header.add_history("Stacked {} offset by {} rows and {} columns".format(name, rows, cols))
+        tmp_filename = os.path.join(os.path.dirname(out_filename), ".{}.part".format(os.path.basename(out_filename)))
+        _write_frame(tmp_filename, data, header, count == 0, error, OutputFormat("float32"))
+        os.replace(tmp_filename, out_filename)
+        logger.info("Wrote stack of {} frames to {}".format(len(self.frames), out_filename))
+
+
+def _stack_key(names, manifest, stacking):
+    """Return the hash of the calibrated frames names (by their manifest checksums) and the StackOptions."""
+    digest = hashlib.sha256()
+    record = [[name, manifest[name]["sha256"]] for name in sorted(names)] + [stacking.method, stacking.region]
+    digest.update(json.dumps(record).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _stack_filename(check_path, object_name):
+    """Return the path of the stack of an object in its cal_<object> directory check_path."""
+    return os.path.join(check_path, "stack-{}.fit".format(object_name))
+
+
+def _is_stacked(stack_filename, key):
+    """Return True if the stack at stack_filename exists and was made with key (see _stack_key)."""
+    try:
+        return _read_primary_header(stack_filename).get("STACKKEY") == key
+    except (OSError, ValueError):
+        return False
+
+
+def _check_lease(lease, object_name):
+    """Raise a RuntimeError if the lease callable of do_calibrate says the outputs of object_name were lost."""
+    if lease is not None and not lease():
+        raise RuntimeError("Lost the lease on {}; leaving its outputs to the new holder".format(object_name))
+
+
+def do_calibrate(object_list, master_flat, master_dark, object_name, cal_frame_dir, return_fits_objs=False,
+                 workers=1, engine="numpy", master_bias=None, overscan=False, index=None, output=None,
+                 pipeline=None, masking=None, screen=None, stacking=None, kernels=None, lease=None):
+    """
+    Calibrate a list of images.
+
+    Each frame is calibrated with the masters of its filter, binning, shape and exposure
+    looked up in a MasterIndex from its header; masters are read from disk only when a frame
+    first needs them. Without an index, the given masters are used for every frame.
+
+    Calibration is incremental: a manifest in cal_<object> records each input frame's identity,
+    the masters used and the output checksum, and only new or changed frames, or frames whose
+    masters changed, are calibrated again. Outputs are written atomically. Frames that fail to
+    calibrate (unreadable, wrong shape, missing exposure) are logged and skipped; the rest of
+    the object is still calibrated.
+
+    Serially, frames go through a read -> calibrate -> write pipeline: reader threads prefetch
+    the next frames and writer threads write (and compress) the previous ones while a frame is
+    calibrated. The busy seconds and frames per second of each pipeline stage are added to the
+    run report, and the slowest stage is logged.
+
+    With masking, the static bad pixels of each set of masters are added to the frame masks, and
+    cosmic rays are rejected from each frame in memory before it is written, saving a second pass
+    over the calibrated frames.
+
+    With screen, the frames to calibrate are first measured on a subsample of their raw pixels
+    (see frame_quality), and saturated, cloudy or trailed frames are skipped and listed in
+    rejected.csv in cal_<object>. They are screened again on the next run.
+
+    With stacking, the calibrated frames of the object are co-added into stack-<object>.fit in
+    cal_<object> as they are calibrated (see _Stacker), instead of being read back afterwards.
+    Frames calibrated by earlier runs, including those in the manifest but not in object_list,
+    are stacked first; the stack is only rebuilt when its frames or options change. A "mean"
+    stack saves its running mean and variance to .stack-<object>.npz, and a later run adds only
+    the frames that are not in it, unless a frame in it changed; other frames are read back.
+
+    Args:
+        object_list: a list of file paths of the light frames to be calibrated
+        master_flat: a CCDData object containing the master flat
+        master_dark: a CCDData object containing the master dark
+        cal_frame_dir: a string identifying the output path for writing to disk
+        return_fits_obj=False: determine, if function should return list fits obj; set to False for memory saving
+        workers=1: number of worker processes; 1 calibrates serially, 0 or less uses all CPUs.
+            The master frames are shipped once to each worker.
+        engine="numpy": "numpy" calibrates with a CalibrationKernel in float32, "ccdproc" with
+            ccdproc.subtract_dark and ccdproc.flat_correct in float64 with uncertainties
+        master_bias=None: a CCDData object containing the master bias, subtracted before the
+            dark; master_dark must then be bias-subtracted too (see do_dark_combine)
+        overscan=False: subtract the overscan and trim each frame as given by its BIASSEC and
+            TRIMSEC headers
+        index=None: a MasterIndex of the night's masters; master_flat, master_dark and
+            master_bias are ignored when it is given
+        output=None: an OutputFormat for the calibrated frames; None writes them uncompressed
+            in the engine's dtype with all their extensions. A change of format recalibrates
+            the frames.
+        pipeline=None: the PipelineOptions of the serial pipeline; None uses the defaults
+        masking=None: the MaskOptions of the bad-pixel and cosmic-ray masking; None masks only
+            the pixels masked in the masters. A change of masking recalibrates the frames.
+        screen=None: the ScreenOptions of the quality pre-screen; None calibrates every frame
+        stacking=None: the StackOptions of the per-object stack; None writes no stack
+        kernels=None: a dict keeping the CalibrationKernels and bad-pixel masks of index for the
+            serial calibration (see _masters_of), to reuse them across calls with the same index
+            and masking; None builds them anew
+        lease=None: a callable returning True while the caller may write the outputs of the
+            object, e.g. while a worker holds its unit of a WorkQueue; it is checked before every
+            write of the manifest and of the stack, and a RuntimeError is raised once it returns
+            False, so a worker whose unit was claimed again does not overwrite the new holder's
+            manifest
+
+    Returns:
+        A list of the CCDData objects calibrated in this run (if return_fits_obj=True) and a list of the file paths
+        where they were saved, both in the same order as object_list.
+    """
+    if engine not in _ENGINES:
+        raise ValueError("Unknown calibration engine '{}'".format(engine))
+
+    cal_dir = "cal_{}".format(object_name)
+    check_path = os.path.join(cal_frame_dir, cal_dir)
+
+    if not os.path.exists(check_path):
+        os.makedirs(check_path)
+
+    processed_frames, processed_fnames = [], []
+
+    manifest = _load_manifest(check_path)
+    if index is None:
+        index = MasterIndex.single(master_flat, master_dark, master_bias)
+
+    # Pick the masters and check shapes and exposures from the headers before reading any pixels
+    todo_list, todo_keys, todo_masters, done_list = [], [], [], []
+    for item in object_list:
+        try:
+            info = scan_header(item)
+        except Exception as err:
+            logger.warning("Skipping object calibration of {}: unreadable header: {}".format(
+                os.path.basename(item), err))
+            continue
+        master_keys = index.masters_for(info)
+        if master_keys is None:
+            logger.warning("Skipping object calibration of {}: no master flat and dark for filter {}, "
+                           "binning {} and shape {}".format(os.path.basename(item), info.filter, info.binning,
+                                                           info.shape))
+            continue
+        flat_key, dark_key, bias_key = master_keys
+        masters = [index.reduxkey(dark_key), index.reduxkey(flat_key)]
+        if bias_key is not None:
+            masters.append(index.reduxkey(bias_key))
+        if overscan:
+            masters.append("overscan")
+        if _is_calibrated(manifest.get(os.path.basename(item)), item, masters, engine, check_path, output,
+                          masking):
+            logger.debug("Skipping {}: already calibrated".format(os.path.basename(item)))
+            done_list.append(os.path.basename(item))
+            continue
+        reason = _check_frame(info, index.shape(dark_key), overscan)
+        if reason is not None:
+            logger.warning("Skipping object calibration of {}: {}".format(os.path.basename(item), reason))
+            continue
+        todo_list.append(item)
+        todo_keys.append(master_keys)
+        todo_masters.append(masters)
+
+    if screen is not None and todo_list:
+        passed = _screen_frames(todo_list, object_name, check_path, screen)
+        todo_list, todo_keys, todo_masters = ([value for value, ok in zip(values, passed) if ok]
+                                              for values in (todo_list, todo_keys, todo_masters))
+    logger.info("Calibrating {} of {} frames of {}".format(len(todo_list), len(object_list), object_name))
+
+    if workers is not None and workers <= 0:
+        workers = os.cpu_count()
+
+    stacker = None
+    if stacking is not None:
+        # Frames of the object calibrated by earlier runs, also from outside object_list
+        names = {os.path.basename(item) for item in object_list}
+        done_list = sorted(done_list + [name for name, entry in manifest.items() if name not in names and
+                                        _has_output(entry, check_path)])
+        stack_filename = _stack_filename(check_path, object_name)
+        if todo_list or not _is_stacked(stack_filename, _stack_key(done_list, manifest, stacking)):
+            stacker = _Stacker(os.path.join(check_path, ".stack-{}.spill".format(object_name)), stacking)
+    stacked = []
+    # The stack needs the calibrated frames back, but only the caller's are returned
+    keep_frames = return_fits_objs or stacker is not None
+
+    try:
+        if stacker is not None:
+            state_filename = os.path.join(check_path, ".stack-{}.npz".format(object_name))
+            # Frames calibrated by earlier runs go first, so the reference stays the first frame
+            with _stage("stack", object=object_name, output=stack_filename) as record:
+                if stacking.method == "mean":
+                    stacked = stacker.resume(state_filename, {name: manifest[name]["sha256"] for name in done_list})
+                    if stacked is not None:
+                        record["bytes_read"] += os.path.getsize(state_filename)
+                    stacked = stacked or []
+                resumed = set(stacked)
+                for name in done_list:
+                    if name in resumed:
+                        continue
+                    cal_filename = os.path.join(check_path, manifest[name]["output"])
+                    stacker.add(name, _read_calibrated(cal_filename))
+                    stacked.append(name)
+                    record["frames"] += 1
+                    record["bytes_read"] += os.path.getsize(cal_filename)
+
+        with _stage("calibrate", object=object_name, output=check_path) as record, ExitStack() as stack:
+            if workers is None or workers == 1 or len(todo_list) < 2:
+                frame_pipeline, results = _pipeline_calibrate(zip(todo_list, todo_keys), index, engine, overscan,
+                                                              check_path, keep_frames, output, pipeline, masking,
+                                                              kernels)
+                # Report the stage counters once every frame is through
+                stack.callback(_report_pipeline, frame_pipeline, record)
+            else:
+                logger.info("Calibrating {} frames with {} workers".format(len(todo_list), workers))
+                executor = stack.enter_context(ProcessPoolExecutor(
+                    max_workers=min(workers, len(todo_list)),
+                    initializer=_init_calibrate_worker,
+                    initargs=(index, engine, overscan, output, masking),
+                    ))
+                # map preserves the order of todo_list
+                results = executor.map(
+                    partial(_calibrate_frame_worker, check_path=check_path, return_fits_objs=keep_frames),
+                    zip(todo_list, todo_keys),
+                    )
+
+            for item, masters, (cal_object_frame, out_filename, checksum) in zip(todo_list, todo_masters, results):
+                if out_filename is None:
+                    continue
+                _check_lease(lease, object_name)
+                # Record the frame as soon as it is done so an interrupted run can resume
+                manifest[os.path.basename(item)] = {
+                    "input": _file_identity(item),
+                    "masters": masters,
+                    "engine": engine,
+                    "format": _output_key(output),
+                    "masking": _masking_key(masking),
+                    "output": os.path.basename(out_filename),
+                    "size": os.path.getsize(out_filename),
+                    "sha256": checksum,
+                    }
+                _save_manifest(check_path, manifest)
+                record["frames"] += 1
+                record["bytes_read"] += os.path.getsize(item)
+                record["bytes_written"] += os.path.getsize(out_filename)
+                if stacker is not None:
+                    stacker.add(os.path.basename(item), cal_object_frame)
+                    stacked.append(os.path.basename(item))
+                if return_fits_objs:
+                    processed_frames.append(cal_object_frame)
+                processed_fnames.append(out_filename)
+
+        if stacker is not None and stacked:
+            _check_lease(lease, object_name)
+            with _stage("stack", object=object_name, output=stack_filename) as record:
+                stacker.write(stack_filename, _stack_key(stacked, manifest, stacking))
+                record["bytes_written"] += os.path.getsize(stack_filename)
+                if stacking.method == "mean":
+                    stacker.save(state_filename, {name: manifest[name]["sha256"] for name in stacked})
+                    record["bytes_written"] += os.path.getsize(state_filename)
+    finally:
+        if stacker is not None:
+            stacker.close()
+
+    # processed_frames is an empty list, if return_fits_obj=False
+    # the true value should be used for the tests
+    return processed_frames, processed_fnames
+
+
+_FRAME_PATTERN = "*.fit*"
+"Pattern of the frame file names."
+
+_CALIBRATION_PATTERNS = (("bias", "*[bB]ias*.fit*"), ("dark", "*[dD]ark*.fit*"), ("flat", "*[fF]lat*.fit*"))
+"Directory name and file name pattern of the calibration frames of a night."
+
+_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS dirs (reldir TEXT PRIMARY KEY, mtime_ns INTEGER, subdirs TEXT);
+CREATE TABLE IF NOT EXISTS frames (
+    path TEXT PRIMARY KEY, reldir TEXT, name TEXT, night TEXT, object TEXT, frametype TEXT,
+    exposure REAL, nrows INTEGER, ncols INTEGER, imagetyp TEXT, filter TEXT,
+    mtime_ns INTEGER, size INTEGER);
+CREATE INDEX IF NOT EXISTS frames_reldir ON frames (reldir);
+CREATE INDEX IF NOT EXISTS frames_night_object ON frames (night, object);
+"""
+
+_CATALOG_VERSION = "2"
+"Version of the ObservationCatalog layout; a catalog of another version is rebuilt."
+
+
+class ObservationCatalog(object):
+    """
+    Persistent SQLite index of every frame under a root directory.
+
+    Each frame matching *.fit* is recorded with its path, night, object, frame type
+    (bias, dark, flat or light), exposure, shape, IMAGETYP, FILTER, size and mtime.
+    update() lists only the directories whose mtime changed since the last scan and reads
+    the headers only of new or modified files, so refreshing a large archive costs about
+    one stat per directory. A file rewritten in place does not change its directory's
+    mtime; update(full=True) rescans everything.
+
+    Paths are stored relative to the root and joined with the root the catalog is opened with,
+    so the same catalog serves an equivalent relative or absolute root.
+
+    Args:
+        db_path: the SQLite file, or ":memory:" for a throwaway index
+        root: the root directory of the archive, laid out as root/night/object/frames
+    """
+
+    def __init__(self, db_path, root):
+        self.root = root
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(_CATALOG_SCHEMA)
+        meta = dict(self.db.execute("SELECT key, value FROM meta WHERE key IN ('root', 'version')").fetchall())
+        if meta != {"root": os.path.abspath(root), "version": _CATALOG_VERSION}:
+            # The index is of another directory tree, or of an older layout
+            with self.db:
+                self.db.execute("DELETE FROM dirs")
+                self.db.execute("DELETE FROM frames")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('root', ?)", (os.path.abspath(root),))
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (_CATALOG_VERSION,))
+
+    def close(self):
+        self.db.close()
+
+    def _forget(self, reldir):
+        """Drop a directory and everything below it from the index."""
+        below = os.path.join(reldir, "") + "%"
+        self.db.execute("DELETE FROM frames WHERE reldir = ? OR reldir LIKE ?", (reldir, below))
+        self.db.execute("DELETE FROM dirs WHERE reldir = ? OR reldir LIKE ?", (reldir, below))
+
+    def _scan_frames(self, reldir, names, full):
+        """Index the frames of one directory, reading headers only of new or modified files."""
+        parts = reldir.split(os.sep) if reldir else []
+        night = parts[0] if parts else None
+        obj = parts[-1] if parts else None
+        frametype = obj if obj in ("bias", "dark", "flat") else "light"
+        known = {row[0]: (row[1], row[2]) for row in self.db.execute(
+            "SELECT name, mtime_ns, size FROM frames WHERE reldir = ?", (reldir,))}
+        for name in set(known) - set(names):
+            self.db.execute("DELETE FROM frames WHERE reldir = ? AND name = ?", (reldir, name))
+        for name in names:
+            relpath = os.path.join(reldir, name)
+            path = os.path.join(self.root, relpath)
+            try:
+                size, mtime_ns = _file_identity(path)
+            except OSError:
+                continue
+            if not full and known.get(name) == (mtime_ns, size):
+                continue
+            try:
+                info = scan_header(path)
+                nrows, ncols = info.shape if len(info.shape) == 2 else (None, None)
+                values = (info.exposure, nrows, ncols, info.imagetyp, info.filter)
+            except Exception as err:
+                logger.warning("Cannot read header of {}: {}".format(path, err))
+                values = (None, None, None, None, None)
+            self.db.execute(
+                "INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (relpath, reldir, name, night, obj, frametype) + values + (mtime_ns, size))
+
+    def update(self, full=False):
+        """
+        Bring the index up to date with the directory tree.
+
+        Returns:
+            the number of directories that were listed
+        """
+        listed = 0
+        with self.db:
+            pending = [""]
+            while pending:
+                reldir = pending.pop()
+                path = os.path.join(self.root, reldir)
+                row = self.db.execute("SELECT mtime_ns, subdirs FROM dirs WHERE reldir = ?", (reldir,)).fetchone()
+                try:
+                    # Stat before listing so changes made during the scan are seen next time
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError:
+                    self._forget(reldir)
+                    continue
+                if row is not None and row[0] == mtime_ns and not full:
+                    pending.extend(json.loads(row[1]))
+                    continue
+
+                listed += 1
+                subdirs, names = [], []
+                for entry in os.scandir(path):
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        subdirs.append(os.path.join(reldir, entry.name) if reldir else entry.name)
+                    elif fnmatch.fnmatchcase(entry.name, _FRAME_PATTERN):
+                        names.append(entry.name)
+                self._scan_frames(reldir, names, full)
+                if row is not None:
+                    for old in set(json.loads(row[1])) - set(subdirs):
+                        self._forget(old)
+                self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                                (reldir, mtime_ns, json.dumps(sorted(subdirs))))
+                pending.extend(subdirs)
+        logger.debug("Catalog update listed {} directories".format(listed))
+        return listed
+
+    def subdirs(self, reldir=""):
+        """Return the names of the subdirectories of a directory relative to the root."""
+        row = self.db.execute("SELECT subdirs FROM dirs WHERE reldir = ?", (reldir,)).fetchone()
+        return sorted(os.path.basename(d) for d in json.loads(row[0])) if row is not None else []
+
+    def nights(self):
+        """Return the night directory names."""
+        return self.subdirs("")
+
+    def frames_in(self, reldir, pattern=_FRAME_PATTERN):
+        """Return the sorted paths of the frames directly in reldir whose name matches pattern."""
+        rows = self.db.execute("SELECT path, name FROM frames WHERE reldir = ? ORDER BY name", (reldir,))
+        return [os.path.join(self.root, path) for path, name in rows if fnmatch.fnmatchcase(name, pattern)]
+
+    def frames(self, **where):
+        """
+        Return the frames matching column values, e.g. frames(night="20170817", frametype="dark").
+
+        Returns:
+            a list of dicts, one per frame, sorted by path, with the path joined with the root
+        """
+        for column in where:
+            if column not in ("night", "object", "frametype", "filter", "reldir"):
+                raise ValueError("Cannot select frames by '{}'".format(column))
+        query = "SELECT * FROM frames"
+        if where:
+            query += " WHERE " + " AND ".join("{} = ?".format(column) for column in where)
+        cursor = self.db.execute(query + " ORDER BY path", tuple(where.values()))
+        columns = [d[0] for d in cursor.description]
+        frames = [dict(zip(columns, row)) for row in cursor]
+        for frame in frames:
+            frame["path"] = os.path.join(self.root, frame["path"])
+        return frames
+
+
+def do_file_list(catalog=None):
+    """
+    Make array of file paths in this directory and all subdirectories, recursively and filter by suffix.
+
+    Without a catalog the tree is walked and only the paths are listed; with a persistent
+    ObservationCatalog of _IN_DIR, the paths come from the catalog, which is brought up to date
+    first (reading only the headers of new or modified frames).
+
+    Assumes path:
+        root_path/ObservationDate/objectFolder/objectFrames
+    or
+        root_path/ObservationDate/randomName/objectFolder/objectFrames
+    """
+    if catalog is not None:
+        catalog.update()
+        file_array = [Path(frame["path"]) for frame in catalog.frames()]
+    else:
+        file_array = sorted(Path(_IN_DIR).glob('**/*.*'))
+
+    # Filters array for specified file suffix
+    suffix_search = '*.fit' # Examples: '.txt' '.py'
+
+    # Filter list by suffix
+    filtered_list = [path for path in file_array if path.match(suffix_search)]
+
+    file_array_len = len(filtered_list)
+
+    # Parse path to populate table
+    object_name = [filtered_list[x].parent.name for x in range(file_array_len)]
+    file_name = [filtered_list[x].name for x in range(file_array_len)]
+    observation_date = [filtered_list[x].parent.parent.name if filtered_list[x].parent.parent.name.isdigit() else filtered_list[x].parent.parent.parent.name for x in range(file_array_len)]
+
+    from astropy.table import Table, Column
+
+    # Make list into Columns
+    object_name = Column(object_name)
+    file_name = Column(file_name)
+    observation_date = Column(observation_date)
+
+    # Populate Table
+    file_table = Table([observation_date, object_name, file_name, filtered_list], names=('OBS_Date','Object','Frame','Path'))
+
+    # Create groups by similar observation date
+    obs_by_date = file_table.group_by('OBS_Date')
+
+    return obs_by_date
+
+
+def _calibration_lists(anight, catalog=None):
+    """
+    Return the sorted bias, dark and flat file lists of a night directory, from the catalog if given.
+    """
+    if catalog is not None:
+        night = os.path.basename(os.path.normpath(anight))
+        return tuple(catalog.frames_in(os.path.join(night, kind), pattern) for kind, pattern in _CALIBRATION_PATTERNS)
+    return tuple(sorted(glob.glob(os.path.join(anight, kind, pattern))) for kind, pattern in _CALIBRATION_PATTERNS)
+
+
+def _object_dirs(anight, catalog=None):
+    """
+    Return the names of the object directories of a night directory, from the catalog if given.
+    """
+    if catalog is not None:
+        subdirs = catalog.subdirs(os.path.basename(os.path.normpath(anight)))
+    else:
+        subdirs = [f for f in os.listdir(anight) if os.path.isdir(os.path.join(anight, f))]
+    return sorted(f for f in subdirs if f not in ['bias', 'dark', 'flat'])
+
+
+def _object_list(anight, obj, catalog=None):
+    """
+    Return the sorted frames of an object directory, from the catalog if given.
+    """
+    if catalog is not None:
+        return catalog.frames_in(os.path.join(os.path.basename(os.path.normpath(anight)), obj))
+    return sorted(glob.glob(os.path.join(anight, obj, _FRAME_PATTERN)))
+
+
+def _night_output_dir(anight, name):
+    """
+    Return (creating it if needed) the output directory `name` of a night, e.g. 'master_frames'.
+    """
+    anight_base = os.path.basename(os.path.normpath(anight))
+    out_dir = os.path.join(_OUT_DIR, anight_base, name)
+    logger.info("{} = {}".format(name, out_dir))
+    if not os.path.exists(out_dir):
+        logger.debug("Creating {}".format(out_dir))
+        os.makedirs(out_dir, exist_ok=True)
+    return out_dir
+
+
+def _group_frames(frame_list, kind):
+    """
+    Split calibration frames into the groups of the masters of kind they make (see _master_groups).
+
+    Returns:
+        a dict group -> (list of file paths, FrameInfo of the first frame), in order of frame_list
+    """
+    groups = {}
+    for path in frame_list:
+        try:
+            info = scan_header(path)
+        except Exception as err:
+            logger.warning("Skipping {} frame {}: unreadable header: {}".format(kind, path, err))
+            continue
+        group = _master_groups(info)[kind]
+        groups.setdefault(group, ([], info))[0].append(path)
+    return groups
+
+
+def _master_name(kind, group, ngroups):
+    """
+    Return the file name of a master: master-<kind>.fit if it is the only one of its kind in
+    the night, otherwise with a suffix naming its group, e.g. master-dark-1x1-2048x2048-60s.fit.
+    """
+    if ngroups == 1:
+        return "master-{}.fit".format(kind)
+    if kind == "flat":
+        filt, binning, shape = group
+        label = ["{}".format(filt).replace(" ", "_")]
+    else:
+        binning, shape = group[:2]
+        label = []
+    label += ["{}x{}".format(*binning), "{}x{}".format(*shape)]
+    if kind == "dark":
+        label.append("{:g}s".format(group[2] * _EXPOSURE_BUCKET) if group[2] is not None else "unknown")
+    return "master-{}-{}.fit".format(kind, "-".join(label))
+
+
+def _make_masters(anight, bias_list, dark_list, flat_list, mem_limit=_DEFAULT_MEM_LIMIT, cache=None,
+                  overscan=False, combine=None):
+    """
+    Create the master biases (if the night has bias frames), master darks and master flats of a night.
+
+    One master is made per group of frames (see _master_groups). A master dark is made with the
+    master bias of its binning and shape, and a master flat with the master dark and bias matching
+    its binning, shape and exposure.
+
+    Args:
+        combine: an optional dict "bias"/"dark"/"flat" -> CombineOptions; median by default
+
+    Returns:
+        a MasterIndex of the masters' file names
+    """
+    combine = combine or {}
+    # Create directory to save masters
+    master_frame_dir = _night_output_dir(anight, "master_frames")
+
+    # Create master calibration frames
+    index = MasterIndex()
+    bias_groups = _group_frames(bias_list, "bias")
+    for group, (frame_list, __) in bias_groups.items():
+        __, filename = do_bias_combine(frame_list, master_frame_dir, mem_limit, cache, overscan,
+                                       name=_master_name("bias", group, len(bias_groups)),
+                                       combine=combine.get("bias"))
+        index.add("bias", group, filename)
+
+    dark_groups = _group_frames(dark_list, "dark")
+    for group, (frame_list, info) in dark_groups.items():
+        master_bias = index.get(index.find("bias", _master_groups(info)["bias"]))
+        __, filename = do_dark_combine(frame_list, master_frame_dir, mem_limit, cache, master_bias, overscan,
+                                       name=_master_name("dark", group, len(dark_groups)),
+                                       combine=combine.get("dark"))
+        index.add("dark", group, filename)
+
+    flat_groups = _group_frames(flat_list, "flat")
+    for group, (frame_list, info) in flat_groups.items():
+        groups = _master_groups(info)
+        master_dark = index.get(index.find("dark", groups["dark"]))
+        if master_dark is None:
+            logger.warning("Skipping flats of {}: no master dark for binning {} and shape {}".format(
+                group[0], group[1], group[2]))
+            continue
+        master_bias = index.get(index.find("bias", groups["bias"]))
+        __, filename = do_flat_combine(frame_list, master_dark, master_frame_dir, mem_limit, cache, master_bias,
+                                       overscan, name=_master_name("flat", group, len(flat_groups)),
+                                       combine=combine.get("flat"))
+        index.add("flat", group, filename)
+    return index
+
+
+def _night_dirs(catalog=None):
+    """
+    Return the night directories under _IN_DIR, from the catalog if given.
+    """
+    if catalog is not None:
+        return [os.path.join(_IN_DIR, anight) for anight in catalog.nights()]
+    return sorted(os.path.join(_IN_DIR, anight)
+                  for anight in os.listdir(_IN_DIR)
+                  if os.path.isdir(os.path.join(_IN_DIR, anight)))
+
+
+class _Task(object):
+    """
+    A node of the reduction DAG.
+
+    The task calls func(*args, *dep_results) where dep_results are the results of the
+    tasks named in deps, in order. io_bound tasks are subject to the I/O throttle.
+    """
+
+    def __init__(self, name, func, args=(), deps=(), io_bound=False):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.deps = tuple(deps)
+        self.io_bound = io_bound
+
+
+def _run_dag(tasks, max_workers, io_limit=None):
+    """
+    Run a DAG of tasks on a process pool.
+
+    A task is submitted as soon as all its dependencies have finished, so independent
+    branches (e.g. different nights) overlap. At most max_workers tasks run at once, and
+    at most io_limit of them are io_bound. Tasks whose dependencies failed are skipped.
+
+    Args:
+        tasks: a list of _Task objects, in order of preference
+        max_workers: the global concurrency limit
+        io_limit: the maximum number of concurrent io_bound tasks; None for no limit
+
+    Returns:
+        a dict task name -> result for the tasks that succeeded
+    """
+    results, failed = {}, set()
+    pending = list(tasks)
+    running = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            io_running = sum(task.io_bound for task in running.values())
+            for task in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if any(dep in failed for dep in task.deps):
+                    logger.warning("Skipping {}: a dependency failed".format(task.name))
+                    pending.remove(task)
+                    failed.add(task.name)
+                    continue
+                if not all(dep in results for dep in task.deps):
+                    continue
+                if task.io_bound and io_limit is not None and io_running >= io_limit:
+                    continue
+                logger.debug("Submitting {}".format(task.name))
+                pending.remove(task)
+                future = executor.submit(task.func, *(task.args + tuple(results[dep] for dep in task.deps)))
+                running[future] = task
+                io_running += task.io_bound
+            if not running:
+                break
+            done, __ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    results[task.name] = future.result()
+                except Exception:
+                    logger.exception("Task {} failed".format(task.name))
+                    failed.add(task.name)
+    return results
+
+
+class _TaskOutput(object):
+    """The result of a reduction task and the stage records collected in its worker process."""
+
+    def __init__(self, value, stages):
+        self.value = value
+        self.stages = stages
+
+
+def _in_dirs(in_dir, out_dir, report_options, func, *args):
+    """
+    Run func(*args) in a worker process with _IN_DIR, _OUT_DIR and reporting set up.
+
+    Arguments that are the _TaskOutput of a dependency are replaced by their value.
+
+    Args:
+        report_options: None, or the keyword arguments of the worker's RunReport
+
+    Returns:
+        a _TaskOutput
+    """
+    global _IN_DIR, _OUT_DIR, _REPORT
+    _IN_DIR, _OUT_DIR = in_dir, out_dir
+    _REPORT = RunReport(**report_options) if report_options is not None else None
+    _import_lazy_modules()
+    args = [arg.value if isinstance(arg, _TaskOutput) else arg for arg in args]
+    value = func(*args)
+    return _TaskOutput(value, _REPORT.stages if _REPORT is not None else [])
+
+
+def _masters_task(anight, bias_list, dark_list, flat_list, mem_limit, cache, overscan, combine):
+    return _make_masters(anight, bias_list, dark_list, flat_list, mem_limit, cache, overscan, combine)
+
+
+def _object_task(anight, obj, object_list, engine, overscan, output, pipeline, masking, screen, stacking, index):
+    cal_frame_dir = _night_output_dir(anight, "cal_frames")
+    __, cal_fnames = do_calibrate(object_list, None, None, obj, cal_frame_dir, engine=engine, overscan=overscan,
+                                  index=index, output=output, pipeline=pipeline, masking=masking, screen=screen,
+                                  stacking=stacking)
+    return cal_fnames
+
+
+def _reduction_tasks(nights_dirs, mem_limit=_DEFAULT_MEM_LIMIT, cache=None, engine="numpy", catalog=None,
+                     overscan=False, combine=None, output=None, pipeline=None, objects=None, masking=None,
+                     screen=None, stacking=None):
+    """
+    Build the reduction DAG: per night, the masters -> one task per object (of objects, if given).
+    """
+    tasks = []
+    report_options = {"profile_dir": _REPORT.profile_dir} if _REPORT is not None else None
+    common = (_IN_DIR, _OUT_DIR, report_options)
+    for anight in nights_dirs:
+        bias_list, dark_list, flat_list = _calibration_lists(anight, catalog)
+        if not (dark_list and flat_list):
+            logger.info("Skipping directory: {}".format(anight))
+            continue
+        masters_name = "{}:masters".format(anight)
+        tasks.append(_Task(masters_name, _in_dirs,
+                           common + (_masters_task, anight, bias_list, dark_list, flat_list, mem_limit, cache,
+                                     overscan, combine),
+                           io_bound=True))
+        for obj in _object_dirs(anight, catalog):
+            if objects is not None and obj not in objects:
+                continue
+            object_list = _object_list(anight, obj, catalog)
+            tasks.append(_Task("{}:{}".format(anight, obj), _in_dirs,
+                               common + (_object_task, anight, obj, object_list, engine, overscan, output,
+                                         pipeline, masking, screen, stacking),
+                               deps=[masters_name]))
+    return tasks
+
+
+def main(workers=1, mem_limit=_DEFAULT_MEM_LIMIT, cache=None, tasks=1, io_tasks=None, engine="numpy",
+         catalog=None, overscan=False, combine=None, output=None, pipeline=None, nights=None, objects=None,
+         masking=None, screen=None, stacking=None):
+    """
+    Reduce every night under _IN_DIR into _OUT_DIR.
+
+    Args:
+        workers: number of worker processes calibrating the frames of one object
+        mem_limit: the memory ceiling in bytes for combining master frames
+        cache: an optional MasterCache shared across nights
+        tasks: if greater than 1, nights and objects are reduced concurrently by a DAG
+            scheduler with this many processes, and frames within an object are calibrated serially
+        io_tasks: the maximum number of master combines running at once in scheduler mode
+        engine: the calibration engine, "numpy" or "ccdproc" (see do_calibrate)
+        catalog: the ObservationCatalog of _IN_DIR the work is planned from; default is
+            catalog.sqlite in _OUT_DIR, updated incrementally on every run
+        overscan: subtract the overscan and trim every frame as given by its BIASSEC and
+            TRIMSEC headers
+        combine: an optional dict "bias"/"dark"/"flat" -> CombineOptions; median by default
+        output: an optional OutputFormat of the calibrated frames (see do_calibrate)
+        pipeline: optional PipelineOptions of the serial calibration (see do_calibrate)
+        nights: the names of the night directories to reduce; default is every night
+        objects: the names of the object directories to calibrate; default is every object
+        masking: optional MaskOptions of the bad pixels and cosmic rays masked in the calibrated
+            frames (see do_calibrate)
+        screen: optional ScreenOptions of the quality pre-screen of the light frames (see do_calibrate)
+        stacking: optional StackOptions of the stack of each object (see do_calibrate)
+
+    Nights with bias frames get a master bias, which is subtracted from darks, flats and
+    lights, so the master dark scales to any exposure time. Masters are made per filter,
+    binning, shape and exposure (see _make_masters) and each frame is calibrated with its own.
+    """
+    _import_lazy_modules()
+
+    with _stage("main", profile=False), ExitStack() as stack:
+        # Fancy header
+        logger.info("Starting image redux")
+
+        if catalog is None:
+            catalog = ObservationCatalog(os.path.join(_OUT_DIR, "catalog.sqlite"), _IN_DIR)
+            stack.callback(catalog.close)
+        catalog.update()
+
+        nights_dirs = [anight for anight in _night_dirs(catalog)
+                       if nights is None or os.path.basename(anight) in nights]
+
+        if tasks is not None and tasks > 1:
+            logger.info("Scheduling {} nights on {} processes".format(len(nights_dirs), tasks))
+            results = _run_dag(_reduction_tasks(nights_dirs, mem_limit, cache, engine, catalog, overscan, combine,
+                                                output, pipeline, objects, masking, screen, stacking),
+                               tasks, io_tasks)
+            if _REPORT is not None:
+                # Collect the stages timed in the worker processes
+                for result in results.values():
+                    _REPORT.stages.extend(result.stages)
+            return
+
+        for anight in nights_dirs:
+            # Create lists
+            bias_list, dark_list, flat_list = _calibration_lists(anight, catalog)
+
+            logger.debug("bias_list = {}".format(bias_list))
+            logger.debug("dark_list = {}".format(dark_list))
+            logger.debug("flat_list = {}".format(flat_list))
+
+            if dark_list and flat_list:
+                with _stage("night", profile=False, night=os.path.basename(os.path.normpath(anight))):
+                    # Create master calibration frames
+                    index = _make_masters(anight, bias_list, dark_list, flat_list, mem_limit, cache, overscan,
+                                          combine)
+
+                    # Create list of object directories
+                    obj_dirs = [obj for obj in _object_dirs(anight, catalog) if objects is None or obj in objects]
+
+                    logger.debug("obj_dirs = {}".format(obj_dirs))
+
+                    # Create directory to save calibrated objects
+                    cal_frame_dir = _night_output_dir(anight, "cal_frames")
+
+                    # Calibrate object frames
+                    for obj in obj_dirs:
+                        logger.info("obj = {}".format(obj))
+                        object_list = _object_list(anight, obj, catalog)
+                        logger.debug("object_list = {}".format(object_list))
+                        do_calibrate(object_list, None, None, obj, cal_frame_dir, workers=workers, engine=engine,
+                                     overscan=overscan, index=index, output=output, pipeline=pipeline,
+                                     masking=masking, screen=screen, stacking=stacking)
+            else:
+                logger.info("Skipping directory: {}".format(anight))
+
+
+def _stable_files(paths, seen, now, settle_time):
+    """
+    Return the files whose size and mtime have not changed for settle_time seconds.
+
+    Args:
+        paths: a list of file paths
+        seen: a dict path -> (identity, time first seen with that identity), updated in place
+        now: the current time in seconds
+        settle_time: seconds a file must stay unchanged to be considered completely written
+    """
+    stable = []
+    for path in paths:
+        try:
+            identity = _file_identity(path)
+        except OSError:
+            # Removed or renamed since listed
+            continue
+        previous = seen.get(path)
+        if previous is None or previous[0] != identity:
+            seen[path] = (identity, now)
+        elif now - previous[1] >= settle_time:
+            stable.append(path)
+    return stable
+
+
+async def _watch(workers, mem_limit, cache, engine, poll_interval, settle_time, idle_timeout, queue_size,
+                 overscan=False, combine=None, output=None, pipeline=None, masking=None, screen=None, stacking=None):
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    seen, queued, masters, master_inputs, locks, calibrated = {}, set(), {}, {}, {}, set()
+    # The kernels and bad-pixel masks of each night, built once for the whole session
+    kernels = {}
+    last_activity = loop.time()
+
+    async def calibrate_worker():
+        while True:
+            anight, obj, item = await queue.get()
+            try:
+                # Frames of one object share a manifest, so calibrate them one at a time
+                async with locks.setdefault((anight, obj), asyncio.Lock()):
+                    cal_frame_dir = _night_output_dir(anight, "cal_frames")
+                    await loop.run_in_executor(
+                        None, partial(do_calibrate, [item], None, None, obj, cal_frame_dir, engine=engine,
+                                      overscan=overscan, index=masters[anight], output=output,
+                                      pipeline=pipeline, masking=masking, screen=screen,
+                                      kernels=kernels[anight]))
+                    calibrated.add((anight, obj))
+            except Exception:
+                logger.exception("Failed to calibrate {}".format(item))
+            finally:
+                queue.task_done()
+
+    if workers is None or workers <= 0:
+        workers = os.cpu_count()
+    consumers = [asyncio.ensure_future(calibrate_worker()) for __ in range(workers)]
+    try:
+        while True:
+            now = loop.time()
+            active = False
+            for anight in _night_dirs():
+                bias_list, dark_list, flat_list = _calibration_lists(anight)
+                calib_list = bias_list + dark_list + flat_list
+                stable = _stable_files(calib_list, seen, now, settle_time)
+                if dark_list and flat_list and len(stable) == len(calib_list):
+                    inputs = [(f, seen[f][0]) for f in calib_list]
+                    if master_inputs.get(anight) != inputs:
+                        # (Re)build the masters once the calibration directories are complete
+                        logger.info("Building masters for {}".format(anight))
+                        masters[anight] = await loop.run_in_executor(
+                            None, _make_masters, anight, bias_list, dark_list, flat_list, mem_limit, cache, overscan,
+                            combine)
+                        master_inputs[anight] = inputs
+                        kernels[anight] = {}
+                        active = True
+                if anight not in masters:
+                    continue
+                master_keys = masters[anight].reduxkeys()
+                for obj in _object_dirs(anight):
+                    object_list = _object_list(anight, obj)
+                    for item in _stable_files(object_list, seen, now, settle_time):
+                        work_key = (item, tuple(seen[item][0]), master_keys)
+                        if work_key not in queued:
+                            queued.add(work_key)
+                            # Blocks while the queue is full
+                            await queue.put((anight, obj, item))
+                            active = True
+            if active or not queue.empty():
+                last_activity = loop.time()
+            elif idle_timeout is not None and loop.time() - last_activity >= idle_timeout:
+                await queue.join()
+                logger.info("No new frames for {} seconds, stopping watch".format(idle_timeout))
+                if stacking is not None:
+                    # Stack each object once, from the frames in its manifest
+                    for anight, obj in sorted(calibrated):
+                        await loop.run_in_executor(
+                            None, partial(do_calibrate, [], None, None, obj, _night_output_dir(anight, "cal_frames"),
+                                          index=masters[anight], stacking=stacking))
+                break
+            await asyncio.sleep(poll_interval)
+    finally:
+        for consumer in consumers:
+            consumer.cancel()
 
 
-def do_dark_combine(dark_list, master_frame_dir):
+def watch(workers=1, mem_limit=_DEFAULT_MEM_LIMIT, cache=None, engine="numpy", poll_interval=2.0,
+          settle_time=5.0, idle_timeout=None, queue_size=64, overscan=False, combine=None, output=None,
+          pipeline=None, masking=None, screen=None, stacking=None):
     """
-    Create master dark by median-combining a list of dark images.
+    Watch _IN_DIR and calibrate frames as they are written during the night.
 
-    Args:
-        dark_list: a list of CCDData objects containing the individual dark frames
+    The directory tree is polled every poll_interval seconds. A file counts as completely
+    written once its size and mtime have been stable for settle_time seconds. A night's
+    masters are built once all of its bias, dark and flat frames are stable (and rebuilt if more
+    arrive); each new stable object frame is then put on a bounded queue and calibrated by
+    one of `workers` consumers. With stacking, the stack of each object with new frames is built
+    when the watch stops after idle_timeout.
 
-    Returns:
-        a CCDData object containing the master dark
+    Args:
+        workers: number of frames calibrated concurrently
+        mem_limit: the memory ceiling in bytes for combining master frames
+        cache: an optional MasterCache shared across nights
+        engine: the calibration engine, "numpy" or "ccdproc" (see do_calibrate)
+        poll_interval: seconds between scans of the directory tree
+        settle_time: seconds a file must stay unchanged before it is processed
+        idle_timeout: stop after this many seconds without new frames; None watches forever
+        queue_size: maximum number of frames waiting to be calibrated
+        overscan: subtract the overscan and trim every frame (see main)
+        combine: an optional dict "bias"/"dark"/"flat" -> CombineOptions (see main)
+        output: an optional OutputFormat of the calibrated frames (see do_calibrate)
+        pipeline: optional PipelineOptions of the calibration (see do_calibrate)
+        masking: optional MaskOptions of the calibrated frames (see do_calibrate)
+        screen: optional ScreenOptions of the light frames (see do_calibrate)
+        stacking: optional StackOptions of the objects (see do_calibrate)
     """
-    out_filename = os.path.join(master_frame_dir, "master-dark.fit")
-    if not os.path.isfile(out_filename):
+    logger.info("Watching {}".format(_IN_DIR))
+    _import_lazy_modules()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(
+            _watch(workers, mem_limit, cache, engine, poll_interval, settle_time, idle_timeout, queue_size,
+                   overscan, combine, output, pipeline, masking, screen, stacking))
+    finally:
+        loop.close()
 
-        logger.info("Combining darks")
-        # Median combine darks
-        master_dark = ccdproc.combine(dark_list, method="median", unit="adu", clobber=True)
 
-        logger.info("Writing master dark to disk")
-        # Write master dark to disk
-        ccdproc.fits_ccddata_writer(master_dark, out_filename)
+_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS units (
+    name TEXT PRIMARY KEY, seq INTEGER, kind TEXT, args TEXT, deps TEXT, state TEXT,
+    attempts INTEGER, worker TEXT, lease_until REAL, result TEXT, error TEXT);
+"""
 
-    else:
+_LEASE = 300.0
+"Default seconds a worker holds a unit of a WorkQueue without renewing its lease."
 
-        logger.warning("Skipping dark combine: assigning existing file 'master-dark.fit'")
-        # Read master dark from disk and assign to variable
-        master_dark = ccdproc.fits_ccddata_reader(out_filename)
 
-    return master_dark, out_filename
+class WorkQueue(object):
+    """
+    SQLite queue of reduction units on storage shared by every node.
 
+    A coordinator adds a "masters" unit per night and an "object" unit per object, which
+    depends on the masters of its night (see Reducer.distribute). Workers (see run_worker)
+    claim units whose dependencies are done, with a lease they renew while they work. A unit
+    whose lease expires, e.g. because its node died, is claimed again by another worker, and
+    a unit that fails is retried, up to max_attempts tries; units depending on a unit that
+    failed for good fail too. Every operation is a short transaction on its own connection,
+    so threads, processes and nodes can share the queue; the shared filesystem must support
+    POSIX locks (e.g. NFSv4 or Lustre).
 
-def do_flat_combine(flat_list, master_dark, master_frame_dir):
+    Args:
+        db_path: the SQLite file of the queue
+        max_attempts: the number of times a unit is tried
     """
-    Create master flat.
 
-    Args:
-        flat_list: a list of CCDData objects containing the individual flat frames
-        master_dark: a CCDData object containing the master dark
-        master_frame_dir: a string identifying the output path for writing to disk
+    def __init__(self, db_path, max_attempts=3):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        db = sqlite3.connect(db_path, timeout=60)
+        try:
+            db.executescript(_QUEUE_SCHEMA)
+        finally:
+            db.close()
 
-    Returns:
-        a CCDData object containing the master flat.
-    """
-    out_filename = os.path.join(master_frame_dir, "master-flat.fit")
-    if not os.path.isfile(out_filename):
+    @contextmanager
+    def _transaction(self):
+        """Yield a connection holding the write lock of the queue until the block ends."""
+        db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
 
-        logger.info("Combining flats")
-        # Median combine flats
-        combined_flat = ccdproc.combine(flat_list, method="median", unit="adu")
+    def configure(self, in_dir, out_dir, options):
+        """Record the directories and the options (see _encode_options) every worker runs with."""
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('config', ?)",
+                       (json.dumps({"in_dir": in_dir, "out_dir": out_dir, "options": options}),))
 
-        logger.info("Subtracting dark from flat")
-        # Subtract master dark from combined flat
-        master_flat = ccdproc.subtract_dark(
-            combined_flat, master_dark,
-            data_exposure=combined_flat.header["exposure"] * u.second,
-            dark_exposure=master_dark.header["exposure"] * u.second,
-            scale=True)
+    def config(self):
+        """Return the (in_dir, out_dir, options) of the queue."""
+        with self._transaction() as db:
+            row = db.execute("SELECT value FROM meta WHERE key = 'config'").fetchone()
+        if row is None:
+            raise ValueError("Work queue {} has not been configured".format(self.db_path))
+        config = json.loads(row[0])
+        return config["in_dir"], config["out_dir"], config["options"]
 
-        logger.info("Writing master flat to disk")
-        # Write master flat to disk
-        ccdproc.fits_ccddata_writer(master_flat, out_filename)
+    def add(self, name, kind, args, deps=(), force=False):
+        """
+        Add a unit, or queue it again if its args changed, it failed or force is True.
 
-    else:
+        Returns:
+            True if the unit is (again) pending, False if it is unchanged.
+        """
+        args, deps = json.dumps(args, sort_keys=True), json.dumps(list(deps))
+        with self._transaction() as db:
+            row = db.execute("SELECT args, state FROM units WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] == args and row[1] != "failed" and not force:
+                return False
+            seq = db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM units").fetchone()[0]
+            db.execute("INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, 'pending', 0, NULL, NULL, NULL, NULL)",
+                       (name, seq, kind, args, deps))
+        return True
 
-        logger.warning("Skipping flat combine: assigning existing file 'master-flat.fit'")
-        # Read master flat from disk and assign to variable
-        master_flat = ccdproc.fits_ccddata_reader(out_filename)
+    def claim(self, worker, lease=_LEASE):
+        """
+        Claim the first unit that is ready, or whose lease expired, for lease seconds.
 
-    return master_flat, out_filename
+        Returns:
+            a dict with the name, kind, args, attempts and deps (the results of the unit's
+            dependencies, in order) of the unit, or None if no unit is ready.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            units = db.execute("SELECT name, kind, args, deps, state, attempts, lease_until, result FROM units "
+                               "ORDER BY seq").fetchall()
+            states = {unit[0]: unit[4] for unit in units}
+            results = {unit[0]: unit[7] for unit in units}
+            for name, kind, args, deps, state, attempts, lease_until, __ in units:
+                deps = json.loads(deps)
+                if state == "running" and lease_until < now:
+                    if attempts >= self.max_attempts:
+                        self._finish(db, name, "failed", error="lease expired {} times".format(attempts))
+                        states[name] = "failed"
+                        continue
+                    logger.warning("Lease of {} expired, claiming it again".format(name))
+                elif state != "pending":
+                    continue
+                if any(states[dep] == "failed" for dep in deps):
+                    self._finish(db, name, "failed", error="a dependency failed")
+                    states[name] = "failed"
+                    continue
+                if not all(states[dep] == "done" for dep in deps):
+                    continue
+                db.execute("UPDATE units SET state = 'running', attempts = ?, worker = ?, lease_until = ? "
+                           "WHERE name = ?", (attempts + 1, worker, now + lease, name))
+                return {"name": name, "kind": kind, "args": json.loads(args), "attempts": attempts + 1,
+                        "deps": [json.loads(results[dep]) for dep in deps]}
+        return None
+
+    @staticmethod
+    def _finish(db, name, state, result=None, error=None):
+        db.execute("UPDATE units SET state = ?, lease_until = NULL, result = ?, error = ? WHERE name = ?",
+                   (state, json.dumps(result) if result is not None else None, error, name))
+
+    def _owned(self, db, name, worker, attempt=None):
+        """
+        Return the attempts of a unit if worker holds an unexpired lease on it, else None.
+
+        attempt is the attempts returned by claim; it tells this lease from a later one of the
+        same worker.
+        """
+        row = db.execute("SELECT worker, state, attempts, lease_until FROM units WHERE name = ?",
+                         (name,)).fetchone()
+        if (row is None or row[0] != worker or row[1] != "running" or attempt not in (None, row[2]) or
+                row[3] < time.time()):
+            logger.warning("{} no longer holds {}".format(worker, name))
+            return None
+        return row[2]
+
+    def holds(self, name, worker, attempt=None):
+        """Return True if worker still holds the lease it claimed on a unit (attempt as returned by claim)."""
+        with self._transaction() as db:
+            return self._owned(db, name, worker, attempt) is not None
+
+    def renew(self, name, worker, lease=_LEASE, attempt=None):
+        """Extend the lease of a claimed unit; False if the worker lost it."""
+        with self._transaction() as db:
+            if self._owned(db, name, worker, attempt) is None:
+                return False
+            db.execute("UPDATE units SET lease_until = ? WHERE name = ?", (time.time() + lease, name))
+        return True
+
+    def complete(self, name, worker, result, attempt=None):
+        """
+        Record the JSON-serializable result of a claimed unit.
+
+        Returns:
+            False, and the result is discarded, if the lease of the worker expired or the unit
+            was claimed again since.
+        """
+        with self._transaction() as db:
+            if self._owned(db, name, worker, attempt) is None:
+                return False
+            self._finish(db, name, "done", result=result)
+        return True
+
+    def fail(self, name, worker, error, attempt=None):
+        """
+        Record the failure of a claimed unit, which is retried until it has been tried max_attempts times.
+
+        The failure is discarded if the lease of the worker expired or the unit was claimed again.
+        """
+        with self._transaction() as db:
+            attempts = self._owned(db, name, worker, attempt)
+            if attempts is None:
+                return
+            self._finish(db, name, "pending" if attempts < self.max_attempts else "failed", error=error)
 
+    def counts(self):
+        """Return the number of units in each state."""
+        with self._transaction() as db:
+            return dict(db.execute("SELECT state, COUNT(*) FROM units GROUP BY state").fetchall())
 
-def do_calibrate(object_list, master_flat, master_dark, object_name, cal_frame_dir, return_fits_objs=False):
+    def finished(self):
+        """Return True if no unit is pending or running."""
+        counts = self.counts()
+        return not counts.get("pending") and not counts.get("running")
+
+    def results(self):
+        """Return a dict unit name -> result of the units done."""
+        with self._transaction() as db:
+            return {name: json.loads(result) for name, result in db.execute(
+                "SELECT name, result FROM units WHERE state = 'done' ORDER BY seq")}
+
+
+def _encode_options(options):
+    """Return the JSON form of the run options of a Reducer, without the node-specific workers."""
+    cache = options["cache"]
+    combine = options["combine"]
+    return {
+        "mem_limit": options["mem_limit"],
+        "cache": [os.path.abspath(cache.cache_dir), cache.max_size] if cache is not None else None,
+        "engine": options["engine"],
+        "overscan": options["overscan"],
+        "combine": {kind: list(value) for kind, value in combine.items()} if combine else None,
+        "output": list(options["output"]) if options["output"] is not None else None,
+        "pipeline": list(options["pipeline"]) if options["pipeline"] is not None else None,
+        "masking": list(options["masking"]) if options["masking"] is not None else None,
+        "screen": list(options["screen"]) if options["screen"] is not None else None,
+        "stacking": list(options["stacking"]) if options["stacking"] is not None else None,
+        }
+
+
+def _decode_options(data):
+    """Return the Reducer options of their JSON form given by _encode_options."""
+    return {
+        "mem_limit": data["mem_limit"],
+        "cache": MasterCache(*data["cache"]) if data["cache"] is not None else None,
+        "engine": data["engine"],
+        "overscan": data["overscan"],
+        "combine": {kind: CombineOptions(*value) for kind, value in data["combine"].items()}
+        if data["combine"] else None,
+        "output": OutputFormat(*data["output"]) if data["output"] is not None else None,
+        "pipeline": PipelineOptions(*data["pipeline"]) if data["pipeline"] is not None else None,
+        "masking": MaskOptions(*data["masking"]) if data.get("masking") is not None else None,
+        "screen": ScreenOptions(*data["screen"]) if data.get("screen") is not None else None,
+        "stacking": StackOptions(*data["stacking"]) if data.get("stacking") is not None else None,
+        }
+
+
+def _run_unit(unit, options, workers=1, lease=None):
     """
-    Calibrate a list of images.
+    Run a unit claimed from a WorkQueue with _IN_DIR and _OUT_DIR set.
 
-    Args:
-        object_list: a list of CCDData objects containing the light frames to be calibrated
-        master_flat: a CCDData object containing the master flat
-        master_dark: a CCDData object containing the master dark
-        cal_frame_dir: a string identifying the output path for writing to disk
-        return_fits_obj=False: determine, if function should return list fits obj; set to False for memory saving
+    lease is a callable returning True while the worker still holds the unit; an object unit
+    stops writing its manifest and stack as soon as it returns False (see do_calibrate).
 
     Returns:
-        A list of the calibrated CCDData objects (if return_fits_obj=True) and a list of the file paths where they were saved.
+        the JSON-serializable result of the unit
     """
-    cal_dir = "cal_{}".format(object_name)
-    check_path = os.path.join(cal_frame_dir, cal_dir)
+    args = unit["args"]
+    anight = os.path.join(_IN_DIR, args["night"])
+    if unit["kind"] == "masters":
+        index = _make_masters(anight, args["bias"], args["dark"], args["flat"], options["mem_limit"],
+                              options["cache"], options["overscan"], options["combine"])
+        return {"masters": index.to_json()}
+    index = MasterIndex.from_json(unit["deps"][0]["value"]["masters"])
+    cal_frame_dir = _night_output_dir(anight, "cal_frames")
+    __, cal_fnames = do_calibrate(args["frames"], None, None, args["object"], cal_frame_dir, workers=workers,
+                                  engine=options["engine"], overscan=options["overscan"], index=index,
+                                  output=options["output"], pipeline=options["pipeline"], masking=options["masking"],
+                                  screen=options["screen"], stacking=options["stacking"], lease=lease)
+    return {"calibrated": len(cal_fnames)}
 
-    if not os.path.exists(check_path):
-        os.makedirs(check_path)
 
-    processed_frames, processed_fnames = [], []
+def _worker_id():
+    """Return the name of this worker process in a WorkQueue."""
+    return "{}:{}".format(socket.gethostname(), os.getpid())
 
-    # Calibration begins if directory cal_object exists and is empty
-    if not os.listdir(check_path):
-        for item in object_list:
 
-            frame = os.path.basename(item)
+def run_worker(queue, workers=1, lease=_LEASE, poll_interval=2.0, idle_timeout=None, worker_id=None):
+    """
+    Claim and run the units of a WorkQueue until none is pending or running.
+
+    The lease of the unit being run is renewed every lease/3 seconds by a background thread,
+    so only a worker that stopped (or hung) loses its unit. A worker that lost its lease, e.g.
+    after a long pause, stops writing the manifest of its object, and its result or failure is
+    discarded: only the worker currently holding a unit writes its outputs. The stages of each unit are timed
+    and returned to the coordinator with the unit's result.
 
-            logger.info("Reading object {}".format(frame))
-            # Read CCDData object
-            object_frame = ccdproc.fits_ccddata_reader(item, unit="adu")
+    Args:
+        queue: the WorkQueue, on storage shared with the coordinator
+        workers: number of worker processes calibrating the frames of one object on this node
+        lease: seconds a unit is held without renewal
+        poll_interval: seconds between claims while units wait for their dependencies
+        idle_timeout: keep polling this many seconds after the queue is finished, for units
+            queued later; None stops as soon as it is finished
+        worker_id: the name of this worker in the queue; default is hostname:pid
 
-            # Check if object frame is same size as master frames
-            if not object_frame.shape == master_dark.shape:
-                logger.warning("Skipping object calibration... Object frame is not same shape as Master frames")
+    Returns:
+        the number of units this worker completed
+    """
+    worker_id = worker_id or _worker_id()
+    in_dir, out_dir, options = queue.config()
+    _import_lazy_modules()
+    options = _decode_options(options)
+    completed = 0
+    idle_since = time.time()
+    while True:
+        unit = queue.claim(worker_id, lease)
+        if unit is None:
+            if queue.finished() and (idle_timeout is None or time.time() - idle_since >= idle_timeout):
                 break
-            else:
-                logger.info("Subtracting dark from {}".format(frame))
-                # Subtract dark from object
-                object_min_dark = ccdproc.subtract_dark(
-                    object_frame, master_dark,
-                    data_exposure=object_frame.header["exposure"] * u.second,
-                    dark_exposure=master_dark.header["exposure"] * u.second,
-                    scale=True,
-                    )
+            time.sleep(poll_interval)
+            continue
+        logger.info("{} running {} (attempt {})".format(worker_id, unit["name"], unit["attempts"]))
+        stop = threading.Event()
 
-                logger.info("Dividing {} by flat".format(frame))
-                # Divide object by flat
-                cal_object_frame = ccdproc.flat_correct(object_min_dark, master_flat)
+        def renew(name=unit["name"], attempt=unit["attempts"]):
+            while not stop.wait(lease / 3.0):
+                if not queue.renew(name, worker_id, lease, attempt):
+                    break
 
-                logger.info("Writing object {} to disk".format(frame))
-                # Write calibrated object to disk
-                out_filename = os.path.join(check_path, "cal-{}".format(frame))
-                ccdproc.fits_ccddata_writer(cal_object_frame, out_filename)
-                if return_fits_objs:
-                    processed_frames.append(cal_object_frame)
-                processed_fnames.append(out_filename)
+        heartbeat = threading.Thread(target=renew, daemon=True)
+        heartbeat.start()
+        reducer = Reducer(in_dir, out_dir, report=RunReport())
+        try:
+            with reducer._configured():
+                value = _run_unit(unit, options, workers,
+                                  lease=partial(queue.holds, unit["name"], worker_id, unit["attempts"]))
+        except Exception as err:
+            logger.exception("Unit {} failed".format(unit["name"]))
+            queue.fail(unit["name"], worker_id, "{}: {}".format(type(err).__name__, err), unit["attempts"])
+        else:
+            if queue.complete(unit["name"], worker_id, {"value": value, "stages": reducer.report.stages},
+                              unit["attempts"]):
+                completed += 1
+        finally:
+            stop.set()
+            heartbeat.join()
+        idle_since = time.time()
+    return completed
 
 
-    # processed_frames is an empty list, if return_fits_obj=False
-    # the true value should be used for the tests
-    return processed_frames, processed_fnames
+class Reducer(object):
+    """
+    Reduce the nights under in_dir into out_dir from Python, e.g. from a scheduler.
 
+    The paths and options are given explicitly. _IN_DIR, _OUT_DIR and _REPORT are set only
+    for the duration of a call and restored after, so a process runs one call at a time.
+    astropy, ccdproc and numpy are imported when pixels are first read; plan() needs none of
+    them.
 
-def do_file_list():
-    """
-    Make array of file paths in this directory and all subdirectories, recursively and filter by suffix.
-   
-    Assumes path:
-        root_path/ObservationDate/objectFolder/objectFrames
-    or
-        root_path/ObservationDate/randomName/objectFolder/objectFrames
+    >>> with Reducer("raw", "reduced", workers=8) as reducer:
+    ...     plan = reducer.plan(nights=["20170817"])
+    ...     reducer.object("20170817", "ngc4993")
+
+    Args:
+        in_dir: the root directory of the nights
+        out_dir: the directory masters and calibrated frames are written to
+        catalog: the path of the ObservationCatalog of in_dir; default is catalog.sqlite in out_dir
+        report: an optional RunReport collecting the stages of every call
+        workers, mem_limit, cache, tasks, io_tasks, engine, overscan, combine, output, pipeline, masking, screen,
+        stacking: the options of main
     """
-    file_array = np.asarray(sorted(Path(_IN_DIR).glob('**/*.*')))
 
-    file_array_len = len(file_array)
+    def __init__(self, in_dir, out_dir, catalog=None, report=None, workers=1, mem_limit=_DEFAULT_MEM_LIMIT,
+                 cache=None, tasks=1, io_tasks=None, engine="numpy", overscan=False, combine=None, output=None,
+                 pipeline=None, masking=None, screen=None, stacking=None):
+        self.in_dir = in_dir
+        self.out_dir = out_dir
+        self.catalog_path = catalog if catalog is not None else os.path.join(out_dir, "catalog.sqlite")
+        self.report = report
+        self.options = dict(workers=workers, mem_limit=mem_limit, cache=cache, tasks=tasks, io_tasks=io_tasks,
+                            engine=engine, overscan=overscan, combine=combine, output=output, pipeline=pipeline,
+                            masking=masking, screen=screen, stacking=stacking)
+        self._catalog = None
 
-    # Filters array for specified file suffix
-    suffix_search = '*.fit' # Examples: '.txt' '.py'
+    @property
+    def catalog(self):
+        """The ObservationCatalog of in_dir, opened on first use."""
+        if self._catalog is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.catalog_path)), exist_ok=True)
+            self._catalog = ObservationCatalog(self.catalog_path, self.in_dir)
+        return self._catalog
 
-    # Filter list by suffix
-    filtered_list = [file_array[x] for x in range(file_array_len) if file_array[x].match(suffix_search)]
+    def close(self):
+        """Close the catalog."""
+        if self._catalog is not None:
+            self._catalog.close()
+            self._catalog = None
 
-    file_array_len = len(filtered_list)
+    def __enter__(self):
+        return self
 
-    # Parse path to populate table
-    object_name = [filtered_list[x].parent.name for x in range(file_array_len)]
-    file_name = [filtered_list[x].name for x in range(file_array_len)]
-    observation_date = [filtered_list[x].parent.parent.name if filtered_list[x].parent.parent.name.isdigit() else filtered_list[x].parent.parent.parent.name for x in range(file_array_len)]
+    def __exit__(self, *exc_info):
+        self.close()
 
-    # Make list into Columns
-    object_name = Column(object_name)
-    file_name = Column(file_name)
-    observation_date = Column(observation_date)
+    @contextmanager
+    def _configured(self):
+        """Point _IN_DIR, _OUT_DIR and _REPORT at this reducer while a call runs."""
+        global _IN_DIR, _OUT_DIR, _REPORT
+        saved = _IN_DIR, _OUT_DIR, _REPORT
+        _IN_DIR, _OUT_DIR = self.in_dir, self.out_dir
+        if self.report is not None:
+            _REPORT = self.report
+        try:
+            yield
+        finally:
+            _IN_DIR, _OUT_DIR, _REPORT = saved
 
-    # Populate Table
-    file_table = Table([observation_date, object_name, file_name, filtered_list], names=('OBS_Date','Object','Frame','Path'))
+    def run(self, nights=None, objects=None):
+        """Reduce every night, or only the given nights and objects (directory names)."""
+        with self._configured():
+            main(catalog=self.catalog, nights=nights, objects=objects, **self.options)
 
-    # Create groups by similar observation date
-    obs_by_date = file_table.group_by('OBS_Date')
+    def night(self, night):
+        """Reduce one night, given by its directory name."""
+        self.run(nights=[night])
 
-    return obs_by_date
+    def object(self, night, obj):
+        """Calibrate one object of a night, making the night's masters if needed."""
+        self.run(nights=[night], objects=[obj])
 
+    def frame(self, path):
+        """
+        Calibrate a single light frame in_dir/<night>/<object>/<frame>, making the night's masters
+        if needed.
 
-def main():
+        Returns:
+            the path of the calibrated frame, or None if it could not be calibrated
 
-    # Fancy header
-    logger.info("Starting image redux")
+        Raises:
+            ValueError: if the frame's night has no darks and flats.
+        """
+        night, obj = Path(os.path.relpath(path, self.in_dir)).parts[:2]
+        options = self.options
+        with self._configured():
+            _import_lazy_modules()
+            self.catalog.update()
+            anight = os.path.join(self.in_dir, night)
+            bias_list, dark_list, flat_list = _calibration_lists(anight, self.catalog)
+            if not (dark_list and flat_list):
+                raise ValueError("Night {} has no darks and flats".format(night))
+            index = _make_masters(anight, bias_list, dark_list, flat_list, options["mem_limit"], options["cache"],
+                                  options["overscan"], options["combine"])
+            cal_frame_dir = _night_output_dir(anight, "cal_frames")
+            do_calibrate([path], None, None, obj, cal_frame_dir, engine=options["engine"],
+                         overscan=options["overscan"], index=index, output=options["output"],
+                         pipeline=options["pipeline"], masking=options["masking"], screen=options["screen"],
+                         stacking=options["stacking"])
+        out_filename = _cal_filename(path, os.path.join(cal_frame_dir, "cal_{}".format(obj)))
+        return out_filename if os.path.exists(out_filename) else None
 
-    nights_dirs = [os.path.join(_IN_DIR, anight)
-                   for anight in os.listdir(_IN_DIR)
-                   if os.path.isdir(os.path.join(_IN_DIR, anight))]
+    def distribute(self, queue=None, nights=None, objects=None, poll_interval=2.0, wait=True):
+        """
+        Queue the reduction as units of a WorkQueue for run_worker processes on other nodes.
 
-    for anight in nights_dirs:
-        # Create output paths
-        anight_base = os.path.basename(os.path.normpath(anight))
-
-        # Create lists
-        bias_list = glob.glob(os.path.join(anight, "bias", "*[bB]ias*.fit*"))
-        dark_list = glob.glob(os.path.join(anight, "dark", "*[dD]ark*.fit*"))
-        flat_list = glob.glob(os.path.join(anight, "flat", "*[fF]lat*.fit*"))
-
-        logger.debug("bias_list = {}".format(bias_list))
-        logger.debug("dark_list = {}".format(dark_list))
-        logger.debug("flat_list = {}".format(flat_list))
-
-        if dark_list and flat_list:
-            # Create directory to save masters
-            master_frame_dir = os.path.join(_OUT_DIR, anight_base, "master_frames")
-            logger.info("master_frame_dir = {}".format(master_frame_dir))
-            if not os.path.exists(master_frame_dir):
-                logger.info("not os.path.exists(master_frame_dir) = {}".format(not os.path.exists(master_frame_dir)))
-                os.makedirs(master_frame_dir)
-
-            # Create master calibration frames
-            master_dark, __ = do_dark_combine(dark_list, master_frame_dir)
-            master_flat, __ = do_flat_combine(flat_list, master_dark, master_frame_dir)
-
-            # Create list of object directories
-            obj_dirs = [f for f in os.listdir(anight)
-                        if os.path.isdir(os.path.join(anight, f)) and
-                        f not in ['bias', 'dark', 'flat']]
-
-            logger.debug("obj_dirs = {}".format(obj_dirs))
-            logger.debug("(Bool) dir 'master_frame_dir' exists > {}".format(os.path.exists("master_frame_dir")))
-
-            # Create directory to save calibrated objects
-            cal_frame_dir = os.path.join(_OUT_DIR, anight_base, "cal_frames")
-            logger.info("cal_frame_dir = {}".format(cal_frame_dir))
-            if not os.path.exists(cal_frame_dir):
-                 logger.debug("not os.path.exists(cal_frame_dir) = {}".format(not os.path.exists(cal_frame_dir)))
-                 os.makedirs(cal_frame_dir)
-
-            # Calibrate object frames
-            for obj in obj_dirs:
-                logger.info("obj = {}".format(obj))
-                object_list = glob.glob(os.path.join(anight, obj, "*.fit*"))
-                logger.debug("object_list = {}".format(object_list))
-                do_calibrate(object_list, master_flat, master_dark, obj, cal_frame_dir)
+        Every night gets a masters unit and every object an object unit, which runs after its
+        night's masters. Units already done with the same frames are kept, so distributing
+        again only queues new or changed work. in_dir, out_dir and the masters cache must be
+        at the same paths on every node.
+
+        Args:
+            queue: the path of the queue; default is queue.sqlite in out_dir
+            nights, objects: restrict the work to these nights and objects (see run)
+            poll_interval: seconds between progress checks while waiting
+            wait: if True, wait until every unit is done or has failed, and add the stages
+                timed by the workers to the RunReport
+
+        Returns:
+            a dict state -> number of units
+        """
+        os.makedirs(self.out_dir, exist_ok=True)
+        queue = WorkQueue(queue if queue is not None else os.path.join(self.out_dir, "queue.sqlite"))
+        queued = set()
+        with self._configured():
+            self.catalog.update()
+            queue.configure(os.path.abspath(self.in_dir), os.path.abspath(self.out_dir),
+                            _encode_options(self.options))
+            for anight in _night_dirs(self.catalog):
+                night = os.path.basename(anight)
+                if nights is not None and night not in nights:
+                    continue
+                lists = [[os.path.abspath(f) for f in frame_list]
+                         for frame_list in _calibration_lists(anight, self.catalog)]
+                if not (lists[1] and lists[2]):
+                    logger.info("Skipping directory: {}".format(anight))
+                    continue
+                masters_name = "{}:masters".format(night)
+                masters_args = dict(zip(("bias", "dark", "flat"), lists), night=night)
+                masters_queued = queue.add(masters_name, "masters", masters_args)
+                if masters_queued:
+                    queued.add(masters_name)
+                for obj in _object_dirs(anight, self.catalog):
+                    if objects is not None and obj not in objects:
+                        continue
+                    name = "{}:{}".format(night, obj)
+                    frames = [os.path.abspath(f) for f in _object_list(anight, obj, self.catalog)]
+                    # New masters mean recalibrating every object of the night
+                    if queue.add(name, "object", {"night": night, "object": obj, "frames": frames},
+                                 deps=[masters_name], force=masters_queued):
+                        queued.add(name)
+
+            counts = queue.counts()
+            logger.info("Queued units in {}: {}".format(queue.db_path, counts))
+            while wait and not queue.finished():
+                time.sleep(poll_interval)
+                if queue.counts() != counts:
+                    counts = queue.counts()
+                    logger.info("Units: {}".format(counts))
+            if wait and _REPORT is not None:
+                for name, result in queue.results().items():
+                    if name in queued:
+                        _REPORT.stages.extend(result["stages"])
+            return queue.counts()
+
+    def plan(self, nights=None, objects=None):
+        """
+        Return what run() would do, from headers, the catalog and the manifests only.
+
+        No pixels are read and nothing but the catalog is written.
+
+        Returns:
+            a list of dicts: per night, "night" and "masters", a dict kind -> {master name: number
+            of frames}, or "skipped" if it has no darks and flats; per object, "night", "object",
+            "frames" and "todo", the number of frames new or changed since last calibrated
+        """
+        steps = []
+        with self._configured():
+            self.catalog.update()
+            for anight in _night_dirs(self.catalog):
+                night = os.path.basename(anight)
+                if nights is not None and night not in nights:
+                    continue
+                calibration = dict(zip(("bias", "dark", "flat"), _calibration_lists(anight, self.catalog)))
+                if not (calibration["dark"] and calibration["flat"]):
+                    steps.append({"night": night, "skipped": True})
+                    continue
+                masters = {}
+                for kind, frame_list in calibration.items():
+                    groups = _group_frames(frame_list, kind)
+                    masters[kind] = {_master_name(kind, group, len(groups)): len(paths)
+                                     for group, (paths, __) in groups.items()}
+                steps.append({"night": night, "masters": masters})
+                for obj in _object_dirs(anight, self.catalog):
+                    if objects is not None and obj not in objects:
+                        continue
+                    object_list = _object_list(anight, obj, self.catalog)
+                    manifest = _load_manifest(os.path.join(self.out_dir, night, "cal_frames", "cal_{}".format(obj)))
+                    todo = sum(1 for item in object_list
+                               if manifest.get(os.path.basename(item), {}).get("input") != _file_identity(item))
+                    steps.append({"night": night, "object": obj, "frames": len(object_list), "todo": todo})
+        return steps
+
+
+def _format_plan(steps):
+    """Return the lines describing the steps of Reducer.plan."""
+    lines = []
+    for step in steps:
+        if step.get("skipped"):
+            lines.append("{}: skipped, no darks and flats".format(step["night"]))
+        elif "masters" in step:
+            lines.append("{}: {}".format(step["night"], ", ".join(
+                "{} ({} frames)".format(name, count)
+                for kind in ("bias", "dark", "flat") for name, count in sorted(step["masters"][kind].items()))))
         else:
-            logger.info("Skipping directory: {}".format(anight))
+            lines.append("{}/{}: {} of {} frames to calibrate".format(
+                step["night"], step["object"], step["todo"], step["frames"]))
+    return lines
 
 
 if __name__ == '__main__':
@@ -283,15 +3897,396 @@ if __name__ == '__main__':
         dest='output_path',
         )
 
+    parser.add_argument(
+        '-j', '--jobs', default=1, type=int,
+        help='Number of worker processes used to calibrate light frames. '
+             'Use 0 for all CPUs. Default is 1 (serial).',
+        metavar='N',
+        dest='jobs',
+        )
+
+    parser.add_argument(
+        '--mem-limit', default=_DEFAULT_MEM_LIMIT, type=_parse_size,
+        help='Memory ceiling for combining master frames and median stacks, e.g. 512M or 2G. Default is 1e9 bytes.',
+        metavar='SIZE',
+        dest='mem_limit',
+        )
+
+    parser.add_argument(
+        '--cache-dir', default=None,
+        help='Directory of a master frame cache shared across nights and runs. Default is no cache.',
+        metavar='DIR',
+        dest='cache_dir',
+        )
+
+    parser.add_argument(
+        '--cache-size', default='20G', type=_parse_size,
+        help='Size above which least recently used cached masters are evicted. Default is 20G.',
+        metavar='SIZE',
+        dest='cache_size',
+        )
+
+    parser.add_argument(
+        '--engine', default='numpy', choices=_ENGINES,
+        help='Calibration engine: numpy (float32, fast) or ccdproc (float64 with uncertainties). '
+             'Default is numpy.',
+        dest='engine',
+        )
+
+    parser.add_argument(
+        '--tasks', default=1, type=int,
+        help='Number of processes reducing nights and objects concurrently. '
+             'Frames within an object are then calibrated serially. Default is 1.',
+        metavar='N',
+        dest='tasks',
+        )
+
+    parser.add_argument(
+        '--io-tasks', default=None, type=int,
+        help='Maximum number of master combines running at once with --tasks. Default is no limit.',
+        metavar='N',
+        dest='io_tasks',
+        )
+
+    for kind, methods in (("bias", _COMBINE_METHODS[:-1]), ("dark", _COMBINE_METHODS[:-1]),
+                          ("flat", _COMBINE_METHODS)):
+        parser.add_argument(
+            '--{}-combine'.format(kind), default='median', choices=methods,
+            help='How {} frames are combined into a master. Default is median.'.format(kind),
+            dest='{}_combine'.format(kind),
+            )
+
+    parser.add_argument(
+        '--clip-sigma', default=3.0, type=float,
+        help='Rejection threshold in standard deviations of the sigma_clip combine. Default is 3.',
+        metavar='SIGMA',
+        dest='clip_sigma',
+        )
+
+    parser.add_argument(
+        '--clip-extrema', default=1, type=int,
+        help='Number of lowest and of highest values rejected per pixel by the minmax combine. Default is 1.',
+        metavar='N',
+        dest='clip_extrema',
+        )
+
+    parser.add_argument(
+        '--overscan', action='store_true',
+        help='Subtract the overscan and trim every frame as given by its BIASSEC and TRIMSEC headers.',
+        dest='overscan',
+        )
+
+    parser.add_argument(
+        '--readers', default=PipelineOptions().readers, type=int,
+        help='Threads reading light frames ahead of a serial calibration. Default is 2.',
+        metavar='N',
+        dest='readers',
+        )
+
+    parser.add_argument(
+        '--prefetch', default=PipelineOptions().prefetch, type=int,
+        help='Maximum number of light frames read ahead of a serial calibration. Default is 4.',
+        metavar='N',
+        dest='prefetch',
+        )
+
+    parser.add_argument(
+        '--writers', default=PipelineOptions().writers, type=int,
+        help='Threads writing calibrated frames in a serial calibration. Default is 1.',
+        metavar='N',
+        dest='writers',
+        )
+
+    parser.add_argument(
+        '--output-dtype', default=None, choices=('float32', 'float64'),
+        help='Data type of the calibrated frames. Default is float32 for the numpy engine, float64 for ccdproc.',
+        dest='output_dtype',
+        )
+
+    parser.add_argument(
+        '--compress', default=None, choices=sorted(_COMPRESSIONS),
+        help='Tile-compress the calibrated frames. Default is uncompressed.',
+        dest='compress',
+        )
+
+    parser.add_argument(
+        '--quantize-level', default=16.0, type=float,
+        help='Quantization of compressed frames, in fractions of the noise; higher keeps more precision. '
+             'Use 0 with gzip for lossless compression. Default is 16.',
+        metavar='Q',
+        dest='quantize_level',
+        )
+
+    parser.add_argument(
+        '--no-extensions', action='store_false',
+        help='Write the calibrated frames without their mask and uncertainty extensions.',
+        dest='extensions',
+        )
+
+    parser.add_argument(
+        '--mask-bad-pixels', action='store_true',
+        help='Mask the hot pixels of the master dark and the bad pixels of the master flat in every frame.',
+        dest='bad_pixels',
+        )
+
+    parser.add_argument(
+        '--hot-sigma', default=MaskOptions().hot_sigma, type=float,
+        help='Threshold of hot pixels in robust standard deviations above the median of the master dark. '
+             'Default is 5.',
+        metavar='SIGMA',
+        dest='hot_sigma',
+        )
+
+    parser.add_argument(
+        '--flat-limits', default=(MaskOptions().low_flat, MaskOptions().high_flat), type=float, nargs=2,
+        help='Range of good pixels of the master flat normalized to its median. Default is 0.5 1.5.',
+        metavar=('LOW', 'HIGH'),
+        dest='flat_limits',
+        )
+
+    parser.add_argument(
+        '--reject-cosmic-rays', action='store_true',
+        help='Mask cosmic-ray hits and replace them by the median of their neighbours before writing each frame.',
+        dest='cosmic_rays',
+        )
+
+    parser.add_argument(
+        '--cr-sigma', default=MaskOptions().cr_sigma, type=float,
+        help='Cosmic-ray detection threshold in standard deviations of the noise. Default is 5.',
+        metavar='SIGMA',
+        dest='cr_sigma',
+        )
+
+    parser.add_argument(
+        '--cr-contrast', default=MaskOptions().cr_contrast, type=float,
+        help='Minimum contrast of cosmic rays against the fine structure of the frame. Default is 2.',
+        metavar='RATIO',
+        dest='cr_contrast',
+        )
+
+    parser.add_argument(
+        '--cr-tile-size', default=MaskOptions().tile_size, type=int,
+        help='Side in pixels of the tiles cosmic rays are detected in. Default is 512.',
+        metavar='N',
+        dest='cr_tile_size',
+        )
+
+    parser.add_argument(
+        '--cr-threads', default=MaskOptions().threads, type=int,
+        help='Threads detecting cosmic rays in the tiles of a frame. Default is 1.',
+        metavar='N',
+        dest='cr_threads',
+        )
+
+    parser.add_argument(
+        '--screen', action='store_true',
+        help='Skip light frames that are saturated, out of --min-level/--max-level or have too few stars, '
+             'measured on a subsample of the raw frame, and list them in rejected.csv.',
+        dest='screen',
+        )
+
+    parser.add_argument(
+        '--screen-step', default=ScreenOptions().step, type=int,
+        help='Subsampling step in rows and columns of the quality pre-screen. Default is 4.',
+        metavar='N',
+        dest='screen_step',
+        )
+
+    parser.add_argument(
+        '--saturation', default=ScreenOptions().saturation, type=float,
+        help='Level in ADU of saturated pixels. Default is 60000.',
+        metavar='ADU',
+        dest='saturation',
+        )
+
+    parser.add_argument(
+        '--max-saturated', default=ScreenOptions().max_saturated, type=float,
+        help='Largest fraction of saturated pixels of a good frame. Default is 0.01.',
+        metavar='FRACTION',
+        dest='max_saturated',
+        )
+
+    parser.add_argument(
+        '--min-level', default=None, type=float,
+        help='Lowest median level in ADU of a good raw frame. Default is no limit.',
+        metavar='ADU',
+        dest='min_level',
+        )
+
+    parser.add_argument(
+        '--max-level', default=None, type=float,
+        help='Highest median level in ADU of a good raw frame, e.g. to reject twilight or cloudy frames. '
+             'Default is no limit.',
+        metavar='ADU',
+        dest='max_level',
+        )
+
+    parser.add_argument(
+        '--min-stars', default=ScreenOptions().min_stars, type=int,
+        help='Fewest stars of a good frame, counted on the subsample. Default is 5.',
+        metavar='N',
+        dest='min_stars',
+        )
+
+    parser.add_argument(
+        '--stack', action='store_true',
+        help='Co-add the calibrated frames of each object into stack-<object>.fit while they are calibrated, '
+             'aligned on the first frame.',
+        dest='stack',
+        )
+
+    parser.add_argument(
+        '--stack-method', default=StackOptions().method, choices=_STACK_METHODS,
+        help='Stack method: a running mean, or the median of the frames spilled to disk (memory capped by '
+             '--mem-limit). Default is mean.',
+        dest='stack_method',
+        )
+
+    parser.add_argument(
+        '--stack-region', default=StackOptions().region, type=int,
+        help='Side in pixels of the central region the frame offsets are measured on. Default is 512.',
+        metavar='PIXELS',
+        dest='stack_region',
+        )
+
+    parser.add_argument(
+        '--catalog', default=None,
+        help='SQLite index of the input frames used to plan the run. Default is catalog.sqlite in the output path.',
+        metavar='FILE',
+        dest='catalog',
+        )
+
+    parser.add_argument(
+        '--night', action='append', default=None,
+        help='Reduce only this night directory. Can be given more than once. Default is every night.',
+        metavar='NIGHT',
+        dest='nights',
+        )
+
+    parser.add_argument(
+        '--object', action='append', default=None,
+        help='Calibrate only this object directory. Can be given more than once. Default is every object.',
+        metavar='OBJECT',
+        dest='objects',
+        )
+
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Print the masters and frames a run would process, without reading any pixels, and exit.',
+        dest='dry_run',
+        )
+
+    parser.add_argument(
+        '--distribute', action='store_true',
+        help='Queue the nights and objects as units for --worker processes, and wait until they are done.',
+        dest='distribute',
+        )
+
+    parser.add_argument(
+        '--worker', action='store_true',
+        help='Run the units of the --queue until none is left. Paths and options come from the queue.',
+        dest='worker',
+        )
+
+    parser.add_argument(
+        '--queue', default=None,
+        help='SQLite work queue on shared storage for --distribute and --worker. '
+             'Default is queue.sqlite in the output path.',
+        metavar='FILE',
+        dest='queue',
+        )
+
+    parser.add_argument(
+        '--lease', default=_LEASE, type=float,
+        help='Seconds a worker holds a unit without renewing it before other workers may take it over. '
+             'Default is 300.',
+        metavar='SEC',
+        dest='lease',
+        )
+
+    parser.add_argument(
+        '--profile', action='store_true',
+        help="Run each stage under cProfile and dump the stats to a 'profiles' dir in the output path.",
+        dest='profile',
+        )
+
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='Keep watching the input directory and calibrate frames as they are written.',
+        dest='watch',
+        )
+
+    parser.add_argument(
+        '--poll-interval', default=2.0, type=float,
+        help='Seconds between directory scans in watch mode. Default is 2.',
+        metavar='SEC',
+        dest='poll_interval',
+        )
+
+    parser.add_argument(
+        '--settle-time', default=5.0, type=float,
+        help='Seconds a file size must stay unchanged before it is processed in watch mode. Default is 5.',
+        metavar='SEC',
+        dest='settle_time',
+        )
+
+    parser.add_argument(
+        '--idle-timeout', default=None, type=float,
+        help='Stop watch mode after this many seconds without new frames. Default is to watch forever.',
+        metavar='SEC',
+        dest='idle_timeout',
+        )
+
     args = parser.parse_args()
     _OUT_DIR = args.output_path
     _IN_DIR = args.input_path
+    log_name = "redux.log"
+
+    if args.worker:
+        if args.queue is None:
+            parser.error("--worker needs the --queue of the coordinator")
+        queue = WorkQueue(args.queue)
+        _IN_DIR, _OUT_DIR, __ = queue.config()
+        log_name = "redux-{}.log".format(_worker_id().replace(":", "-"))
 
+    cache = MasterCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+
+    combine = {kind: CombineOptions(getattr(args, "{}_combine".format(kind)), args.clip_sigma, args.clip_extrema,
+                                    args.clip_extrema)
+               for kind in ("bias", "dark", "flat")}
+
+    output = OutputFormat(args.output_dtype, args.compress, args.quantize_level, args.extensions)
+    if output == OutputFormat():
+        output = None
+    pipeline = PipelineOptions(args.readers, args.prefetch, args.writers)
+    masking = None
+    if args.bad_pixels or args.cosmic_rays:
+        masking = MaskOptions(args.bad_pixels, args.cosmic_rays, args.hot_sigma, args.flat_limits[0],
+                              args.flat_limits[1], args.cr_sigma, args.cr_contrast, args.cr_tile_size,
+                              args.cr_threads)
+    screen = None
+    if args.screen:
+        screen = ScreenOptions(args.screen_step, args.saturation, args.max_saturated, args.min_level, args.max_level,
+                               args.min_stars)
+    stacking = None
+    if args.stack:
+        stacking = StackOptions(args.stack_method, args.stack_region, args.mem_limit)
+
+    reducer = Reducer(_IN_DIR, _OUT_DIR, catalog=args.catalog, workers=args.jobs, mem_limit=args.mem_limit,
+                      cache=cache, tasks=args.tasks, io_tasks=args.io_tasks, engine=args.engine,
+                      overscan=args.overscan, combine=combine, output=output, pipeline=pipeline, masking=masking,
+                      screen=screen, stacking=stacking)
+
+    if args.dry_run:
+        # Leave redux.log of the last run alone
+        with reducer:
+            print("\n".join(_format_plan(reducer.plan(args.nights, args.objects))))
+        sys.exit(0)
 
     logger.setLevel(logging.DEBUG)
 
     # create a file handler and set level to debug
-    fh = logging.FileHandler(os.path.join(_OUT_DIR, "redux.log"), mode='w')
+    fh = logging.FileHandler(os.path.join(_OUT_DIR, log_name), mode='w')
     fh.setLevel(logging.DEBUG)
 
     # create formatter and add it to the logger
@@ -308,6 +4303,28 @@ if __name__ == '__main__':
     logger.debug("_OUT_DIR = {}".format(_OUT_DIR))
     logger.debug("_IN_DIR =ls {}".format(_IN_DIR))
 
-    main()
+    _REPORT = RunReport(os.path.join(_OUT_DIR, "profiles") if args.profile else None)
+
+    if args.worker:
+        completed = run_worker(queue, workers=args.jobs, lease=args.lease, poll_interval=args.poll_interval,
+                               idle_timeout=args.idle_timeout)
+        logger.info("Worker completed {} units".format(completed))
+        sys.exit(0)
+
+    if args.watch:
+        watch(workers=args.jobs, mem_limit=args.mem_limit, cache=cache, engine=args.engine,
+              poll_interval=args.poll_interval, settle_time=args.settle_time,
+              idle_timeout=args.idle_timeout, overscan=args.overscan, combine=combine, output=output,
+              pipeline=pipeline, masking=masking, screen=screen, stacking=stacking)
+    elif args.distribute:
+        with reducer:
+            counts = reducer.distribute(args.queue, args.nights, args.objects, args.poll_interval)
+        logger.info("Units: {}".format(counts))
+    else:
+        with reducer:
+            reducer.run(args.nights, args.objects)
+
+    # Write the run report next to redux.log
+    _REPORT.write(os.path.join(_OUT_DIR, "run_report.json"))
 
     logger.info("Image redux complete")
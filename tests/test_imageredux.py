@@ -1,10 +1,16 @@
 import sys
 import os
+import json
+import pickle
+import subprocess
+import time
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 import imageredux as redux
 import unittest
+from unittest import mock
 from astropy.io import fits
 import ccdproc
+import numpy
 from numpy.random import normal
 
 
@@ -46,6 +52,15 @@ class TestCombinations(unittest.TestCase):
         # Test if darkmaster file has correct shape
         self.assertEqual(fits.getdata(dark_fname).shape, (self.nrows, self.ncols))
 
+    def test_do_bias_combine(self):
+        biasmaster, bias_fname = redux.do_bias_combine(self.ccds, self.out_dir)
+        self.assertTrue(isinstance(biasmaster, ccdproc.CCDData))
+        self.assertEqual(biasmaster.shape, (self.nrows, self.ncols))
+        self.assertEqual(fits.getdata(bias_fname).shape, (self.nrows, self.ncols))
+        # The master dark is bias-subtracted
+        darkmaster, __ = redux.do_dark_combine(self.ccds, self.out_dir, master_bias=biasmaster)
+        numpy.testing.assert_allclose(darkmaster.data, 0.0)
+
     def test_do_flat_combine(self):
         dark_master = ccdproc.CCDData(
             normal(loc=100, scale=5, size=(self.nrows, self.ncols)),
@@ -66,6 +81,189 @@ class TestCombinations(unittest.TestCase):
         self.assertEqual(fits.getdata(flat_fname).shape, (self.nrows, self.ncols))
 
 
+class TestTiledCombine(unittest.TestCase):
+    def setUp(self):
+        self.num_test_files = 5
+        self.nrows = 37
+        self.ncols = 23
+        self.in_dir = "inputs"
+        self.out_dir = "outputs"
+        for adir in (self.in_dir, self.out_dir):
+            if not os.path.exists(adir):
+                os.makedirs(adir)
+        self.fnames = []
+        for i in range(self.num_test_files):
+            hdu = fits.PrimaryHDU(
+                normal(loc=100, scale=5, size=(self.nrows, self.ncols)),
+                )
+            hdu.header['exposure'] = 60.0
+            fname = os.path.join(self.in_dir, "frame_{:02d}.fits".format(i))
+            hdu.writeto(fname)
+            self.fnames.append(fname)
+        # Small enough to force one row per block
+        self.mem_limit = 1
+
+    def tearDown(self):
+        import shutil
+        for adir in (self.in_dir, self.out_dir):
+            if os.path.exists(adir):
+                shutil.rmtree(adir)
+
+    def assertSameCCD(self, ccd, expected):
+        self.assertTrue((ccd.data == expected.data).all())
+        self.assertTrue((ccd.mask == expected.mask).all())
+        self.assertTrue((ccd.uncertainty.array == expected.uncertainty.array).all())
+
+    def test_tiled_dark_combine(self):
+        expected = ccdproc.combine(self.fnames, method="median", unit="adu")
+        darkmaster, dark_fname = redux.do_dark_combine(
+            self.fnames, self.out_dir, self.mem_limit,
+            )
+        # Test if tiled result is bit-identical to the in-memory combine
+        self.assertSameCCD(darkmaster, expected)
+        self.assertSameCCD(ccdproc.fits_ccddata_reader(dark_fname), expected)
+
+    def test_tiled_combine_uint16(self):
+        fnames = []
+        for i in range(self.num_test_files):
+            data = normal(loc=1000, scale=5, size=(self.nrows, self.ncols))
+            # Written as BITPIX=16 with BZERO=32768
+            fname = os.path.join(self.in_dir, "raw_{:02d}.fits".format(i))
+            fits.PrimaryHDU(data.astype(numpy.uint16)).writeto(fname)
+            fnames.append(fname)
+        self.assertEqual(fits.getheader(fnames[0])["BZERO"], 32768)
+        expected = ccdproc.combine(fnames, method="median", unit="adu")
+        darkmaster, __ = redux.do_dark_combine(fnames, self.out_dir, self.mem_limit)
+        self.assertSameCCD(darkmaster, expected)
+
+    def test_tiled_flat_combine(self):
+        dark_master = ccdproc.CCDData(
+            normal(loc=10, scale=1, size=(self.nrows, self.ncols)),
+            unit='adu',
+            )
+        dark_master.header = {'exposure': 30.0}
+        ccds = [ccdproc.fits_ccddata_reader(f, unit="adu") for f in self.fnames]
+        expected, __ = redux.do_flat_combine(ccds, dark_master, self.in_dir)
+        flatmaster, __ = redux.do_flat_combine(
+            self.fnames, dark_master, self.out_dir, self.mem_limit,
+            )
+        # Test if tiled result is bit-identical to the in-memory combine
+        self.assertSameCCD(flatmaster, expected)
+
+    def test_combine_methods(self):
+        # A frame with a hot pixel for the rejection methods
+        with fits.open(self.fnames[0], mode="update") as hdul:
+            hdul[0].data[3, 4] = 1e5
+        ccds = [ccdproc.fits_ccddata_reader(f, unit="adu") for f in self.fnames]
+        for method in redux._COMBINE_METHODS:
+            combine = redux.CombineOptions(method, sigma=2.0)
+            expected = redux._combine_in_memory(ccds, combine)
+            out_dir = os.path.join(self.out_dir, method)
+            os.makedirs(out_dir)
+            darkmaster, __ = redux.do_dark_combine(self.fnames, out_dir, self.mem_limit, combine=combine)
+            # Running sums match ccdproc.combine to rounding
+            numpy.testing.assert_allclose(darkmaster.data, expected.data, rtol=1e-12)
+            numpy.testing.assert_allclose(darkmaster.uncertainty.array, expected.uncertainty.array, rtol=1e-12)
+            self.assertTrue((darkmaster.mask == expected.mask).all())
+            if method in ("median", "sigma_clip", "minmax"):
+                self.assertLess(darkmaster.data[3, 4], 200)
+            else:
+                self.assertGreater(darkmaster.data[3, 4], 200)
+
+    def test_weighted_flat_combine(self):
+        # Twilight flats of the same pattern at very different levels
+        pattern = 1.0 + 0.1 * numpy.random.RandomState(0).random_sample((self.nrows, self.ncols))
+        fnames = []
+        for i, level in enumerate((1000.0, 4000.0, 16000.0)):
+            fname = os.path.join(self.in_dir, "flat_{:02d}.fits".format(i))
+            hdu = fits.PrimaryHDU(level * pattern)
+            hdu.header['exposure'] = 30.0
+            hdu.writeto(fname)
+            fnames.append(fname)
+        dark_master = ccdproc.CCDData(numpy.zeros((self.nrows, self.ncols)), unit='adu')
+        dark_master.header = {'exposure': 30.0}
+        flatmaster, __ = redux.do_flat_combine(fnames, dark_master, self.out_dir, self.mem_limit,
+                                               combine=redux.CombineOptions("weighted"))
+        # Frames are scaled to their mean level, so the pattern is preserved
+        numpy.testing.assert_allclose(flatmaster.data / flatmaster.data.mean(), pattern / pattern.mean())
+        self.assertAlmostEqual(flatmaster.data.mean() / pattern.mean(), 7000.0, delta=10.0)
+
+
+class TestMasterCache(unittest.TestCase):
+    def setUp(self):
+        self.nrows = 10
+        self.ncols = 10
+        self.in_dir = "inputs"
+        self.out_dir = "outputs"
+        self.cache_dir = os.path.join(self.out_dir, "cache")
+        for adir in (self.in_dir, self.out_dir):
+            if not os.path.exists(adir):
+                os.makedirs(adir)
+        self.fnames = [self._write_dark(i) for i in range(3)]
+
+    def tearDown(self):
+        import shutil
+        for adir in (self.in_dir, self.out_dir):
+            if os.path.exists(adir):
+                shutil.rmtree(adir)
+
+    def _write_dark(self, i):
+        hdu = fits.PrimaryHDU(normal(loc=100, scale=5, size=(self.nrows, self.ncols)))
+        hdu.header['exposure'] = 60.0
+        fname = os.path.join(self.in_dir, "dark_{:02d}.fits".format(i))
+        hdu.writeto(fname)
+        return fname
+
+    def test_reuse_across_nights(self):
+        cache = redux.MasterCache(self.cache_dir)
+        night1 = os.path.join(self.out_dir, "night1")
+        night2 = os.path.join(self.out_dir, "night2")
+        os.makedirs(night1)
+        os.makedirs(night2)
+        master1, __ = redux.do_dark_combine(self.fnames, night1, cache=cache)
+        with mock.patch.object(redux, "_tiled_combine") as combine:
+            master2, fname2 = redux.do_dark_combine(self.fnames, night2, cache=cache)
+        # Test if the second night reused the cached master
+        self.assertFalse(combine.called)
+        self.assertTrue(os.path.exists(fname2))
+        self.assertTrue((master1.data == master2.data).all())
+
+    def test_recombine_on_new_input(self):
+        master1, fname = redux.do_dark_combine(self.fnames, self.out_dir)
+        with mock.patch.object(redux, "_tiled_combine") as combine:
+            redux.do_dark_combine(self.fnames, self.out_dir)
+        # Test if an unchanged master is reused
+        self.assertFalse(combine.called)
+        self.fnames.append(self._write_dark(3))
+        master2, __ = redux.do_dark_combine(self.fnames, self.out_dir)
+        # Test if a new dark triggers a recombine
+        self.assertNotEqual(master1.header["REDUXKEY"], master2.header["REDUXKEY"])
+        self.assertEqual(fits.getheader(fname)["REDUXKEY"], master2.header["REDUXKEY"])
+
+    def test_eviction(self):
+        redux.do_dark_combine(self.fnames, self.out_dir, cache=redux.MasterCache(self.cache_dir))
+        size = os.path.getsize(os.path.join(self.out_dir, "master-dark.fit"))
+        cache = redux.MasterCache(self.cache_dir, max_size=size)
+        self.fnames.append(self._write_dark(3))
+        __, fname = redux.do_dark_combine(self.fnames, self.out_dir, cache=cache)
+        # Test if only the most recent master is kept
+        cached = [f for f in os.listdir(self.cache_dir) if f.endswith(".fit")]
+        self.assertEqual(cached, ["{}.fit".format(fits.getheader(fname)["REDUXKEY"])])
+
+    def test_concurrent_puts(self):
+        # Test if processes putting masters at once lose no index entry
+        script = ("import sys; sys.path.insert(0, {!r}); import imageredux; "
+                  "cache = imageredux.MasterCache({!r}); "
+                  "[cache.put('{{}}-{{}}'.format(sys.argv[1], i), {!r}) for i in range(25)]").format(
+                      os.path.dirname(os.path.abspath(redux.__file__)), self.cache_dir, self.fnames[0])
+        workers = [subprocess.Popen([sys.executable, "-c", script, str(i)]) for i in range(8)]
+        for worker in workers:
+            self.assertEqual(worker.wait(timeout=120), 0)
+        index = redux.MasterCache(self.cache_dir)._load_index()
+        self.assertEqual(len(index), 8 * 25)
+        self.assertEqual(len([f for f in os.listdir(self.cache_dir) if f.endswith(".fit")]), 8 * 25)
+
+
 class TestCalibrate(unittest.TestCase):
     def setUp(self):
         self.num_test_files = 3
@@ -124,6 +322,608 @@ class TestCalibrate(unittest.TestCase):
             # Test if file has correct shape
             self.assertEqual(fits.getdata(afile).shape, (self.nrows, self.ncols))
 
+    def _make_masters(self):
+        dark_master = ccdproc.CCDData(
+            normal(loc=100, scale=5, size=(self.nrows, self.ncols)),
+            unit='adu',
+            )
+        dark_master.header = {'exposure': 60.0}
+        flat_master = ccdproc.CCDData(
+            normal(loc=100, scale=5, size=(self.nrows, self.ncols)),
+            unit='adu',
+            )
+        flat_master.header = {'exposure': 60.0}
+        return flat_master, dark_master
+
+    def test_do_calibrate_workers(self):
+        flat_master, dark_master = self._make_masters()
+        serial_ccds, serial_fnames = redux.do_calibrate(
+            self.ccds, flat_master, dark_master, "serial", self.out_dir, True
+            )
+        cal_ccds, cal_fnames = redux.do_calibrate(
+            self.ccds, flat_master, dark_master, self.obj_name, self.out_dir, True,
+            workers=2,
+            )
+        # Test if output order follows the input order
+        self.assertEqual(
+            [os.path.basename(f) for f in cal_fnames],
+            ["cal-{}".format(os.path.basename(f)) for f in self.ccds],
+            )
+        # Test if results match the serial path
+        for acal, aserial in zip(cal_ccds, serial_ccds):
+            self.assertTrue((acal.data == aserial.data).all())
+
+    def test_do_calibrate_bad_frame(self):
+        flat_master, dark_master = self._make_masters()
+        bad_fname = os.path.join(self.in_dir, "{}_bad.fits".format(self.obj_name))
+        fits.PrimaryHDU(data=normal(size=(self.nrows + 1, self.ncols))).writeto(bad_fname)
+        object_list = [bad_fname] + self.ccds
+        for workers in (1, 2):
+            __, cal_fnames = redux.do_calibrate(
+                object_list, flat_master, dark_master,
+                "{}_{}".format(self.obj_name, workers), self.out_dir,
+                workers=workers,
+                )
+            # Test if the bad frame is skipped and the rest are calibrated
+            self.assertEqual(len(cal_fnames), self.num_test_files)
+
+    def test_numpy_engine_accuracy(self):
+        flat_master, dark_master = self._make_masters()
+        dark_master.header['exposure'] = 30.0
+        expected, __ = redux.do_calibrate(
+            self.ccds, flat_master, dark_master, "ccdproc", self.out_dir, True,
+            engine="ccdproc",
+            )
+        cal_ccds, __ = redux.do_calibrate(
+            self.ccds, flat_master, dark_master, self.obj_name, self.out_dir, True,
+            engine="numpy",
+            )
+        # Test if the numpy kernel matches the ccdproc path to float32 precision
+        for acal, aexpected in zip(cal_ccds, expected):
+            self.assertEqual(acal.data.dtype, numpy.float32)
+            numpy.testing.assert_allclose(acal.data, aexpected.data, rtol=1e-5)
+
+    def test_planned_rejections(self):
+        flat_master, dark_master = self._make_masters()
+        bad_fname = os.path.join(self.in_dir, "{}_bad.fits".format(self.obj_name))
+        fits.PrimaryHDU(data=normal(size=(self.nrows + 1, self.ncols))).writeto(bad_fname)
+        noexp_fname = os.path.join(self.in_dir, "{}_noexp.fits".format(self.obj_name))
+        fits.PrimaryHDU(data=normal(size=(self.nrows, self.ncols))).writeto(noexp_fname)
+        with mock.patch.object(redux, "_read_object", wraps=redux._read_object) as read_object:
+            __, cal_fnames = redux.do_calibrate(
+                [bad_fname] + self.ccds + [noexp_fname], flat_master, dark_master, self.obj_name, self.out_dir,
+                )
+        # Test if the frames of the wrong shape or without exposure are skipped from their
+        # headers, before any pixels are read
+        self.assertEqual([call[0][0] for call in read_object.call_args_list], self.ccds)
+        self.assertEqual(len(cal_fnames), self.num_test_files)
+
+    def test_numpy_engine_uint16(self):
+        flat_master, dark_master = self._make_masters()
+        raw_fnames = []
+        for i in range(self.num_test_files):
+            hdu = fits.PrimaryHDU(normal(loc=1000, scale=5, size=(self.nrows, self.ncols)).astype(numpy.uint16))
+            if i == 1:
+                # Scaled 16-bit integers, and blank pixels
+                hdu.scale("int16", bscale=0.5, bzero=1000.0)
+                hdu.header['BLANK'] = -32768
+                hdu.data[0, 0] = -32768
+            elif i == 2:
+                hdu.scale("int16", bscale=0.25, bzero=900.0)
+            hdu.header['EXPOSURE'] = 30.0
+            fname = os.path.join(self.in_dir, "raw_{:02d}.fits".format(i))
+            hdu.writeto(fname)
+            raw_fnames.append(fname)
+        expected, __ = redux.do_calibrate(
+            raw_fnames, flat_master, dark_master, "ccdproc", self.out_dir, True,
+            engine="ccdproc",
+            )
+        __, cal_fnames = redux.do_calibrate(
+            raw_fnames, flat_master, dark_master, self.obj_name, self.out_dir,
+            )
+        for afile, aexpected in zip(cal_fnames, expected):
+            header = fits.getheader(afile)
+            # Test if output is written unscaled in float32
+            self.assertEqual(header["BITPIX"], -32)
+            self.assertNotIn("BZERO", header)
+            self.assertNotIn("BSCALE", header)
+            numpy.testing.assert_allclose(fits.getdata(afile), aexpected.data, rtol=1e-5)
+        # Test if the raw frames are read memory-mapped and unscaled, and blank pixels are NaN
+        raw = redux._read_object(raw_fnames[2])
+        self.assertEqual(raw.data.dtype, numpy.dtype(">i2"))
+        import mmap
+        base = raw.data
+        while isinstance(base, numpy.ndarray):
+            base = base.base
+        self.assertIsInstance(base, mmap.mmap)
+        self.assertTrue(numpy.isnan(fits.getdata(cal_fnames[1])[0, 0]))
+
+    def test_scan_header(self):
+        hdu = fits.PrimaryHDU(numpy.zeros((self.nrows, self.ncols + 4), dtype=numpy.uint16))
+        hdu.header['EXPOSURE'] = 30
+        hdu.header['IMAGETYP'] = "Light Frame"
+        hdu.header['FILTER'] = "O'III"
+        hdu.header['XBINNING'] = 2
+        hdu.header['BIASSEC'] = "[11:14,1:10]"
+        hdu.header['TRIMSEC'] = "[2:9,1:10]"
+        hdu.header['COMMENT'] = "EXPOSURE = 1"
+        fname = os.path.join(self.in_dir, "header.fits")
+        hdu.writeto(fname)
+        # Test if the header is parsed as astropy does
+        info = redux.scan_header(fname)
+        self.assertEqual(info.exposure, 30)
+        self.assertEqual(info.shape, (self.nrows, self.ncols + 4))
+        self.assertEqual((info.imagetyp, info.filter, info.binning), ("Light Frame", "O'III", (1, 2)))
+        self.assertEqual(info.trimmed_shape, (10, 8))
+        from ccdproc.utils.slices import slice_from_string
+        for section in ("[11:14,1:10]", "[2:9,1:10]"):
+            self.assertEqual(redux._fits_section(section), slice_from_string(section, fits_convention=True))
+
+    def test_do_calibrate_resume(self):
+        flat_master, dark_master = self._make_masters()
+        __, cal_fnames = redux.do_calibrate(
+            self.ccds, flat_master, dark_master, self.obj_name, self.out_dir,
+            )
+        self.assertEqual(len(cal_fnames), self.num_test_files)
+        # Test if a rerun without changes does nothing
+        __, cal_fnames = redux.do_calibrate(
+            self.ccds, flat_master, dark_master, self.obj_name, self.out_dir,
+            )
+        self.assertEqual(cal_fnames, [])
+        # Test if only new and changed frames are calibrated
+        new_fname = os.path.join(self.in_dir, "{}_new.fits".format(self.obj_name))
+        new_hdu = fits.PrimaryHDU(data=normal(size=(self.nrows, self.ncols)))
+        new_hdu.header['EXPOSURE'] = 60.0
+        new_hdu.writeto(new_fname)
+        fits.setval(self.ccds[0], 'OBSERVER', value='test')
+        __, cal_fnames = redux.do_calibrate(
+            self.ccds + [new_fname], flat_master, dark_master, self.obj_name, self.out_dir,
+            )
+        self.assertEqual(
+            [os.path.basename(f) for f in cal_fnames],
+            ["cal-" + os.path.basename(self.ccds[0]), "cal-" + os.path.basename(new_fname)],
+            )
+        # Test if a missing output is calibrated again
+        os.remove(cal_fnames[0])
+        __, cal_fnames = redux.do_calibrate(
+            self.ccds + [new_fname], flat_master, dark_master, self.obj_name, self.out_dir,
+            )
+        self.assertEqual(len(cal_fnames), 1)
+        # Test if all frames are redone when a master changes
+        dark_master.header['REDUXKEY'] = 'changed'
+        __, cal_fnames = redux.do_calibrate(
+            self.ccds + [new_fname], flat_master, dark_master, self.obj_name, self.out_dir,
+            )
+        self.assertEqual(len(cal_fnames), self.num_test_files + 1)
+
+    def test_do_calibrate_lost_lease(self):
+        flat_master, dark_master = self._make_masters()
+        leases = iter([True, False])
+        # Test if the manifest is no longer written once the lease is lost
+        with self.assertRaises(RuntimeError):
+            redux.do_calibrate(
+                self.ccds, flat_master, dark_master, self.obj_name, self.out_dir,
+                lease=lambda: next(leases),
+                )
+        manifest = redux._load_manifest(os.path.join(self.out_dir, "cal_" + self.obj_name))
+        self.assertEqual(list(manifest), [os.path.basename(self.ccds[0])])
+
+    def test_output_formats(self):
+        flat_master, dark_master = self._make_masters()
+        expected, __ = redux.do_calibrate(
+            self.ccds, flat_master, dark_master, "plain", self.out_dir, True,
+            engine="ccdproc",
+            )
+        # Test if Rice-compressed float32 frames stay within the quantization error
+        rice = redux.OutputFormat("float32", "rice", 16.0)
+        __, cal_fnames = redux.do_calibrate(
+            self.ccds, flat_master, dark_master, "rice", self.out_dir,
+            engine="ccdproc", output=rice,
+            )
+        for afile, aexpected in zip(cal_fnames, expected):
+            data = fits.getdata(afile)
+            self.assertEqual(data.dtype, numpy.float32)
+            # Each tile is quantized to 1/16 of its own noise estimate
+            numpy.testing.assert_allclose(data, aexpected.data, atol=numpy.std(aexpected.data) / 4.0)
+        # Test if the mask and uncertainty extensions are compressed too and read back by ccdproc
+        mask = numpy.zeros((self.nrows, self.ncols), dtype=bool)
+        mask[2, 3] = True
+        uncertainty = numpy.full((self.nrows, self.ncols), 2.0)
+        fname = os.path.join(self.out_dir, "extensions.fits")
+        redux._write_frame(fname, expected[0].data, fits.Header(), mask, uncertainty, rice)
+        ccd = ccdproc.fits_ccddata_reader(fname, hdu=1)
+        numpy.testing.assert_array_equal(ccd.mask, mask)
+        numpy.testing.assert_allclose(ccd.uncertainty.array, uncertainty, rtol=1e-3)
+        # Test if gzip with quantize_level=0 is lossless and extensions can be skipped
+        gzip = redux.OutputFormat(None, "gzip", 0, extensions=False)
+        __, cal_fnames = redux.do_calibrate(
+            self.ccds, flat_master, dark_master, "gzip", self.out_dir,
+            engine="ccdproc", output=gzip,
+            )
+        for afile, aexpected in zip(cal_fnames, expected):
+            with fits.open(afile) as hdul:
+                self.assertEqual(len(hdul), 2)
+                numpy.testing.assert_array_equal(hdul[1].data, aexpected.data)
+        with self.assertRaises(ValueError):
+            redux._write_frame(os.path.join(self.out_dir, "lossy.fits"), expected[0].data, fits.Header(),
+                               output=redux.OutputFormat(compression="rice", quantize_level=0))
+
+    def test_frame_pipeline(self):
+        held, peak = set(), [0]
+
+        def read(job):
+            if job[0] == "bad":
+                raise IOError("unreadable")
+            held.add(job[0])
+            peak[0] = max(peak[0], len(held))
+            return job[1]
+
+        def compute(job, frame):
+            held.discard(job[0])
+            return frame * 2
+
+        pipeline = redux._FramePipeline(read, compute, lambda job, result: result + 1,
+                                        redux.PipelineOptions(readers=2, prefetch=3, writers=2))
+        jobs = [("frame{}".format(i), i) for i in range(10)]
+        jobs.insert(4, ("bad", 0))
+        # Test if outputs follow the jobs order and a failed job yields the failed value
+        self.assertEqual(list(pipeline.run(jobs, failed=None)),
+                         [2 * i + 1 for i in range(4)] + [None] + [2 * i + 1 for i in range(4, 10)])
+        # Test if no more than prefetch frames were read ahead of the calibration
+        self.assertLessEqual(peak[0], 3)
+        counters = pipeline.rates()
+        self.assertEqual([counters[stage]["frames"] for stage in ("read", "calibrate", "write")], [11, 10, 10])
+        self.assertIsNotNone(counters["write"]["frames_per_sec"])
+
+    def test_output_format_change(self):
+        flat_master, dark_master = self._make_masters()
+        redux.do_calibrate(self.ccds, flat_master, dark_master, self.obj_name, self.out_dir)
+        # Test if a new output format recalibrates every frame, and only once
+        for expected in (self.num_test_files, 0):
+            __, cal_fnames = redux.do_calibrate(
+                self.ccds, flat_master, dark_master, self.obj_name, self.out_dir,
+                output=redux.OutputFormat(compression="gzip"),
+                )
+            self.assertEqual(len(cal_fnames), expected)
+
+    def test_reject_cosmic_rays(self):
+        rng = numpy.random.RandomState(0)
+        yy, xx = numpy.mgrid[0:64, 0:64]
+        data = rng.normal(100.0, 5.0, (64, 64))
+        star = 3000.0 * numpy.exp(-((yy - 20.3) ** 2 + (xx - 40.6) ** 2) / (2 * 2.0 ** 2))
+        data += star
+        hits = [(5, 5), (33, 17), (50, 50), (50, 51), (15, 42)]
+        for hit in hits:
+            data[hit] += 800.0
+        clean = data.copy()
+        mask = redux.reject_cosmic_rays(clean, tile_size=16, threads=2)
+        # Test if every hit is masked and replaced, including the one on the wing of the star,
+        # and the star itself is left alone
+        for hit in hits:
+            self.assertTrue(mask[hit])
+            self.assertLess(clean[hit] - star[hit], 130.0)
+        self.assertFalse(mask[star > 300.0].any())
+        self.assertLessEqual(numpy.count_nonzero(mask), len(hits) + 3)
+        numpy.testing.assert_array_equal(clean[~mask], data[~mask])
+        # Test if the tiles give the same result on one thread
+        serial = data.copy()
+        numpy.testing.assert_array_equal(redux.reject_cosmic_rays(serial, tile_size=16), mask)
+        numpy.testing.assert_array_equal(serial, clean)
+        # Test if a NaN pixel next to a hit is masked and does not hide the hit
+        data[34, 17] = numpy.nan
+        nan_mask = redux.reject_cosmic_rays(data, tile_size=16)
+        self.assertTrue(nan_mask[34, 17])
+        for hit in hits:
+            self.assertTrue(nan_mask[hit])
+        self.assertLessEqual(numpy.count_nonzero(nan_mask), numpy.count_nonzero(mask) + 1)
+
+    def _write_field(self, name, nstars, level=100.0, saturated=0.0):
+        rng = numpy.random.RandomState(len(name))
+        yy, xx = numpy.mgrid[0:64, 0:64]
+        data = rng.normal(level, 5.0, (64, 64))
+        for y, x in rng.uniform(4, 60, (nstars, 2)):
+            data += 2000.0 * numpy.exp(-((yy - y) ** 2 + (xx - x) ** 2) / (2 * 1.5 ** 2))
+        data[:int(64 * saturated)] = 65535
+        hdu = fits.PrimaryHDU(data.astype(numpy.uint16))
+        hdu.header['EXPOSURE'] = 60.0
+        fname = os.path.join(self.in_dir, "{}.fits".format(name))
+        hdu.writeto(fname, overwrite=True)
+        return fname
+
+    def test_screen_frames(self):
+        self.nrows = self.ncols = 64
+        flat_master, dark_master = self._make_masters()
+        clear = self._write_field("clear", 20)
+        cloudy = self._write_field("cloudy", 0, level=300.0)
+        saturated = self._write_field("saturated", 20, saturated=0.25)
+        quality = redux.frame_quality(clear, step=1)
+        self.assertAlmostEqual(quality.level, 100.0, delta=5.0)
+        self.assertGreaterEqual(quality.stars, 15)
+        self.assertEqual(quality.saturated, 0.0)
+        screen = redux.ScreenOptions(step=1, threads=2)
+        __, cal_fnames = redux.do_calibrate(
+            [clear, cloudy, saturated], flat_master, dark_master, self.obj_name, self.out_dir,
+            screen=screen,
+            )
+        # Test if only the clear frame is calibrated and the others are listed with their reason
+        self.assertEqual([os.path.basename(f) for f in cal_fnames], ["cal-clear.fits"])
+        rejected_csv = os.path.join(self.out_dir, "cal_{}".format(self.obj_name), "rejected.csv")
+        rejected = redux._load_rejected(os.path.dirname(rejected_csv))
+        self.assertEqual(sorted(rejected), ["cloudy.fits", "saturated.fits"])
+        self.assertEqual(rejected["cloudy.fits"]["reason"], "0 stars")
+        self.assertEqual(rejected["saturated.fits"]["reason"], "25.0% of pixels saturated")
+        # Test if a frame that passes on a later run is calibrated and removed from the list
+        self._write_field("cloudy", 20)
+        __, cal_fnames = redux.do_calibrate(
+            [clear, cloudy, saturated], flat_master, dark_master, self.obj_name, self.out_dir,
+            screen=screen,
+            )
+        self.assertEqual([os.path.basename(f) for f in cal_fnames], ["cal-cloudy.fits"])
+        self.assertEqual(sorted(redux._load_rejected(os.path.dirname(rejected_csv))), ["saturated.fits"])
+
+    def test_do_calibrate_masking(self):
+        flat_master, dark_master = self._make_masters()
+        dark_master.data[2, 3] = 1000.0
+        flat_master.data[5, 5] = 10.0
+        bad_pixels = redux.bad_pixel_mask(dark_master, flat_master)
+        self.assertEqual(list(zip(*numpy.nonzero(bad_pixels))), [(2, 3), (5, 5)])
+        # Test if a NaN in a master masks only its own pixel
+        nan_dark = dark_master.copy()
+        nan_dark.data[8, 1] = numpy.nan
+        self.assertEqual(list(zip(*numpy.nonzero(redux.bad_pixel_mask(nan_dark, flat_master)))),
+                         [(2, 3), (5, 5), (8, 1)])
+        with fits.open(self.ccds[0], mode="update") as hdul:
+            hdul[0].data[7, 7] += 1000.0
+        masking = redux.MaskOptions(tile_size=8)
+        for engine in redux._ENGINES:
+            cal_ccds, cal_fnames = redux.do_calibrate(
+                self.ccds, flat_master, dark_master, engine, self.out_dir, True,
+                engine=engine, masking=masking,
+                )
+            # Test if the bad pixels and the cosmic ray are in the written mask
+            for acal, afile in zip(cal_ccds, cal_fnames):
+                mask = ccdproc.fits_ccddata_reader(afile).mask
+                numpy.testing.assert_array_equal(mask, acal.mask)
+                self.assertTrue(mask[bad_pixels].all())
+            self.assertTrue(cal_ccds[0].mask[7, 7])
+            self.assertLess(abs(cal_ccds[0].data[7, 7]), 100.0)
+        # Test if a change of masking recalibrates every frame, and only once
+        for expected in (self.num_test_files, 0):
+            __, cal_fnames = redux.do_calibrate(
+                self.ccds, flat_master, dark_master, "numpy", self.out_dir,
+                masking=masking._replace(cr_sigma=6.0, threads=2),
+                )
+            self.assertEqual(len(cal_fnames), expected)
+
+    def _write_shifted(self, name, offset):
+        rng = numpy.random.RandomState(0)
+        yy, xx = numpy.mgrid[0:64, 0:64]
+        data = normal(200.0, 5.0, (64, 64))
+        for y, x in rng.uniform(12, 52, (10, 2)):
+            data += 3000.0 * numpy.exp(-((yy - y - offset[0]) ** 2 + (xx - x - offset[1]) ** 2) / (2 * 1.5 ** 2))
+        hdu = fits.PrimaryHDU(data.astype(numpy.uint16))
+        hdu.header['EXPOSURE'] = 60.0
+        fname = os.path.join(self.in_dir, "{}.fits".format(name))
+        hdu.writeto(fname, overwrite=True)
+        return fname
+
+    def test_do_calibrate_stacking(self):
+        self.nrows = self.ncols = 64
+        flat_master, dark_master = self._make_masters()
+        offsets = [(0, 0), (3, -2), (-5, 4), (1, 7)]
+        frames = [self._write_shifted("field_{}".format(i), offset) for i, offset in enumerate(offsets)]
+        stacking = redux.StackOptions(region=64)
+        cal_ccds, __ = redux.do_calibrate(frames[:3], flat_master, dark_master, self.obj_name, self.out_dir, True,
+                                          stacking=stacking)
+        check_path = os.path.join(self.out_dir, "cal_{}".format(self.obj_name))
+        stack_fname = os.path.join(check_path, "stack-{}.fit".format(self.obj_name))
+        # Test if the offsets are recovered and the aligned frames are averaged
+        header = fits.getheader(stack_fname)
+        self.assertEqual(header["NCOMBINE"], 3)
+        self.assertEqual(list(header["HISTORY"]), [
+            "Stacked field_{}.fits offset by {} rows and {} columns".format(i, *offset)
+            for i, offset in enumerate(offsets[:3])])
+        stack = ccdproc.fits_ccddata_reader(stack_fname)
+        expected = numpy.mean([cal_ccd.data[20 + dy:44 + dy, 20 + dx:44 + dx]
+                               for cal_ccd, (dy, dx) in zip(cal_ccds, offsets)], axis=0)
+        numpy.testing.assert_allclose(stack.data[20:44, 20:44], expected, rtol=1e-5, atol=1e-3)
+        # The reference frame covers the whole stack
+        self.assertFalse(stack.mask.any())
+        self.assertTrue(numpy.isfinite(stack.uncertainty.array[5:-5, 7:-7]).all())
+        # Test if an unchanged object is not stacked again, and a new frame is added to the stack
+        mtime = os.path.getmtime(stack_fname)
+        redux.do_calibrate(frames[:3], flat_master, dark_master, self.obj_name, self.out_dir, stacking=stacking)
+        self.assertEqual(os.path.getmtime(stack_fname), mtime)
+        with mock.patch.object(redux, "_read_calibrated", wraps=redux._read_calibrated) as read:
+            redux.do_calibrate(frames[3:], flat_master, dark_master, self.obj_name, self.out_dir, stacking=stacking)
+        # The frames stacked before are not read back
+        self.assertEqual(read.call_count, 0)
+        header = fits.getheader(stack_fname)
+        self.assertEqual(header["NCOMBINE"], 4)
+        self.assertEqual(len(header["HISTORY"]), 4)
+        self.assertIn("Stacked field_3.fits offset by 1 rows and 7 columns", header["HISTORY"])
+        # Test if the resumed stack is the stack of all the frames read back
+        stack = ccdproc.fits_ccddata_reader(stack_fname)
+        os.remove(os.path.join(check_path, ".stack-{}.npz".format(self.obj_name)))
+        os.remove(stack_fname)
+        with mock.patch.object(redux, "_read_calibrated", wraps=redux._read_calibrated) as read:
+            redux.do_calibrate(frames, flat_master, dark_master, self.obj_name, self.out_dir, stacking=stacking)
+        self.assertEqual(read.call_count, 4)
+        rebuilt = ccdproc.fits_ccddata_reader(stack_fname)
+        numpy.testing.assert_allclose(rebuilt.data, stack.data, rtol=1e-6)
+        numpy.testing.assert_allclose(rebuilt.uncertainty.array, stack.uncertainty.array, rtol=1e-5)
+        # Test if the median stack, combined in blocks of rows, leaves no spill file behind
+        median = redux.StackOptions("median", 64, mem_limit=64 * 64 * 4 * 10)
+        redux.do_calibrate(frames, flat_master, dark_master, self.obj_name, self.out_dir, stacking=median)
+        median_stack = ccdproc.fits_ccddata_reader(stack_fname)
+        self.assertEqual(median_stack.header["STACKMTH"], "median")
+        numpy.testing.assert_allclose(median_stack.data[20:44, 20:44], stack.data[20:44, 20:44], rtol=0.1,
+                                      atol=50.0)
+        self.assertEqual(sorted(os.listdir(check_path)), [".stack-{}.npz".format(self.obj_name)] +
+                         ["cal-field_{}.fits".format(i) for i in range(4)] +
+                         ["manifest.json", "stack-{}.fit".format(self.obj_name)])
+
+
+class TestBias(unittest.TestCase):
+    def setUp(self):
+        self.in_dir = "inputs"
+        self.out_dir = "outputs"
+        for adir in (self.in_dir, self.out_dir):
+            if not os.path.exists(adir):
+                os.makedirs(adir)
+        # 12x20 raw frames: columns 17-20 are overscan, rows 2-11 and columns 1-16 are kept
+        self.nrows, self.ncols = 12, 20
+        yy, xx = numpy.mgrid[0:self.nrows, 0:self.ncols]
+        self.bias_level = 1000.0 + 2.0 * xx
+        self.dark_rate = 0.5
+        self.flat_field = 1.0 + 0.01 * yy
+        self.sky = 300.0
+        self.trim = (slice(1, 11), slice(0, 16))
+
+    def tearDown(self):
+        import shutil
+        for adir in (self.in_dir, self.out_dir):
+            if os.path.exists(adir):
+                shutil.rmtree(adir)
+
+    def _write_raw(self, name, signal, exposure, seed):
+        # Each readout adds a row-dependent offset to the whole row, overscan included
+        rng = numpy.random.RandomState(seed)
+        offset = rng.uniform(40, 60, size=(self.nrows, 1))
+        data = offset + signal
+        data[:, 16:] = offset
+        hdu = fits.PrimaryHDU(data)
+        hdu.header['exposure'] = exposure
+        hdu.header['BIASSEC'] = '[17:20,1:12]'
+        hdu.header['TRIMSEC'] = '[1:16,2:11]'
+        fname = os.path.join(self.in_dir, name)
+        hdu.writeto(fname)
+        return fname
+
+    def _write_masters_inputs(self):
+        bias = [self._write_raw("bias_{}.fits".format(i), self.bias_level, 0.0, i) for i in range(3)]
+        darks = [self._write_raw("dark_{}.fits".format(i), self.bias_level + self.dark_rate * 60.0, 60.0, 10 + i)
+                 for i in range(3)]
+        flats = [self._write_raw("flat_{}.fits".format(i),
+                                 self.bias_level + self.dark_rate * 5.0 + 20000.0 * self.flat_field, 5.0, 20 + i)
+                 for i in range(3)]
+        return bias, darks, flats
+
+    def test_overscan_tiled_combine(self):
+        bias, __, __ = self._write_masters_inputs()
+        master_bias, bias_fname = redux.do_bias_combine(bias, self.out_dir, mem_limit=1, overscan=True)
+        self.assertEqual(master_bias.shape, (10, 16))
+        numpy.testing.assert_allclose(master_bias.data, self.bias_level[self.trim])
+        self.assertNotIn('TRIMSEC', master_bias.header)
+        # In-memory frames are corrected by ccdproc.subtract_overscan and trim_image
+        ccds = [ccdproc.fits_ccddata_reader(f, unit='adu') for f in bias]
+        os.remove(bias_fname)
+        in_memory, __ = redux.do_bias_combine(ccds, self.out_dir, overscan=True)
+        numpy.testing.assert_allclose(in_memory.data, master_bias.data)
+
+    def test_bias_aware_dark_scaling(self):
+        bias, darks, flats = self._write_masters_inputs()
+        master_bias, __ = redux.do_bias_combine(bias, self.out_dir, overscan=True)
+        master_dark, __ = redux.do_dark_combine(darks, self.out_dir, master_bias=master_bias, overscan=True)
+        # The master dark holds only the dark current
+        numpy.testing.assert_allclose(master_dark.data, self.dark_rate * 60.0)
+        master_flat, __ = redux.do_flat_combine(flats, master_dark, self.out_dir, master_bias=master_bias,
+                                                overscan=True)
+
+        # Lights with a much shorter exposure than the darks
+        lights = [self._write_raw("light_{}.fits".format(i),
+                                  self.bias_level + self.dark_rate * 10.0 + self.sky * self.flat_field, 10.0, 30 + i)
+                  for i in range(2)]
+        expected = self.sky * self.flat_field[self.trim].mean()
+        for engine in redux._ENGINES:
+            cal_frames, __ = redux.do_calibrate(lights, master_flat, master_dark, "obj_" + engine, self.out_dir,
+                                                return_fits_objs=True, engine=engine, master_bias=master_bias,
+                                                overscan=True)
+            self.assertEqual(len(cal_frames), 2)
+            for cal in cal_frames:
+                self.assertEqual(cal.shape, (10, 16))
+                numpy.testing.assert_allclose(cal.data, expected, rtol=1e-5)
+
+
+class TestMasterIndex(unittest.TestCase):
+    def setUp(self):
+        self.in_dir = "inputs"
+        self.out_dir = "outputs"
+        self.night_dir = os.path.join(self.in_dir, "20170817")
+        for subdir in ("dark", "flat", "obj"):
+            os.makedirs(os.path.join(self.night_dir, subdir))
+        os.makedirs(self.out_dir)
+        redux._OUT_DIR = self.out_dir
+        self.shape = (8, 6)
+        yy, xx = numpy.mgrid[0:8, 0:6]
+        self.flat_fields = {"R": 1.0 + 0.05 * yy, "V": 1.0 + 0.05 * xx}
+        self.dark_rate = 2.0
+        self.sky = 100.0
+        self.dark_list = [self._write("dark", "dark_{}s_{}.fits".format(exposure, i), exposure,
+                                      self.dark_rate * exposure)
+                          for exposure in (10.0, 60.0) for i in range(3)]
+        self.flat_list = [self._write("flat", "flat_{}_{}.fits".format(filt, i), 10.0,
+                                      self.dark_rate * 10.0 + 1000.0 * field, filt)
+                          for filt, field in sorted(self.flat_fields.items()) for i in range(3)]
+
+    def tearDown(self):
+        import shutil
+        for adir in (self.in_dir, self.out_dir):
+            if os.path.exists(adir):
+                shutil.rmtree(adir)
+
+    def _write(self, subdir, name, exposure, data, filt="R", binning=1):
+        hdu = fits.PrimaryHDU(numpy.broadcast_to(data, self.shape).astype(numpy.float64))
+        hdu.header['exposure'] = exposure
+        hdu.header['FILTER'] = filt
+        hdu.header['XBINNING'] = binning
+        hdu.header['YBINNING'] = binning
+        fname = os.path.join(self.night_dir, subdir, name)
+        hdu.writeto(fname)
+        return fname
+
+    def _light(self, name, filt, exposure, binning=1):
+        return self._write("obj", name, exposure,
+                           self.dark_rate * exposure + self.sky * self.flat_fields.get(filt, 1.0), filt, binning)
+
+    def test_grouped_masters(self):
+        index = redux._make_masters(self.night_dir, [], self.dark_list, self.flat_list)
+        master_dir = os.path.join(self.out_dir, "20170817", "master_frames")
+        self.assertEqual(sorted(os.listdir(master_dir)), [
+            "master-dark-1x1-8x6-10s.fit", "master-dark-1x1-8x6-60s.fit",
+            "master-flat-R-1x1-8x6.fit", "master-flat-V-1x1-8x6.fit",
+            ])
+        self.assertEqual(len(index), 4)
+
+        lights = [self._light("r_60.fits", "R", 60.0), self._light("v_10.fits", "V", 10.0),
+                  self._light("v_30.fits", "V", 30.0), self._light("b_10.fits", "B", 10.0),
+                  self._light("r_bin2.fits", "R", 60.0, binning=2)]
+        flat_key, dark_key, bias_key = index.masters_for(redux.scan_header(lights[1]))
+        self.assertEqual((flat_key[1][0], dark_key[1][2], bias_key), ("V", 10, None))
+        # Exposures without a dark of their own get the longest dark, scaled
+        self.assertEqual(index.masters_for(redux.scan_header(lights[2]))[1][1][2], 60)
+        # No flat for the filter or no masters for the binning
+        self.assertIsNone(index.masters_for(redux.scan_header(lights[3])))
+        self.assertIsNone(index.masters_for(redux.scan_header(lights[4])))
+
+        cal_frames, cal_fnames = redux.do_calibrate(lights, None, None, "obj", self.out_dir,
+                                                    return_fits_objs=True, index=index)
+        self.assertEqual([os.path.basename(f) for f in cal_fnames], ["cal-r_60.fits", "cal-v_10.fits",
+                                                                      "cal-v_30.fits"])
+        for cal, filt in zip(cal_frames, "RVV"):
+            numpy.testing.assert_allclose(cal.data, self.sky * self.flat_fields[filt].mean(), rtol=1e-5)
+
+    def test_lazy_loading(self):
+        # A fresh index, e.g. in a worker process, reads masters only when a frame needs them
+        index = redux._make_masters(self.night_dir, [], self.dark_list, self.flat_list)
+        index = pickle.loads(pickle.dumps(index))
+        lights = [self._light("r_60.fits", "R", 60.0)]
+        __, cal_fnames = redux.do_calibrate(lights, None, None, "obj", self.out_dir, index=index)
+        self.assertEqual(len(cal_fnames), 1)
+        # Only the R flat and the 60 s dark were read
+        self.assertEqual(set(index._loaded), set(index.masters_for(redux.scan_header(lights[0]))[:2]))
+        self.assertEqual(len(index._loaded), 2)
+
 
 class TestMain(unittest.TestCase):
     def setUp(self):
@@ -162,6 +962,18 @@ class TestMain(unittest.TestCase):
                     os.path.join(night_dir, "flat",
                     "flat_{:02d}.fits".format(i)),
                     )
+            # Generate bias frames for the first night only
+            if anight == self.nights[0]:
+                os.makedirs(os.path.join(night_dir, "bias"))
+                for i in range(self.num_test_files):
+                    bias = fits.PrimaryHDU(
+                        normal(loc=10, scale=1, size=(self.nrows, self.ncols)),
+                        )
+                    bias.header['exposure'] = 0.0
+                    bias.writeto(
+                        os.path.join(night_dir, "bias",
+                        "bias_{:02d}.fits".format(i)),
+                        )
             # Generate object frames
             self.object_names = ["eso364-014", "ngc1341"]
             for objn in self.object_names:
@@ -189,6 +1001,107 @@ class TestMain(unittest.TestCase):
         redux._IN_DIR = self.in_dir
         redux._OUT_DIR = self.out_dir
         redux.main()
+        self.check_outputs()
+
+    def test_main_scheduler(self):
+        redux._IN_DIR = self.in_dir
+        redux._OUT_DIR = self.out_dir
+        redux.main(tasks=3, io_tasks=1)
+        self.check_outputs()
+
+    def test_main_report(self):
+        redux._IN_DIR = self.in_dir
+        redux._OUT_DIR = self.out_dir
+        profile_dir = os.path.join(self.out_dir, "profiles")
+        for tasks in (1, 2):
+            redux._REPORT = redux.RunReport(profile_dir)
+            try:
+                redux.main(tasks=tasks)
+                report_fname = os.path.join(self.out_dir, "run_report.json")
+                redux._REPORT.write(report_fname)
+            finally:
+                redux._REPORT = None
+            with open(report_fname) as fobj:
+                report = json.load(fobj)
+            stages = [astage["stage"] for astage in report["stages"]]
+            # Test if every stage of every night and object was recorded
+            self.assertEqual(stages.count("dark_combine"), len(self.nights))
+            self.assertEqual(stages.count("flat_combine"), len(self.nights))
+            self.assertEqual(stages.count("calibrate"), len(self.nights) * len(self.object_names))
+            self.assertEqual(stages.count("main"), 1)
+            for astage in report["stages"]:
+                self.assertIn("seconds", astage)
+                self.assertIn("peak_rss_mb", astage)
+            if tasks == 1:
+                self.assertEqual(report["totals"]["calibrate"]["frames"],
+                                 len(self.nights) * len(self.object_names) * self.num_test_files)
+                # Test if the calibration pipeline counters were recorded
+                for astage in report["stages"]:
+                    if astage["stage"] == "calibrate":
+                        self.assertEqual(astage["pipeline"]["write"]["frames"], self.num_test_files)
+            # Test if the leaf stages were profiled
+            self.assertTrue(any(f.endswith(".prof") for f in os.listdir(profile_dir)))
+
+    def test_reducer(self):
+        night, obj = self.nights[1], self.object_names[0]
+        redux._IN_DIR = None
+        with redux.Reducer(self.in_dir, self.out_dir) as reducer:
+            plan = reducer.plan(nights=[night])
+            self.assertEqual(plan[0], {"night": night, "masters": {
+                "bias": {}, "dark": {"master-dark.fit": 3}, "flat": {"master-flat.fit": 3}}})
+            self.assertEqual([(step["object"], step["todo"]) for step in plan[1:]],
+                             [(objn, self.num_test_files) for objn in self.object_names])
+            # Test if only the given object is calibrated
+            reducer.object(night, obj)
+            plan = reducer.plan(nights=[night])
+            self.assertEqual([step["todo"] for step in plan[1:]], [0, self.num_test_files])
+            # Test if a single frame is calibrated in place
+            item = os.path.join(self.in_dir, night, self.object_names[1], "{}_00.fits".format(self.object_names[1]))
+            out_filename = reducer.frame(item)
+            self.assertEqual(out_filename, os.path.join(self.out_dir, night, "cal_frames",
+                                                        "cal_{}".format(self.object_names[1]), "cal-" +
+                                                        os.path.basename(item)))
+            self.assertEqual(reducer.plan(nights=[night])[2]["todo"], self.num_test_files - 1)
+        # Test if the module globals are left alone
+        self.assertIsNone(redux._IN_DIR)
+
+    def test_plan_imports(self):
+        # Test if planning a run imports none of the heavy modules
+        script = ("import sys; sys.path.insert(0, {!r}); import imageredux; "
+                  "imageredux.Reducer({!r}, {!r}).plan(); "
+                  "print(sorted(m for m in ('astropy', 'ccdproc', 'numpy') if m in sys.modules))").format(
+                      os.path.dirname(os.path.abspath(redux.__file__)), self.in_dir, self.out_dir)
+        output = subprocess.check_output([sys.executable, "-c", script], universal_newlines=True)
+        self.assertEqual(output.strip(), "[]")
+        # Test if a task imports them before its stages are timed
+        script = script.replace(".plan()", "; imageredux._in_dirs({!r}, {!r}, None, len, [])".format(
+            self.in_dir, self.out_dir))
+        output = subprocess.check_output([sys.executable, "-c", script], universal_newlines=True)
+        self.assertEqual(output.strip(), "['astropy', 'ccdproc', 'numpy']")
+
+    def test_distributed(self):
+        queue_fname = os.path.join(self.out_dir, "queue.sqlite")
+        redux._REPORT = None
+        with redux.Reducer(self.in_dir, self.out_dir) as reducer:
+            counts = reducer.distribute(queue_fname, wait=False)
+            self.assertEqual(counts, {"pending": len(self.nights) * (1 + len(self.object_names))})
+            # Test if several worker processes share the queue
+            script = os.path.join(os.path.dirname(os.path.abspath(redux.__file__)), "imageredux.py")
+            workers = [subprocess.Popen([sys.executable, script, "--worker", "--queue", queue_fname,
+                                         "--poll-interval", "0.1"],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                       for __ in range(3)]
+            for worker in workers:
+                self.assertEqual(worker.wait(timeout=120), 0)
+            # Test if distributing again keeps the units done
+            self.assertEqual(reducer.distribute(queue_fname, wait=False),
+                             {"done": len(self.nights) * (1 + len(self.object_names))})
+        self.check_outputs()
+        results = redux.WorkQueue(queue_fname).results()
+        self.assertEqual(results["{}:{}".format(self.nights[0], self.object_names[0])]["value"],
+                         {"calibrated": self.num_test_files})
+
+    def check_outputs(self):
         # Test if all night folders were created
         self.assertTrue(
             all([anight in os.listdir(self.out_dir) for anight in self.nights])
@@ -211,6 +1124,9 @@ class TestMain(unittest.TestCase):
                 fits.getdata(masterflat_path).shape,
                 (self.nrows, self.ncols),
                 )
+            masterbias_path = os.path.join(
+                night_dir, "master_frames", "master-bias.fit")
+            self.assertEqual(os.path.exists(masterbias_path), anight == self.nights[0])
             for anobj in self.object_names:
                 calframe_dir = os.path.join(
                     night_dir, "cal_frames", "cal_{}".format(anobj),
@@ -227,5 +1143,233 @@ class TestMain(unittest.TestCase):
                         )
 
 
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = "outputs"
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.queue = redux.WorkQueue(os.path.join(self.out_dir, "queue.sqlite"), max_attempts=2)
+        self.queue.add("night:masters", "masters", {"night": "night"})
+        self.queue.add("night:obj", "object", {"night": "night"}, deps=["night:masters"])
+
+    def tearDown(self):
+        import shutil
+        if os.path.exists(self.out_dir):
+            shutil.rmtree(self.out_dir)
+
+    def test_dependencies(self):
+        unit = self.queue.claim("a")
+        self.assertEqual(unit["name"], "night:masters")
+        # Test if a unit waits for its dependencies and gets their results
+        self.assertIsNone(self.queue.claim("b"))
+        self.assertTrue(self.queue.complete("night:masters", "a", {"masters": []}))
+        unit = self.queue.claim("b")
+        self.assertEqual((unit["name"], unit["deps"]), ("night:obj", [{"masters": []}]))
+        self.assertTrue(self.queue.complete("night:obj", "b", 1))
+        self.assertTrue(self.queue.finished())
+        # Test if unchanged units are kept and changed ones queued again
+        self.assertFalse(self.queue.add("night:masters", "masters", {"night": "night"}))
+        self.assertTrue(self.queue.add("night:masters", "masters", {"night": "night", "dark": ["new"]}))
+
+    def test_expired_lease(self):
+        self.queue.claim("a", lease=0.0)
+        time.sleep(0.01)
+        # Test if another worker takes over an expired unit and the first one loses it
+        unit = self.queue.claim("b")
+        self.assertEqual((unit["name"], unit["attempts"]), ("night:masters", 2))
+        self.assertFalse(self.queue.renew("night:masters", "a"))
+        self.assertFalse(self.queue.complete("night:masters", "a", None))
+        self.assertTrue(self.queue.renew("night:masters", "b"))
+        # Test if a stale result or failure is discarded and the new holder keeps the unit
+        self.queue.fail("night:masters", "a", "IOError", attempt=1)
+        self.assertFalse(self.queue.holds("night:masters", "b", attempt=1))
+        self.assertTrue(self.queue.holds("night:masters", "b", attempt=2))
+        self.assertTrue(self.queue.complete("night:masters", "b", {"masters": []}, attempt=2))
+
+    def test_lapsed_lease(self):
+        unit = self.queue.claim("a", lease=0.0)
+        time.sleep(0.01)
+        # Test if a worker whose lease lapsed loses its unit before anyone claims it again
+        self.assertFalse(self.queue.holds(unit["name"], "a", unit["attempts"]))
+        self.assertFalse(self.queue.complete(unit["name"], "a", None, unit["attempts"]))
+        self.assertEqual(self.queue.counts(), {"running": 1, "pending": 1})
+
+    def test_retries(self):
+        for worker in ("a", "b"):
+            unit = self.queue.claim(worker)
+            self.assertEqual(unit["name"], "night:masters")
+            self.queue.fail("night:masters", worker, "IOError")
+        # Test if a unit fails for good after max_attempts, with the units depending on it
+        self.assertIsNone(self.queue.claim("c"))
+        self.assertEqual(self.queue.counts(), {"failed": 2})
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.in_dir = "inputs"
+        self.out_dir = "outputs"
+        for adir in (self.in_dir, self.out_dir):
+            if not os.path.exists(adir):
+                os.makedirs(adir)
+        self.night = "20170817"
+        for subdir in ("dark", "flat", "ngc1341"):
+            os.makedirs(os.path.join(self.in_dir, self.night, subdir))
+            for i in range(2):
+                self._write_frame(subdir, "{}_{:02d}.fit".format(subdir, i))
+        self.db_path = os.path.join(self.out_dir, "catalog.sqlite")
+
+    def tearDown(self):
+        import shutil
+        for adir in (self.in_dir, self.out_dir):
+            if os.path.exists(adir):
+                shutil.rmtree(adir)
+
+    def _write_frame(self, subdir, name):
+        hdu = fits.PrimaryHDU(normal(loc=100, scale=5, size=(10, 10)))
+        hdu.header['exposure'] = 60.0
+        hdu.writeto(os.path.join(self.in_dir, self.night, subdir, name))
+
+    def test_incremental_update(self):
+        catalog = redux.ObservationCatalog(self.db_path, self.in_dir)
+        self.assertEqual(catalog.update(), 5)
+        catalog.close()
+
+        # A new frame only rescans its directory and reads its own header
+        self._write_frame("ngc1341", "ngc1341_02.fit")
+        catalog = redux.ObservationCatalog(self.db_path, self.in_dir)
+        with mock.patch.object(redux, "scan_header", wraps=redux.scan_header) as scan:
+            self.assertEqual(catalog.update(), 1)
+        self.assertEqual(scan.call_count, 1)
+        self.assertEqual(catalog.update(), 0)
+
+        self.assertEqual(catalog.nights(), [self.night])
+        self.assertEqual(redux._object_dirs(os.path.join(self.in_dir, self.night), catalog), ["ngc1341"])
+        frames = catalog.frames(night=self.night, object="ngc1341")
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(frames[0]["frametype"], "light")
+        self.assertEqual((frames[0]["exposure"], frames[0]["nrows"], frames[0]["ncols"]), (60.0, 10, 10))
+        anight = os.path.join(self.in_dir, self.night)
+        self.assertEqual(redux._calibration_lists(anight, catalog), redux._calibration_lists(anight))
+
+        # Removed frames and directories are dropped
+        os.remove(os.path.join(self.in_dir, self.night, "dark", "dark_00.fit"))
+        import shutil
+        shutil.rmtree(os.path.join(self.in_dir, self.night, "flat"))
+        catalog.update()
+        self.assertEqual(len(catalog.frames(frametype="dark")), 1)
+        self.assertEqual(catalog.frames(frametype="flat"), [])
+        catalog.close()
+
+    def test_equivalent_root(self):
+        catalog = redux.ObservationCatalog(self.db_path, self.in_dir)
+        catalog.update()
+        catalog.close()
+        # Test if the catalog reopened with the absolute root is reused and gives paths under it
+        root = os.path.abspath(self.in_dir)
+        catalog = redux.ObservationCatalog(self.db_path, root)
+        self.assertEqual(catalog.update(), 0)
+        anight = os.path.join(root, self.night)
+        darks = redux._calibration_lists(anight, catalog)[1]
+        self.assertEqual(darks, redux._calibration_lists(anight)[1])
+        self.assertTrue(all(os.path.isabs(f) and os.path.exists(f) for f in darks))
+        catalog.close()
+
+    def test_do_file_list(self):
+        redux._IN_DIR = self.in_dir
+        catalog = redux.ObservationCatalog(self.db_path, self.in_dir)
+        table = redux.do_file_list(catalog)
+        self.assertEqual(len(table), 6)
+        self.assertEqual(set(table['OBS_Date']), {self.night})
+        self.assertEqual(set(table['Object']), {"dark", "flat", "ngc1341"})
+        catalog.close()
+        # Test if the paths are listed without reading headers when no catalog is given
+        with mock.patch.object(redux, "scan_header", wraps=redux.scan_header) as scan:
+            table = redux.do_file_list()
+        self.assertEqual(scan.call_count, 0)
+        self.assertEqual(len(table), 6)
+
+
+class TestScheduler(unittest.TestCase):
+    def test_run_dag(self):
+        import operator
+        tasks = [
+            redux._Task("b", operator.mul, (10,), deps=["a"]),
+            redux._Task("a", operator.add, (1, 2), io_bound=True),
+            redux._Task("c", operator.truediv, (1, 0), io_bound=True),
+            redux._Task("d", operator.neg, (), deps=["c"]),
+            ]
+        results = redux._run_dag(tasks, max_workers=2, io_limit=1)
+        # Test if dependency results are passed on
+        self.assertEqual(results, {"a": 3, "b": 30})
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.num_test_files = 3
+        self.nrows = 10
+        self.ncols = 10
+        self.out_dir = "outputs"
+        self.in_dir = "inputs"
+        self.night = "20170817"
+        self.obj_name = "ngc4993"
+        self.night_dir = os.path.join(self.in_dir, self.night)
+        for adir in ("dark", "flat", self.obj_name):
+            os.makedirs(os.path.join(self.night_dir, adir))
+        os.makedirs(self.out_dir)
+        for i in range(self.num_test_files):
+            self._write_frame("dark", "dark_{:02d}.fits".format(i))
+            self._write_frame("flat", "flat_{:02d}.fits".format(i))
+            self._write_frame(self.obj_name, "{}_{:02d}.fits".format(self.obj_name, i))
+        redux._IN_DIR = self.in_dir
+        redux._OUT_DIR = self.out_dir
+
+    def tearDown(self):
+        import shutil
+        for adir in (self.in_dir, self.out_dir):
+            if os.path.exists(adir):
+                shutil.rmtree(adir)
+
+    def _write_frame(self, subdir, name):
+        hdu = fits.PrimaryHDU(normal(loc=100, scale=5, size=(self.nrows, self.ncols)))
+        hdu.header['exposure'] = 60.0
+        fname = os.path.join(self.night_dir, subdir, name)
+        hdu.writeto(fname)
+        return fname
+
+    def test_stable_files(self):
+        fname = self._write_frame(self.obj_name, "growing.fits")
+        seen = {}
+        self.assertEqual(redux._stable_files([fname], seen, 0.0, 1.0), [])
+        self.assertEqual(redux._stable_files([fname], seen, 2.0, 1.0), [fname])
+        # Test if a file that is still being written is not stable
+        with open(fname, "ab") as fobj:
+            fobj.write(b"\0" * 2880)
+        self.assertEqual(redux._stable_files([fname], seen, 3.0, 1.0), [])
+        self.assertEqual(redux._stable_files([fname], seen, 4.0, 1.0), [fname])
+
+    def test_watch(self):
+        import threading
+        import time
+        watcher = threading.Thread(
+            target=redux.watch,
+            kwargs=dict(workers=2, poll_interval=0.05, settle_time=0.2, idle_timeout=1.0),
+            )
+        with mock.patch.object(redux, "CalibrationKernel", wraps=redux.CalibrationKernel) as kernel_class:
+            watcher.start()
+            time.sleep(0.5)
+            # A frame landing while the watch is running
+            self._write_frame(self.obj_name, "{}_late.fits".format(self.obj_name))
+            watcher.join(timeout=60)
+        self.assertFalse(watcher.is_alive())
+        # Test if the kernel of the night is built once for every frame
+        self.assertEqual(kernel_class.call_count, 1)
+        cal_dir = os.path.join(self.out_dir, self.night, "cal_frames", "cal_{}".format(self.obj_name))
+        names = ["{}_{:02d}.fits".format(self.obj_name, i) for i in range(self.num_test_files)]
+        names.append("{}_late.fits".format(self.obj_name))
+        for name in names:
+            self.assertTrue(os.path.exists(os.path.join(cal_dir, "cal-" + name)))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.out_dir, self.night, "master_frames", "master-flat.fit")))
+
+
 if __name__ == "__main__":
     unittest.main()